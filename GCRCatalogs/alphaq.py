@@ -9,20 +9,29 @@ from distutils.version import StrictVersion # pylint: disable=no-name-in-module,
 import numpy as np
 import h5py
 from astropy.cosmology import FlatLambdaCDM
-from GCR import BaseGenericCatalog
-from .utils import md5
+from .base import BaseCatalog, NativeChunk, read_rows, MAX_ROW_RUNS, ROW_INDEX
+from .buffers import scratch
+from .utils import md5, first, seeded_uniform
 
 __all__ = ['AlphaQGalaxyCatalog']
 __version__ = '5.0.0'
 
 
 def _calc_weighted_size(size1, size2, lum1, lum2):
-    return ((size1*lum1) + (size2*lum2)) / (lum1+lum2)
+    # ((size1*lum1) + (size2*lum2)) / (lum1+lum2), with one output array
+    size = np.multiply(size1, lum1, dtype=np.result_type(size1, size2, lum1, lum2))
+    with scratch(size.shape, size.dtype) as tmp:
+        size += np.multiply(size2, lum2, out=tmp)
+        size /= np.add(lum1, lum2, out=tmp)
+    return size
 
 
 def _calc_weighted_size_minor(size1, size2, lum1, lum2, ell):
     size = _calc_weighted_size(size1, size2, lum1, lum2)
-    return size * (1.0 - ell) / (1.0 + ell)
+    with scratch(size.shape, size.dtype) as tmp:
+        size *= np.subtract(1.0, ell, out=tmp)
+        size /= np.add(1.0, ell, out=tmp)
+    return size
 
 
 def _calc_conv(mag, shear1, shear2):
@@ -49,47 +58,76 @@ def _calc_Av(lum_v, lum_v_dust):
     return Av
 
 
-def _gen_position_angle(size_reference):
-    # pylint: disable=protected-access
-    size = size_reference.size
-    if not hasattr(_gen_position_angle, "_pos_angle") or _gen_position_angle._pos_angle.size != size:
-        _gen_position_angle._pos_angle = np.random.RandomState(123497).uniform(0, 180, size)
-    return _gen_position_angle._pos_angle
+def _gen_position_angle(size_reference, row_index): # pylint: disable=W0613
+    # a fixed random angle for each row of a file, so that the angle of a galaxy
+    # does not depend on which other rows are read
+    if not row_index.size:
+        return np.empty(0)
+    return seeded_uniform(123497, 0, 180, int(row_index.max()) + 1)[row_index]
 
 
-def _calc_ellipticity_1(ellipticity):
-    # position angle using ellipticity as reference for the size or
-    # the array. The angle is converted from degrees to radians
-    pos_angle = _gen_position_angle(ellipticity)*np.pi/180.0
+def _calc_ellipticity_1(ellipticity, row_index):
+    # position angle of each row (see _gen_position_angle).
+    # The angle is converted from degrees to radians
+    pos_angle = _gen_position_angle(ellipticity, row_index)*np.pi/180.0
     # use the correct conversion for ellipticity 1 from ellipticity
     # and position angle
     return ellipticity*np.cos(2.0*pos_angle)
 
 
-def _calc_ellipticity_2(ellipticity):
-    # position angle using ellipticity as reference for the size or
-    # the array. The angle is converted from degrees to radians
-    pos_angle = _gen_position_angle(ellipticity)*np.pi/180.0
+def _calc_ellipticity_2(ellipticity, row_index):
+    # position angle of each row (see _gen_position_angle).
+    # The angle is converted from degrees to radians
+    pos_angle = _gen_position_angle(ellipticity, row_index)*np.pi/180.0
     # use the correct conversion for ellipticity 2 from ellipticity
     # and position angle
     return ellipticity*np.sin(2.0*pos_angle)
 
 
-def _gen_galaxy_id(size_reference):
-    # pylint: disable=protected-access
-    size = size_reference.size
-    if not hasattr(_gen_galaxy_id, "_galaxy_id") or _gen_galaxy_id._galaxy_id.size != size:
-        _gen_galaxy_id._galaxy_id = np.arange(size, dtype='i8')
-    return _gen_galaxy_id._galaxy_id
+def _gen_galaxy_id(size_reference, row_index): # pylint: disable=W0613
+    return row_index.astype('i8')
+
+def _calc_magnification(magnification):
+    return np.where(magnification < 0.2, 1.0, magnification)
+
+
+def _calc_bulge_to_total_ratio(bulge, disk):
+    return bulge/(bulge+disk)
+
+
+def _to_bool(x):
+    return x.astype(np.bool)
 
-def _calc_lensed_magnitude(magnitude, magnification):
-    magnification[magnification==0]=1.0
-    return magnitude -2.5*np.log10(magnification)
 
-class AlphaQGalaxyCatalog(BaseGenericCatalog):
+def _double_rad2deg(pos_angle):
+    return np.rad2deg(np.rad2deg(pos_angle))
+
+
+def _arcsec_to_deg(x):
+    return x/3600
+
+
+def _calc_lensed_magnitude(magnitude, magnification):
+    # magnitude - 2.5*log10(magnification), where a magnification of 0 counts as 1;
+    # `magnification` is shared by all bands, so it is not modified
+    dtype = np.result_type(magnitude, magnification)
+    out = np.empty(np.broadcast(magnitude, magnification).shape, dtype)
+    with scratch(out.shape, dtype) as tmp:
+        tmp.fill(0.0)
+        np.log10(magnification, out=tmp, where=(magnification != 0))
+        tmp *= -2.5
+        np.add(magnitude, tmp, out=out)
+    return out
+
+class AlphaQGalaxyCatalog(BaseCatalog):
     """
     Alpha Q galaxy catalog class. Uses generic quantity and filter mechanisms
     defined by BaseGenericCatalog class.
+
+    Set `use_memmap: true` in the config to memory-map contiguous (unchunked,
+    hence uncompressed) datasets instead of reading (copying) them; quantities
+    may then be returned as read-only arrays (e.g., when one file is read without
+    filters), so copy them before modifying them in place.
     """
 
     def _subclass_init(self, filename, **kwargs): #pylint: disable=W0221
@@ -139,6 +177,7 @@ class AlphaQGalaxyCatalog(BaseGenericCatalog):
                 if isinstance(obj, h5py.Dataset):
                     self._native_quantities.add(name)
             fh['galaxyProperties'].visititems(_collect_native_quantities)
+            self._native_quantities.add(ROW_INDEX)
 
         # check versions
         self.version = kwargs.get('version', '0.0.0')
@@ -167,10 +206,10 @@ class AlphaQGalaxyCatalog(BaseGenericCatalog):
                 'shear1',
                 'shear2',
             ),
-            'magnification': (lambda mag: np.where(mag < 0.2, 1.0, mag), 'magnification'),
+            'magnification': (_calc_magnification, 'magnification'),
             'halo_id':       'hostHaloTag',
             'halo_mass':     'hostHaloMass',
-            'is_central':    (lambda x: x.astype(np.bool), 'isCentral'),
+            'is_central':    (_to_bool, 'isCentral'),
             'stellar_mass':  'totalMassStellar',
             'stellar_mass_disk':        'diskMassStellar',
             'stellar_mass_bulge':       'spheroidMassStellar',
@@ -178,18 +217,18 @@ class AlphaQGalaxyCatalog(BaseGenericCatalog):
             'size_bulge_true':          'morphology/spheroidMajorAxisArcsec',
             'size_minor_disk_true':     'morphology/diskMinorAxisArcsec',
             'size_minor_bulge_true':    'morphology/spheroidMinorAxisArcsec',
-            'position_angle_true':      (_gen_position_angle, 'morphology/positionAngle'),
+            'position_angle_true':      (_gen_position_angle, 'morphology/positionAngle', ROW_INDEX),
             'sersic_disk':              'morphology/diskSersicIndex',
             'sersic_bulge':             'morphology/spheroidSersicIndex',
             'ellipticity_true':         'morphology/totalEllipticity',
-            'ellipticity_1_true':       (_calc_ellipticity_1, 'morphology/totalEllipticity'),
-            'ellipticity_2_true':       (_calc_ellipticity_2, 'morphology/totalEllipticity'),
+            'ellipticity_1_true':       (_calc_ellipticity_1, 'morphology/totalEllipticity', ROW_INDEX),
+            'ellipticity_2_true':       (_calc_ellipticity_2, 'morphology/totalEllipticity', ROW_INDEX),
             'ellipticity_disk_true':    'morphology/diskEllipticity',
-            'ellipticity_1_disk_true':  (_calc_ellipticity_1, 'morphology/diskEllipticity'),
-            'ellipticity_2_disk_true':  (_calc_ellipticity_2, 'morphology/diskEllipticity'),
+            'ellipticity_1_disk_true':  (_calc_ellipticity_1, 'morphology/diskEllipticity', ROW_INDEX),
+            'ellipticity_2_disk_true':  (_calc_ellipticity_2, 'morphology/diskEllipticity', ROW_INDEX),
             'ellipticity_bulge_true':   'morphology/spheroidEllipticity',
-            'ellipticity_1_bulge_true': (_calc_ellipticity_1, 'morphology/spheroidEllipticity'),
-            'ellipticity_2_bulge_true': (_calc_ellipticity_2, 'morphology/spheroidEllipticity'),
+            'ellipticity_1_bulge_true': (_calc_ellipticity_1, 'morphology/spheroidEllipticity', ROW_INDEX),
+            'ellipticity_2_bulge_true': (_calc_ellipticity_2, 'morphology/spheroidEllipticity', ROW_INDEX),
             'size_true': (
                 _calc_weighted_size,
                 'morphology/diskMajorAxisArcsec',
@@ -206,7 +245,7 @@ class AlphaQGalaxyCatalog(BaseGenericCatalog):
                 'morphology/totalEllipticity',
             ),
             'bulge_to_total_ratio_i': (
-                lambda x, y: x/(x+y),
+                _calc_bulge_to_total_ratio,
                 'SDSS_filters/spheroidLuminositiesStellar:SDSS_i:observed',
                 'SDSS_filters/diskLuminositiesStellar:SDSS_i:observed',
             ),
@@ -290,7 +329,7 @@ class AlphaQGalaxyCatalog(BaseGenericCatalog):
         # make quantity modifiers work in older versions
         if catalog_version < StrictVersion('4.0'):
             self._quantity_modifiers.update({
-                'galaxy_id' :    (_gen_galaxy_id, 'galaxyID'),
+                'galaxy_id' :    (_gen_galaxy_id, 'galaxyID', ROW_INDEX),
             })
 
         if catalog_version < StrictVersion('3.0'):
@@ -308,7 +347,7 @@ class AlphaQGalaxyCatalog(BaseGenericCatalog):
 
         if catalog_version < StrictVersion('2.1.2'):
             self._quantity_modifiers.update({
-                'position_angle_true':     (lambda pos_angle: np.rad2deg(np.rad2deg(pos_angle)), 'morphology/positionAngle'), #I converted the units the wrong way, so a double conversion is required.
+                'position_angle_true':     (_double_rad2deg, 'morphology/positionAngle'), #I converted the units the wrong way, so a double conversion is required.
             })
 
         if catalog_version < StrictVersion('2.1.1'):
@@ -331,10 +370,10 @@ class AlphaQGalaxyCatalog(BaseGenericCatalog):
 
         if catalog_version == StrictVersion('2.0'): # to be backward compatible
             self._quantity_modifiers.update({
-                'ra':       (lambda x: x/3600, 'ra'),
-                'ra_true':  (lambda x: x/3600, 'ra_true'),
-                'dec':      (lambda x: x/3600, 'dec'),
-                'dec_true': (lambda x: x/3600, 'dec_true'),
+                'ra':       (_arcsec_to_deg, 'ra'),
+                'ra_true':  (_arcsec_to_deg, 'ra_true'),
+                'dec':      (_arcsec_to_deg, 'dec'),
+                'dec_true': (_arcsec_to_deg, 'dec_true'),
             })
 
 
@@ -345,10 +384,14 @@ class AlphaQGalaxyCatalog(BaseGenericCatalog):
     def _iter_native_dataset(self, native_filters=None):
         if native_filters is not None:
             raise ValueError('*native_filters* is not supported')
+        use_memmap = bool(self._init_kwargs.get('use_memmap', False))
         with h5py.File(self._file, 'r') as fh:
-            def _native_quantity_getter(native_quantity):
-                return fh['galaxyProperties/{}'.format(native_quantity)].value # pylint: disable=no-member
-            yield _native_quantity_getter
+            def _native_quantity_reader(native_quantity, rows=None, dtype=None):
+                return read_rows(fh['galaxyProperties/{}'.format(native_quantity)], rows,
+                                 use_memmap=use_memmap, dtype=dtype)
+            def _get_nrows():
+                return fh['galaxyProperties/{}'.format(first(q for q in self._native_quantities if q != ROW_INDEX))].shape[0]
+            yield NativeChunk(_native_quantity_reader, _get_nrows, max_row_runs=MAX_ROW_RUNS)
 
 
     def _get_native_quantity_info_dict(self, quantity, default=None):
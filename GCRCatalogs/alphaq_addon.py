@@ -4,11 +4,12 @@ Add-on catalogs for alpha q.
 import os
 from itertools import product
 import h5py
-from GCR import BaseGenericCatalog
+from .base import BaseCatalog, NativeChunk, read_rows, resolve_dtype, cast_values, MAX_ROW_RUNS
+from .utils import first
 
 __all__ = ['AlphaQTidalCatalog', 'AlphaQAddonCatalog']
 
-class AlphaQAddonCatalog(BaseGenericCatalog):
+class AlphaQAddonCatalog(BaseCatalog):
     """
     Addon to the AlphaQ catalog that can add extra quanities to the baseline
     catalog
@@ -37,12 +38,14 @@ class AlphaQAddonCatalog(BaseGenericCatalog):
         """
         assert not native_filters, '*native_filters* is not supported'
         with h5py.File(self._addon_filename, 'r') as fh_addon:
-            def native_quantity_getter(native_quantity):
-                return fh_addon['{}/{}'.format(self._addon_group,native_quantity)].value # pylint: disable=E1101
-            yield native_quantity_getter
+            def native_quantity_reader(native_quantity, rows=None, dtype=None):
+                return read_rows(fh_addon['{}/{}'.format(self._addon_group, native_quantity)], rows, dtype=dtype)
+            def get_nrows():
+                return fh_addon['{}/{}'.format(self._addon_group, first(self.list_all_native_quantities()))].shape[0]
+            yield NativeChunk(native_quantity_reader, get_nrows, max_row_runs=MAX_ROW_RUNS)
 
 
-class AlphaQTidalCatalog(BaseGenericCatalog):
+class AlphaQTidalCatalog(BaseCatalog):
     """
     Alpha Q tidal catalog class. Uses generic quantity and filter mechanisms
     defined by BaseGenericCatalog class.
@@ -73,11 +76,14 @@ class AlphaQTidalCatalog(BaseGenericCatalog):
     def _iter_native_dataset(self, native_filters=None):
         with h5py.File(self._filename, 'r') as fh:
             data = fh['tidal'].value # pylint: disable=E1101
-            def native_quantity_getter(native_quantity):
+            def native_quantity_reader(native_quantity, rows=None, dtype=None):
+                rows = slice(None) if rows is None else rows
                 if '/' not in native_quantity:
-                    return data[native_quantity]
-                items = native_quantity.split('/')
-                name = items[0]
-                cols = (slice(None),) + tuple((int(i) for i in items[1:]))
-                return data[name][cols]
-            yield native_quantity_getter
+                    values = data[native_quantity][rows]
+                else:
+                    items = native_quantity.split('/')
+                    name = items[0]
+                    cols = (rows,) + tuple((int(i) for i in items[1:]))
+                    values = data[name][cols]
+                return cast_values(values, resolve_dtype(dtype, values.dtype))
+            yield NativeChunk(native_quantity_reader, len(data))
@@ -0,0 +1,991 @@
+"""
+Common base class for GCRCatalogs readers, and the chunk helpers they share
+"""
+import os
+import functools
+import threading
+import weakref
+from collections import defaultdict
+from queue import Queue, Full
+import numpy as np
+from GCR import BaseGenericCatalog
+from GCR.utils import concatenate_1d
+from .buffers import readonly
+from .categorical import CategoricalArray, concatenate_categorical
+from .query import CompiledQuery, convert_string_comparisons
+from .reducers import bind_reducers, count
+from .snapshot import get_snapshot_path, get_mtimes, load_snapshot, save_snapshot
+from .utils import first
+
+__all__ = ['BaseCatalog', 'NativeChunk', 'ROW_INDEX', 'sample_rows', 'memmap_dataset', 'read_rows', 'prefetch_iter',
+           'get_policy_dtype', 'resolve_dtype', 'cast_values', 'apply_dtype_policy',
+           'constant_array', 'is_constant_array', 'rechunk']
+
+MAX_ROW_RUNS = 256
+
+# output quantities are only read for the selected rows when at most this fraction of rows pass the filters
+LATE_MATERIALIZATION_MAX_FRACTION = 0.25
+
+# native quantity served by NativeChunk: the index of each row in the full chunk (e.g., in the file).
+# Modifiers whose values depend on the row position (e.g., seeded random values) must use it
+# instead of the position in their input arrays, which changes with filters, `sample` and `chunk_rows`.
+ROW_INDEX = '_row_index'
+
+
+def constant_array(value, size, dtype=None):
+    """
+    Return a read-only array of `size` elements that all equal `value`.
+    The array is a zero-stride view of a single element, so it takes O(1) memory.
+    """
+    return np.broadcast_to(np.asarray(value, dtype=dtype), (int(size),))
+
+
+def is_constant_array(values):
+    """
+    check if `values` is a 1-d zero-stride array (as returned by `constant_array`)
+    """
+    return (
+        isinstance(values, np.ndarray) and not np.ma.isMaskedArray(values) and
+        values.ndim == 1 and values.strides == (0,) and values.size > 0
+    )
+
+
+def take_rows(values, rows):
+    """
+    Return `values[rows]` (`rows` being an integer array or a boolean mask);
+    constant arrays stay constant arrays.
+    """
+    if is_constant_array(values):
+        size = np.count_nonzero(rows) if rows.dtype == np.bool_ else len(rows)
+        if size <= values.size:
+            # slicing keeps the zero stride (and the type, e.g. for CategoricalArray)
+            return values[:size]
+        return constant_array(values[0], size, values.dtype)
+    return values[rows]
+
+
+def concatenate_chunks(arrays):
+    """
+    Same as GCR.utils.concatenate_1d, but keeps constant arrays
+    of the same value (e.g., the tract of a single-tract catalog) constant.
+    """
+    if len(arrays) > 1 and any(isinstance(a, CategoricalArray) for a in arrays):
+        return concatenate_categorical(arrays)
+    if len(arrays) > 1 and all(is_constant_array(a) for a in arrays):
+        value, dtype = arrays[0][0], arrays[0].dtype
+        if all(a.dtype == dtype and a[0] == value for a in arrays):
+            return constant_array(value, sum(a.size for a in arrays), dtype)
+    return concatenate_1d(arrays)
+
+
+def sample_rows(nrows, fraction, random_state, block_size=1):
+    """
+    Randomly select rows out of `nrows` rows.
+    Each row is selected with probability `fraction`; rows are selected in
+    contiguous blocks of `block_size` rows (block_size=1 selects rows independently).
+
+    Returns a sorted integer array of row indices.
+    """
+    if fraction >= 1:
+        return np.arange(nrows)
+    block_size = max(int(block_size or 1), 1)
+    nblocks = -(-nrows // block_size)
+    selected = np.flatnonzero(random_state.random_sample(nblocks) < fraction)
+    if block_size == 1:
+        return selected
+    rows = (selected[:, np.newaxis] * block_size + np.arange(block_size)).ravel()
+    return rows[rows < nrows]
+
+
+def get_row_runs(rows):
+    """
+    Return the (start, stop) pairs of the runs of consecutive indices in sorted `rows`
+    """
+    rows = np.asarray(rows)
+    if not rows.size:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = rows[np.concatenate(([0], breaks))]
+    stops = rows[np.concatenate((breaks - 1, [rows.size - 1]))] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def memmap_dataset(dataset):
+    """
+    Return a read-only array that maps the data of an h5py dataset directly
+    from its file (so that repeated reads share the OS page cache instead of
+    copying the data), or None if the dataset cannot be mapped: chunked
+    (hence possibly compressed or filtered), external or not yet allocated
+    storage, object dtypes, empty datasets, or files not opened from disk.
+    """
+    try:
+        if (dataset.chunks is not None or dataset.external or dataset.dtype.hasobject or
+                not dataset.size or dataset.file.driver != 'sec2'):
+            return None
+        offset = dataset.id.get_offset()
+        filename = dataset.file.filename
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if offset is None:
+        return None
+    data = np.memmap(filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+    return data.view(np.ndarray)
+
+
+DTYPE_POLICIES = ('float32', 'compact')
+
+
+def get_policy_dtype(native_dtype, policy=None, dtype=None, compact_dtype=None):
+    """
+    Return the dtype in which values of `native_dtype` are returned: `dtype` if set,
+    otherwise according to `policy`: None (keep the dtype), 'float32' (floats as float32),
+    or 'compact' (floats as float32, and integers as `compact_dtype`, which readers
+    or configs set per quantity; never guessed from the values).
+    Returns None if the dtype is kept.
+    """
+    if dtype is not None:
+        return np.dtype(dtype)
+    if policy is None:
+        return None
+    native_dtype = np.dtype(native_dtype)
+    if native_dtype.kind == 'f' and native_dtype.itemsize > 4:
+        return np.dtype(np.float32)
+    if policy == 'compact' and compact_dtype is not None and native_dtype.kind in 'iu':
+        return np.dtype(compact_dtype)
+    return None
+
+
+def resolve_dtype(dtype, native_dtype):
+    """
+    Return `dtype`, which is None, a dtype, or a function of the native dtype
+    (e.g., a partial of `get_policy_dtype`), for values of `native_dtype`
+    """
+    if callable(dtype) and not isinstance(dtype, type):
+        dtype = dtype(native_dtype)
+    return None if dtype is None else np.dtype(dtype)
+
+
+def cast_values(values, dtype):
+    """Return `values` as `dtype` (constant arrays stay constant arrays), or as they are if `dtype` is None"""
+    if dtype is None or values.dtype == dtype:
+        return values
+    if is_constant_array(values):
+        return constant_array(values[0], values.size, dtype)
+    return values.astype(dtype)
+
+
+def apply_dtype_policy(values, policy=None, dtype=None, compact_dtype=None):
+    """
+    Cast `values` (an array of one quantity) according to `get_policy_dtype`
+    """
+    if isinstance(values, CategoricalArray):
+        # codes already use the smallest integer type
+        return values
+    return cast_values(values, get_policy_dtype(values.dtype, policy, dtype, compact_dtype))
+
+
+def read_rows(dataset, rows=None, max_row_runs=MAX_ROW_RUNS, use_memmap=False, dtype=None):
+    """
+    Read `rows` (None for all rows, or a sorted integer array) of an h5py
+    dataset (or any array-like that supports slicing) using hyperslab reads.
+    Falls back to reading the full dataset when `rows` has too many runs.
+
+    If `use_memmap` is True, contiguous h5py datasets are memory-mapped
+    (see `memmap_dataset`): all rows are returned as a read-only view of
+    the file, and selected rows are copied from the mapping.
+
+    If `dtype` is set (see `resolve_dtype`), values are converted to it
+    while they are read (h5py converts each hyperslab as it reads it).
+    """
+    dtype = resolve_dtype(dtype, dataset.dtype)
+    if dtype == dataset.dtype:
+        dtype = None
+
+    if use_memmap:
+        data = memmap_dataset(dataset)
+        if data is not None:
+            if rows is not None:
+                return cast_values(data[np.asarray(rows, dtype=np.int64)], dtype)
+            return data if dtype is None else data.astype(dtype)
+
+    if dtype is not None:
+        if isinstance(dataset, np.ndarray):
+            return cast_values(read_rows(dataset, rows, max_row_runs), dtype)
+        dataset = dataset.astype(dtype)
+
+    if rows is None:
+        return dataset[()]
+
+    runs = get_row_runs(rows)
+    if not runs:
+        return dataset[0:0]
+
+    if len(runs) > max_row_runs:
+        return dataset[()][rows]
+
+    if len(runs) == 1:
+        return dataset[runs[0][0]:runs[0][1]]
+
+    return np.concatenate([dataset[start:stop] for start, stop in runs])
+
+
+class NativeChunk(object):
+    """
+    A native quantity getter for one chunk (a subset of rows) of a catalog.
+
+    Parameters
+    ----------
+    read_func : callable
+        `read_func(native_quantity, rows)` must return the rows of `native_quantity`
+        selected by `rows`, which is either None (all rows) or a sorted integer array.
+    nrows : int or callable
+        number of rows in this chunk (a callable is only evaluated when needed)
+    info : dict, optional
+        partition information of this chunk (e.g., {'healpix_pixel': 9556})
+    max_row_runs : int, optional
+        if set, samples with `block_size='auto'` are taken in blocks of rows such
+        that there are at most this many separate row ranges to read (useful for HDF5 files).
+    rows : None or array, optional
+        rows selected from this chunk
+    dtypes : dict, optional
+        dtypes (see `resolve_dtype`) of native quantities to convert while reading;
+        `read_func` is then called with a `dtype` keyword argument for these quantities.
+
+    The native quantity ROW_INDEX is the index of each selected row in the full chunk.
+    """
+    def __init__(self, read_func, nrows, info=None, max_row_runs=None, rows=None, dtypes=None):
+        self.read_func = read_func
+        self._nrows = nrows
+        self.info = dict(info or {})
+        self.max_row_runs = max_row_runs
+        self.rows = rows
+        self.dtypes = dict(dtypes or {})
+
+    def __call__(self, native_quantity):
+        if native_quantity == ROW_INDEX:
+            return self.row_index()
+        dtype = self.dtypes.get(native_quantity)
+        if dtype is None:
+            return self.read_func(native_quantity, self.rows)
+        return self.read_func(native_quantity, self.rows, dtype=dtype)
+
+    def row_index(self):
+        """return the indices of the selected rows in the full chunk"""
+        if self.rows is None:
+            return np.arange(self.nrows, dtype=np.int64)
+        return self.rows
+
+    @property
+    def nrows(self):
+        """number of rows of the full chunk (before any row selection)"""
+        if callable(self._nrows):
+            self._nrows = int(self._nrows())
+        return self._nrows
+
+    def __len__(self):
+        return self.nrows if self.rows is None else len(self.rows)
+
+    def take(self, rows):
+        """
+        return a new chunk that only has `rows` (sorted indices into this chunk)
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.rows is not None:
+            rows = self.rows[rows]
+        return NativeChunk(self.read_func, self._nrows, self.info, self.max_row_runs, rows, self.dtypes)
+
+    def astype(self, dtypes):
+        """
+        return a new chunk that converts native quantities to `dtypes` (see `resolve_dtype`) while reading
+        """
+        return NativeChunk(self.read_func, self._nrows, self.info, self.max_row_runs, self.rows,
+                           dict(self.dtypes, **dtypes))
+
+    def split(self, max_rows):
+        """
+        yield chunks of at most `max_rows` consecutive rows that together cover this chunk
+        """
+        nrows = len(self)
+        if nrows <= max_rows:
+            yield self
+            return
+        for start in range(0, nrows, max_rows):
+            yield self.take(np.arange(start, min(start + max_rows, nrows)))
+
+    def sample(self, fraction, random_state, block_size=None):
+        """
+        return a new chunk that only has a random subsample of rows;
+        see `sample_rows` for the meaning of the arguments.
+        If `block_size` is 'auto', it is set from `max_row_runs`.
+        """
+        nrows = len(self)
+        if block_size == 'auto':
+            block_size = 1
+            if self.max_row_runs:
+                block_size = int(np.ceil(nrows * fraction / self.max_row_runs))
+        return self.take(sample_rows(nrows, fraction, random_state, block_size))
+
+
+def _sample_native_quantity_getter(native_quantity_getter, fraction, random_state, block_size=None):
+    """
+    Make `native_quantity_getter` return a random subsample of rows.
+    Getters that support sampling (e.g., NativeChunk) do it themselves;
+    otherwise the full data is read and then subsampled.
+    """
+    if hasattr(native_quantity_getter, 'sample'):
+        return native_quantity_getter.sample(fraction, random_state, block_size)
+    if block_size == 'auto':
+        block_size = None
+
+    selected = []
+    def sampled_native_quantity_getter(native_quantity):
+        data = native_quantity_getter(native_quantity)
+        if not selected:
+            selected.append(sample_rows(len(data), fraction, random_state, block_size))
+        return data[selected[0]]
+    return sampled_native_quantity_getter
+
+
+def _get_data_len(data):
+    return len(next(iter(data.values()))) if data else 0
+
+
+def _concatenate_data(data_list):
+    if len(data_list) == 1:
+        return data_list[0]
+    return {q: concatenate_chunks([data[q] for data in data_list]) for q in data_list[0]}
+
+
+def rechunk(data_iter, chunk_rows=None, chunk_bytes=None):
+    """
+    Re-slice an iterator of data chunks (dicts of arrays) into chunks of
+    `chunk_rows` rows (or about `chunk_bytes` bytes) each, except for the last one.
+    Large chunks are split into views; small chunks are concatenated.
+    """
+    pending = []
+    npending = 0
+    empty = None
+    for data in data_iter:
+        n = _get_data_len(data)
+        if not n:
+            empty = data
+            continue
+        if chunk_rows is None:
+            row_bytes = sum(np.asarray(v).itemsize for v in data.values())
+            chunk_rows = max(int(chunk_bytes // max(row_bytes, 1)), 1)
+
+        start = 0
+        while start < n:
+            stop = min(start + chunk_rows - npending, n)
+            pending.append(data if (start == 0 and stop == n) else {q: v[start:stop] for q, v in data.items()})
+            npending += stop - start
+            start = stop
+            if npending == chunk_rows:
+                yield _concatenate_data(pending)
+                empty = None
+                pending = []
+                npending = 0
+        del data
+
+    if pending:
+        yield _concatenate_data(pending)
+    elif empty is not None:
+        # keep the dtypes of empty results
+        yield empty
+
+
+class _PrefetchDone(object):
+    """marks the end of the prefetch queue"""
+
+
+def prefetch_iter(func, iterable, prefetch=1):
+    """
+    Yield `func(item)` for each item in `iterable`, where both the iteration
+    over `iterable` and the calls to `func` happen on a background thread
+    that runs ahead by up to `prefetch` items (bounded by a queue).
+
+    Items are still yielded in order. Exceptions raised on the background
+    thread are re-raised here. When this generator is closed early, the
+    background thread stops after its current item and closes `iterable`.
+    """
+    queue = Queue(maxsize=max(int(prefetch), 1))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def worker():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((func(item), None)):
+                    break
+        except Exception as e: # pylint: disable=broad-except
+            put((None, e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            put((_PrefetchDone, None))
+
+    thread = threading.Thread(target=worker, name='GCRCatalogs-prefetch')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            result, error = queue.get()
+            if error is not None:
+                raise error
+            if result is _PrefetchDone:
+                break
+            yield result
+    finally:
+        stop.set()
+        thread.join()
+
+
+# catalogs whose resources are reopened in child processes after a fork (see BaseCatalog._reopen_resources)
+_live_catalogs = weakref.WeakSet()
+
+
+def _reopen_resources_after_fork():
+    for catalog in list(_live_catalogs):
+        catalog._reopen_resources() # pylint: disable=protected-access
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reopen_resources_after_fork)
+
+
+class BaseCatalog(BaseGenericCatalog):
+    """
+    Base class for GCRCatalogs readers.
+    Extends GCR.BaseGenericCatalog with additional reading options in `get_quantities`.
+
+    Readers can yield NativeChunk instances from `_iter_native_dataset` to
+    push these options down to their storage backend.
+
+    All readers accept a few more config options:
+    `dtype_policy` (None, 'float32' or 'compact'; see `get_policy_dtype`),
+    which sets the dtypes in which quantities are returned,
+    `dtype_overrides` (a dict of quantity: dtype), which takes precedence,
+    `compact_dtypes` (a dict of quantity: dtype), the integer dtypes used by the
+    'compact' policy (in addition to the ones the reader sets in `_compact_dtypes`), and
+    `chunk_rows` or `chunk_bytes`, the default chunk size of `get_quantities`.
+
+    Quantities that are plain aliases of native quantities read from NativeChunk
+    instances are converted while they are read (see `read_rows`), so that the
+    native dtype is not held in memory; other quantities are converted after
+    they are assembled.
+
+    Quantity modifiers get read-only views of the native quantities, which
+    may be shared by several quantities; modifiers must not modify their
+    inputs (see the buffers module for computing results in place).
+
+    Readers that list their state in `_snapshot_attributes` also accept
+    `use_snapshot` (default False): the state after a successful construction
+    is saved, and later constructions with the same config restore it (see
+    the snapshot module) and then only call `_init_from_snapshot`.
+
+    Catalogs can be pickled (e.g., to send them to multiprocessing workers):
+    only the config and metadata are pickled, not the attributes listed in
+    `_resource_attributes`, which `_reopen_resources` sets up again in the
+    new process. Child processes created by fork also call `_reopen_resources`,
+    so that they do not share open files or connections with the parent.
+    """
+
+    # attributes saved in catalog snapshots (in addition to `_native_quantities`)
+    _snapshot_attributes = ()
+
+    # attributes that hold open resources (connections, file handles, caches of open files);
+    # they are not pickled, and `_reopen_resources` sets them up again after unpickling or forking
+    _resource_attributes = ()
+
+    # integer dtypes of quantities under the 'compact' dtype policy
+    _compact_dtypes = {}
+
+    def __init__(self, **kwargs):
+        self._dtype_policy = kwargs.get('dtype_policy')
+        if self._dtype_policy is not None and self._dtype_policy not in DTYPE_POLICIES:
+            raise ValueError('`dtype_policy` must be None or one of {}'.format(', '.join(DTYPE_POLICIES)))
+        self._dtype_overrides = {q: np.dtype(dtype) for q, dtype in (kwargs.get('dtype_overrides') or {}).items()}
+        self._compact_dtypes = dict(self._compact_dtypes, **{
+            q: np.dtype(dtype) for q, dtype in (kwargs.get('compact_dtypes') or {}).items()
+        })
+        self._chunk_rows = kwargs.get('chunk_rows')
+        self._chunk_bytes = kwargs.get('chunk_bytes')
+
+        self._snapshot_path = self._snapshot_mtimes = None
+        if kwargs.get('use_snapshot') and self._snapshot_attributes:
+            self._snapshot_path = get_snapshot_path(type(self), kwargs)
+            self._snapshot_mtimes = get_mtimes(type(self), self._get_snapshot_paths(**kwargs))
+            state = load_snapshot(self._snapshot_path, self._snapshot_mtimes)
+            if state is not None:
+                self._init_kwargs = kwargs.copy()
+                self.__dict__.update(state)
+                self._init_from_snapshot(**kwargs)
+                _live_catalogs.add(self)
+                return
+
+        super(BaseCatalog, self).__init__(**kwargs)
+        self._save_snapshot()
+        _live_catalogs.add(self)
+
+    def _save_snapshot(self):
+        """save the attributes in `_snapshot_attributes` to the catalog snapshot (when `use_snapshot` is set)"""
+        if self._snapshot_path is None:
+            return
+        attributes = ('_native_quantities',) + tuple(self._snapshot_attributes)
+        save_snapshot(self._snapshot_path, self._snapshot_mtimes, {k: getattr(self, k) for k in attributes})
+
+    def _get_snapshot_paths(self, **kwargs): # pylint: disable=W0613,R0201
+        """
+        return the data directories (or files) of the catalog with config `kwargs`;
+        a snapshot is only used while their mtimes are unchanged
+        """
+        return []
+
+    def _init_from_snapshot(self, **kwargs): # pylint: disable=W0613
+        """
+        finish the construction after the attributes in `_snapshot_attributes` were restored
+        (set up quantity modifiers, file handles, ... that are not stored in the snapshot)
+        """
+        return
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in self._resource_attributes:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _live_catalogs.add(self)
+        self._reopen_resources()
+
+    def _reopen_resources(self):
+        """
+        set up the attributes in `_resource_attributes` again, in a new process
+        (after unpickling or forking); files and connections should be opened lazily
+        """
+        return
+
+    def get_quantities(self, quantities, filters=None, native_filters=None, return_iterator=False,
+                       sample=None, sample_seed=None, sample_block_size=None, prefetch=None,
+                       chunk_rows=None, chunk_bytes=None, partitions=None):
+        """
+        Fetch quantities from this catalog.
+
+        Parameters
+        ----------
+        quantities : str or list of str or tuple of str
+            quantities to fetch
+
+        filters : list of tuple, or GCRQuery instance, optional
+            filters to apply. Each filter should be in the format of (callable, str, str, ...)
+
+        native_filters : list of tuple, optional
+            Native filters to apply. Each filter should be in the format of (callable, str, str, ...)
+
+        return_iterator : bool, optional
+            if True, return an iterator that iterates over the native format, default is False
+
+        sample : float, optional
+            if set (0 < sample <= 1), only read a random subsample of rows;
+            each row is selected with probability `sample`
+
+        sample_seed : int, optional
+            random seed for `sample`
+
+        sample_block_size : int or 'auto', optional
+            if set, select rows in contiguous blocks of this size, which is cheaper
+            to read, but the rows in a block are not independent (rows are often
+            ordered by halo or position), so statistics have a larger variance.
+            With 'auto', readers pick a block size suited to their storage format.
+            By default rows are selected independently.
+
+        prefetch : int, optional
+            if set, read (and filter) up to this many upcoming chunks on a
+            background thread, so that reading overlaps with the processing
+            of the current chunk (most useful with `return_iterator=True`)
+
+        chunk_rows : int, optional
+            if set, iterate over chunks of this many rows (the last one may be smaller)
+            instead of the native chunks (files, tract/patches, ...) of each reader.
+            Large native chunks are also read in parts where the reader supports it.
+
+        chunk_bytes : int, optional
+            same as `chunk_rows`, but sets the size of a chunk in bytes (about)
+
+        partitions : list, optional
+            if set, only read these partitions (keys returned by `get_partitions`,
+            which must be called with the same `native_filters`)
+
+        Returns
+        -------
+        quantities : dict, or iterator of dict (when `return_iterator` is True)
+        """
+
+        quantities = self._preprocess_requested_quantities(quantities)
+        filters = self._preprocess_filters(filters)
+        native_filters = self._preprocess_native_filters(native_filters)
+
+        if sample is not None:
+            sample = float(sample)
+            if not 0 < sample <= 1:
+                raise ValueError('`sample` must be in (0, 1]')
+        if sample_block_size not in (None, 'auto'):
+            sample_block_size = int(sample_block_size)
+            if sample_block_size < 1:
+                raise ValueError("`sample_block_size` must be a positive integer or 'auto'")
+
+        if chunk_rows is None and chunk_bytes is None:
+            chunk_rows, chunk_bytes = self._chunk_rows, self._chunk_bytes
+        if chunk_rows is not None:
+            chunk_rows, chunk_bytes = int(chunk_rows), None
+            if chunk_rows < 1:
+                raise ValueError('`chunk_rows` must be a positive integer')
+        elif chunk_bytes is not None:
+            chunk_bytes = int(chunk_bytes)
+            if chunk_bytes < 1:
+                raise ValueError('`chunk_bytes` must be a positive integer')
+
+        it = self._get_quantities_iter(quantities, filters, native_filters,
+                                       sample=sample,
+                                       sample_seed=sample_seed,
+                                       sample_block_size=sample_block_size,
+                                       prefetch=prefetch,
+                                       chunk_rows=chunk_rows,
+                                       chunk_bytes=chunk_bytes,
+                                       partitions=partitions)
+
+        if return_iterator:
+            return it
+
+        data_all = defaultdict(list)
+        for data in it:
+            for q in quantities:
+                data_all[q].append(data[q])
+        return {q: concatenate_chunks(data_all[q]) for q in quantities}
+
+    def aggregate(self, quantities=None, filters=None, reducers=None, native_filters=None,
+                  return_reducers=False, **kwargs):
+        """
+        Compute aggregates (see GCRCatalogs.reducers) over this catalog,
+        reading one chunk at a time.
+
+        Parameters
+        ----------
+        quantities : str or list of str, optional
+            quantities to apply the reducers that do not specify a quantity to
+        filters : list of tuple, or GCRQuery instance, optional
+        reducers : list of reducers, optional
+            e.g., [hist(bins=..., range=...), mean(), count()]; default is [count()]
+        native_filters : list of tuple, optional
+        return_reducers : bool, optional
+            if True, return the reducers themselves (which can be merged with
+            reducers from other processes with `reducers.merge_results`)
+        Other keyword arguments are passed to `get_quantities`.
+
+        Returns
+        -------
+        results : dict
+            results keyed by reducer (e.g., 'hist(mag_r)', 'mean(mag_r)', 'count')
+        """
+        if quantities is not None and not isinstance(quantities, (list, tuple, set)):
+            quantities = [quantities]
+        reducers = bind_reducers(reducers or [count()], quantities)
+
+        quantities_needed = set(quantities or [])
+        for reducer in reducers:
+            quantities_needed.update(reducer.quantities)
+        if not quantities_needed:
+            # `count` still needs one quantity to know the length of each chunk
+            quantities_needed.add(first(self._preprocess_filters(filters).variable_names) or
+                                  first(sorted(self.list_all_quantities())))
+
+        for data in self.get_quantities(list(quantities_needed), filters, native_filters, return_iterator=True, **kwargs):
+            for reducer in reducers:
+                reducer.update(data)
+            del data
+
+        if return_reducers:
+            return reducers
+        return {reducer.key: reducer.result() for reducer in reducers}
+
+    def _assemble_quantity(self, quantity_requested, native_quantities_loaded):
+        modifier = self._quantity_modifiers.get(quantity_requested, self._default_quantity_modifier)
+
+        if callable(modifier):
+            return modifier(readonly(native_quantities_loaded[quantity_requested]))
+
+        if isinstance(modifier, (tuple, list)) and len(modifier) > 1 and callable(modifier[0]):
+            return modifier[0](*(readonly(native_quantities_loaded[q]) for q in modifier[1:]))
+
+        return super(BaseCatalog, self)._assemble_quantity(quantity_requested, native_quantities_loaded)
+
+    def _preprocess_filters(self, filters):
+        return super(BaseCatalog, self)._preprocess_filters(convert_string_comparisons(filters))
+
+    def _preprocess_native_filters(self, native_filters):
+        if not self.native_filter_string_only:
+            native_filters = convert_string_comparisons(native_filters)
+        return super(BaseCatalog, self)._preprocess_native_filters(native_filters)
+
+    def _get_native_partitions(self, native_filters=None): # pylint: disable=W0613,R0201
+        """
+        Return the keys of the partitions (e.g., files) that may pass `native_filters`,
+        in the order that `_iter_native_dataset` would go through them.
+        Returns None if this reader does not support iterating by partitions.
+        """
+        return None
+
+    def _iter_native_partitions(self, partitions):
+        """
+        Yield native quantity getters of `partitions` (keys returned by
+        `_get_native_partitions`), in the given order.
+        """
+        raise NotImplementedError
+
+    def _get_filtered_partitions(self, native_filters=None):
+        """
+        Same as `_get_native_partitions`, but readers may also return partitions in which
+        only some rows pass `native_filters`; `_iter_filtered_partitions` then applies
+        `native_filters` to their rows.
+        """
+        return self._get_native_partitions(native_filters)
+
+    def _iter_filtered_partitions(self, partitions, native_filters=None): # pylint: disable=W0613
+        """
+        Yield native quantity getters of the rows of `partitions` (keys returned by
+        `_get_filtered_partitions`) that pass `native_filters`, in the given order.
+        """
+        return self._iter_native_partitions(partitions)
+
+    def _get_native_partition_sky_bounds(self, partition): # pylint: disable=W0613,R0201
+        """
+        Return the sky bounding box (ra_min, ra_max, dec_min, dec_max), in degrees,
+        of a partition, or None if unknown.
+        """
+        return None
+
+    def _get_native_partition_info(self, partition): # pylint: disable=W0613,R0201
+        """
+        Return the partition information of a partition (a key returned by
+        `_get_native_partitions`), e.g., {'healpix_pixel': 9556}.
+        """
+        return {}
+
+    def _get_native_partition_size(self, partition): # pylint: disable=W0613,R0201
+        """
+        Return the size in bytes of a partition (a key returned by
+        `_get_native_partitions`), or None if unknown.
+        """
+        return None
+
+    def get_partition_size(self, key):
+        """
+        Return the size in bytes of a partition (a key returned by `get_partitions`),
+        or None if unknown.
+        """
+        kind, partition = key
+        if kind == 'partition':
+            return self._get_native_partition_size(partition)
+        return None
+
+    def get_partitions(self, native_filters=None):
+        """
+        Return the partitions of this catalog that may pass `native_filters`,
+        as a list of (key, info) tuples, where `info` is a dict of partition
+        information (e.g., healpix_pixel, redshift_block_lower, tract, patch).
+
+        Readers that support it list their native partitions (files, tract/patches)
+        without reading any data; otherwise each chunk of the native dataset is a
+        partition. Pass keys to `get_quantities` (with the same `native_filters`)
+        to only read these partitions.
+
+        Chunk partitions are found by going through the native dataset from its
+        first chunk, both here and when each one is read, so reading all of them
+        one at a time (e.g., with `to_dask_dataframe` or `map_partitions`) takes
+        time quadratic in the number of chunks, and readers whose chunk generator
+        reads data read all the earlier chunks again for each partition.
+        """
+        native_filters = self._preprocess_native_filters(native_filters)
+        keys = self._get_filtered_partitions(native_filters)
+        if keys is not None:
+            return [(('partition', key), self._get_native_partition_info(key)) for key in keys]
+        return [(('chunk', i), dict(getattr(getter, 'info', None) or {}))
+                for i, getter in enumerate(self._iter_native_dataset(native_filters))]
+
+    def _iter_native_dataset_of_partitions(self, partitions, native_filters=None):
+        """
+        Yield native quantity getters of `partitions` (keys returned by `get_partitions`)
+        """
+        chunk_indices = set()
+        for kind, key in partitions:
+            if kind == 'partition':
+                for getter in self._iter_filtered_partitions([key], native_filters):
+                    yield getter
+            elif kind == 'chunk':
+                chunk_indices.add(key)
+            else:
+                raise ValueError('Unknown partition key {!r}'.format((kind, key)))
+
+        if chunk_indices:
+            last = max(chunk_indices)
+            for i, getter in enumerate(self._iter_native_dataset(native_filters)):
+                if i in chunk_indices:
+                    yield getter
+                if i >= last:
+                    break
+
+    def _iter_native_dataset_with_filters(self, native_filters=None, filters=None): # pylint: disable=W0613
+        """
+        Same as `_iter_native_dataset`, but `filters` (which will still be applied
+        to each row afterwards) are also passed in, so that subclasses can use them
+        to skip chunks that cannot have any rows passing `filters`.
+        """
+        return self._iter_native_dataset(native_filters)
+
+    def _split_native_chunks(self, native_quantity_getters, native_quantities_needed, chunk_rows=None, chunk_bytes=None):
+        """
+        Split the getters that support it (NativeChunk) into getters of at most `chunk_rows` rows;
+        with `chunk_bytes`, the number of rows is found by reading one row of the first chunk.
+        """
+        for getter in native_quantity_getters:
+            if not hasattr(getter, 'split'):
+                yield getter
+                continue
+            if chunk_rows is None:
+                if not len(getter):
+                    yield getter
+                    continue
+                row = self._obtain_native_data_dict(native_quantities_needed, getter.take([0]))
+                row_bytes = sum(np.asarray(v).itemsize for v in row.values())
+                chunk_rows = max(int(chunk_bytes // max(row_bytes, 1)), 1)
+            for chunk in getter.split(chunk_rows):
+                yield chunk
+
+    def _get_native_dtypes(self, output_only_quantities, native_filter_quantities):
+        """
+        Return the dtypes (see `resolve_dtype`) to convert native quantities to while
+        reading: only for native quantities that are only needed as is by one of
+        `output_only_quantities`, so that no modifier or filter sees converted values.
+        """
+        if self._dtype_policy is None and not self._dtype_overrides:
+            return {}
+        native_dtypes = {}
+        for native_quantity, needed_by in self._translate_quantities(output_only_quantities).items():
+            if len(needed_by) != 1 or native_quantity in native_filter_quantities or native_quantity == ROW_INDEX:
+                continue
+            q = needed_by[0]
+            modifier = self._quantity_modifiers.get(q, self._default_quantity_modifier)
+            if modifier is None or not (callable(modifier) or isinstance(modifier, (tuple, list))):
+                native_dtypes[native_quantity] = functools.partial(
+                    get_policy_dtype, policy=self._dtype_policy,
+                    dtype=self._dtype_overrides.get(q), compact_dtype=self._compact_dtypes.get(q),
+                )
+        return native_dtypes
+
+    def _get_quantities_iter(self, quantities, filters, native_filters,
+                             sample=None, sample_seed=None, sample_block_size=None, prefetch=None,
+                             chunk_rows=None, chunk_bytes=None, partitions=None):
+        # pylint: disable=W0221
+        compiled_filters = CompiledQuery(filters)
+        filter_quantities = compiled_filters.variable_names
+        if not filter_quantities and not compiled_filters.is_empty and quantities:
+            # the filter has no variables; still need the length of each chunk
+            filter_quantities = {first(sorted(quantities))}
+        output_only_quantities = quantities.difference(filter_quantities)
+
+        native_quantities_needed = set(self._translate_quantities(quantities.union(filter_quantities)))
+        native_filter_quantities = set(self._translate_quantities(filter_quantities))
+        native_output_only_quantities = set(self._translate_quantities(output_only_quantities))
+        # native quantities only needed by the filters, to be dropped right after masking
+        native_filter_only = native_filter_quantities.difference(native_output_only_quantities)
+        native_output_remaining = native_output_only_quantities.difference(native_filter_quantities)
+        native_dtypes = self._get_native_dtypes(output_only_quantities, native_filter_quantities)
+
+        if partitions is not None:
+            native_quantity_getters = self._iter_native_dataset_of_partitions(partitions, native_filters)
+        else:
+            native_quantity_getters = self._iter_native_dataset_with_filters(native_filters, filters)
+        if sample is not None:
+            random_state = np.random.RandomState(sample_seed)
+            native_quantity_getters = (
+                _sample_native_quantity_getter(getter, sample, random_state, sample_block_size)
+                for getter in native_quantity_getters
+            )
+        if chunk_rows is not None or chunk_bytes is not None:
+            native_quantity_getters = self._split_native_chunks(
+                native_quantity_getters, native_quantities_needed, chunk_rows, chunk_bytes
+            )
+
+        def load_chunk(native_quantity_getter):
+            if native_dtypes and hasattr(native_quantity_getter, 'astype'):
+                native_quantity_getter = native_quantity_getter.astype(native_dtypes)
+
+            # two-phase read: if the getter can read a subset of rows (e.g., NativeChunk),
+            # read the filter quantities first, and then the other quantities only for selected rows
+            two_phase = (
+                native_output_remaining and
+                filter_quantities and
+                not compiled_filters.is_empty and
+                hasattr(native_quantity_getter, 'take')
+            )
+            if two_phase:
+                native_data = self._obtain_native_data_dict(native_filter_quantities, native_quantity_getter)
+            else:
+                native_data = self._obtain_native_data_dict(native_quantities_needed, native_quantity_getter)
+
+            # evaluate the filters first, so that output quantities are only gathered for selected rows
+            data = {q: self._assemble_quantity(q, native_data) for q in filter_quantities}
+            mask = compiled_filters.mask(data, len(next(iter(data.values())))) if data else None
+            if mask is not None and mask.all():
+                mask = None
+            for q in native_filter_only:
+                del native_data[q]
+            for q in filter_quantities.difference(quantities):
+                del data[q]
+            if mask is not None:
+                for q in data:
+                    data[q] = take_rows(data[q], mask)
+
+            if two_phase:
+                if mask is not None and np.count_nonzero(mask) <= LATE_MATERIALIZATION_MAX_FRACTION * mask.size:
+                    selected = np.flatnonzero(mask)
+                    for q in native_data:
+                        native_data[q] = take_rows(native_data[q], selected)
+                    native_quantity_getter = native_quantity_getter.take(selected)
+                    mask = None
+                native_data.update(self._obtain_native_data_dict(native_output_remaining, native_quantity_getter))
+
+            for q in output_only_quantities:
+                data[q] = self._assemble_quantity(q, native_data)
+                if mask is not None:
+                    data[q] = take_rows(data[q], mask)
+
+            if self._dtype_policy is not None or self._dtype_overrides:
+                for q in data:
+                    data[q] = apply_dtype_policy(data[q], self._dtype_policy, self._dtype_overrides.get(q),
+                                                 self._compact_dtypes.get(q))
+            return data
+
+        if prefetch:
+            data_iter = prefetch_iter(load_chunk, native_quantity_getters, prefetch)
+        else:
+            data_iter = (load_chunk(getter) for getter in native_quantity_getters)
+
+        if chunk_rows is not None or chunk_bytes is not None:
+            # also splits or merges the chunks of readers that cannot read parts of a chunk
+            data_iter = rechunk(data_iter, chunk_rows, chunk_bytes)
+
+        for data in data_iter:
+            yield data
+            del data
@@ -0,0 +1,70 @@
+"""
+Scratch buffers for quantity modifiers
+
+Modifiers run once per chunk, and each intermediate result of an expression
+like `((size1*lum1) + (size2*lum2)) / (lum1+lum2)` is a new chunk-sized array.
+Modifiers can instead allocate only their output, and compute intermediate
+results in place (`out=` and in-place ufuncs) in a scratch buffer:
+
+    out = np.multiply(size1, lum1)
+    with scratch(out.shape, out.dtype) as tmp:
+        np.multiply(size2, lum2, out=tmp)
+        out += tmp
+
+Scratch buffers are kept per thread and reused by later `scratch` blocks,
+so a scratch array must not be used (or returned) after its block exits.
+
+The inputs of modifiers are read-only (see BaseCatalog._assemble_quantity):
+the same native array is often shared by several quantities (e.g.,
+`magnification` by the magnitudes of all bands), so modifiers must write
+to their output or to a scratch buffer, never to their inputs.
+"""
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+__all__ = ['scratch', 'clear_scratch_buffers', 'readonly']
+
+# buffers larger than this are not kept for reuse
+MAX_POOLED_BYTES = 256 * 1024 * 1024
+
+_local = threading.local()
+
+
+def _get_pool():
+    pool = getattr(_local, 'pool', None)
+    if pool is None:
+        pool = _local.pool = dict()
+    return pool
+
+
+@contextmanager
+def scratch(shape, dtype=np.float64):
+    """
+    yield an uninitialized array of `shape` and `dtype` for intermediate results;
+    its memory is reused by later `scratch` blocks in the same thread
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    free = _get_pool().setdefault(dtype, [])
+    buf = free.pop() if free else None
+    if buf is None or buf.size < size:
+        buf = np.empty(size, dtype)
+    try:
+        yield buf[:size].reshape(shape)
+    finally:
+        if buf.nbytes <= MAX_POOLED_BYTES:
+            free.append(buf)
+
+
+def clear_scratch_buffers():
+    """free the scratch buffers of the calling thread"""
+    _get_pool().clear()
+
+
+def readonly(value):
+    """return a read-only view of `value` if it is a writeable array, otherwise `value` itself"""
+    if isinstance(value, np.ndarray) and value.flags.writeable:
+        value = value.view()
+        value.flags.writeable = False
+    return value
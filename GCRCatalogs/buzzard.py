@@ -5,10 +5,11 @@ from __future__ import division, print_function
 import os
 import re
 import functools
+import threading
 import numpy as np
 from astropy.io import fits
 from astropy.cosmology import FlatLambdaCDM
-from GCR import BaseGenericCatalog
+from .base import BaseCatalog, NativeChunk, constant_array, resolve_dtype, cast_values
 
 __all__ = ['BuzzardGalaxyCatalog']
 
@@ -17,6 +18,166 @@ def _ellip2pa(e1, e2):
     return np.remainder(np.rad2deg(np.arctan2(e2, e1)/2.0), 180.0)
 
 
+_SPEED_OF_LIGHT = 299792.458 # km/s
+
+
+def _calc_redshift(zt, x, y, z, vx, vy, vz):
+    return zt + (x*vx+y*vy+z*vz)/np.sqrt(x*x+y*y+z*z)/_SPEED_OF_LIGHT
+
+
+def _calc_redshift_true(zt, x, y, z, vx, vy, vz):
+    return zt - (x*vx+y*vy+z*vz)/np.sqrt(x*x+y*y+z*z)/_SPEED_OF_LIGHT
+
+
+def _mask_func(x):
+    return np.where(x==99.0, np.nan, x)
+
+
+def _abs_mask_func(x, h):
+    out = np.add(x, 5 * np.log10(h))
+    out[x == 99.0] = np.nan
+    return out
+
+
+def _divide(x, h):
+    return x/h
+
+
+def _to_bool(x):
+    return x.astype(np.bool)
+
+
+# quantity modifiers only depend on (high_res, h), so they are built once per process
+_QUANTITY_MODIFIERS_CACHE = dict()
+
+
+def _get_quantity_modifiers(high_res, h):
+    """return (a copy of) the quantity modifiers for the given resolution and Hubble parameter"""
+    key = (bool(high_res), float(h))
+    if key not in _QUANTITY_MODIFIERS_CACHE:
+        _QUANTITY_MODIFIERS_CACHE[key] = _generate_quantity_modifiers(*key)
+    return dict(_QUANTITY_MODIFIERS_CACHE[key])
+
+
+def _generate_quantity_modifiers(high_res, h):
+    abs_mask_func = functools.partial(_abs_mask_func, h=h)
+    divide_by_h = functools.partial(_divide, h=h)
+
+    if high_res:
+        quantity_modifiers = {
+            'redshift': 'truth/Z',
+            'ra_true': 'truth/RA',
+            'dec_true': 'truth/DEC',
+            'redshift_true' : (_calc_redshift_true,
+                               'truth/Z', 'truth/PX', 'truth/PY', 'truth/PZ', 'truth/VX', 'truth/VY', 'truth/VZ'),
+            'halo_id': 'truth/HALOID',
+            'halo_mass': (divide_by_h, 'truth/M200'),
+            'is_central': (_to_bool, 'truth/CENTRAL'),
+            'ellipticity_1_true': 'truth/TE/0',
+            'ellipticity_2_true': 'truth/TE/1',
+            'ellipticity_true': (np.hypot, 'truth/TE/0', 'truth/TE/1'),
+            'position_angle_true': (_ellip2pa, 'truth/TE/0', 'truth/TE/1'),
+            'size_true': 'truth/TSIZE',
+            'position_x': (divide_by_h, 'truth/PX'),
+            'position_y': (divide_by_h, 'truth/PY'),
+            'position_z': (divide_by_h, 'truth/PZ'),
+            'velocity_x': 'truth/VX',
+            'velocity_y': 'truth/VY',
+            'velocity_z': 'truth/VZ',
+        }
+
+        for i, b in enumerate('ugrizyY'):
+            if b == 'Y':
+                i -= 1
+            quantity_modifiers['Mag_true_{}_lsst_z0'.format(b)] = (abs_mask_func, 'lsst/AMAG/{}'.format(i))
+            quantity_modifiers['mag_{}_lsst'.format(b)] = (_mask_func, 'lsst/OMAG/{}'.format(i))
+            if b != 'Y':
+                quantity_modifiers['mag_{}'.format(b)] = quantity_modifiers['mag_{}_lsst'.format(b)]
+            if b != 'y' and b != 'Y':
+                quantity_modifiers['Mag_true_{}_sdss_z01'.format(b)] = (abs_mask_func, 'truth/AMAG/{}'.format(i))
+                quantity_modifiers['mag_true_{}_stripe82'.format(b)] = (_mask_func, 'stripe82/TMAG/{}'.format(i))
+                quantity_modifiers['mag_{}_stripe82'.format(b)] = (_mask_func, 'stripe82/OMAG/{}'.format(i))
+                quantity_modifiers['magerr_{}_stripe82'.format(b)] = (_mask_func, 'stripe82/OMAGERR/{}'.format(i))
+            if b != 'u':
+                i -= 1
+                quantity_modifiers['Mag_true_{}_des_z01'.format(b)] = (abs_mask_func, 'desy5/AMAG/{}'.format(i))
+                quantity_modifiers['mag_true_{}_des'.format(b)] = (_mask_func, 'desy5/TMAG/{}'.format(i))
+                quantity_modifiers['mag_{}_des'.format(b)] = (_mask_func, 'desy5/OMAG/{}'.format(i))
+                quantity_modifiers['magerr_{}_des'.format(b)] = (_mask_func, 'desy5/OMAGERR/{}'.format(i))
+
+        for i, b in enumerate('ZYJHK'):
+            quantity_modifiers['Mag_true_{}_vista_z01'.format(b)] = (abs_mask_func, 'vista/AMAG/{}'.format(i))
+            quantity_modifiers['mag_{}_vista'.format(b)] = (_mask_func, 'vista/OMAG/{}'.format(i))
+
+        for i, b in enumerate(['acsf435w', 'acsf606w', 'acsf775w', 'acsf814w', 'acsf850lp', 'wfc3f275w', 'wfc3f336w',
+                               'wfc3f336w', 'wfc3f125w', 'wfc3f160w']):
+
+            quantity_modifiers['Mag_true_{}_candels_z0'.format(b)] = (abs_mask_func, 'candels/AMAG/{}'.format(i))
+            quantity_modifiers['mag_{}_candels'.format(b)] = (_mask_func, 'candels/OMAG/{}'.format(i))
+
+        for i, b in enumerate(['W1', 'W2', 'W3', 'W4']):
+            quantity_modifiers['Mag_true_{}_wise_z0'.format(b)] = (abs_mask_func, 'wise/AMAG/{}'.format(i))
+            quantity_modifiers['mag_{}_wise'.format(b)] = (_mask_func, 'wise/OMAG/{}'.format(i))
+
+        for i, b in enumerate(['1234']):
+            quantity_modifiers['Mag_true_{}_irac_z0'.format(b)] = (abs_mask_func, 'irac/AMAG/{}'.format(i))
+            quantity_modifiers['mag_{}_irac'.format(b)] = (_mask_func, 'irac/OMAG/{}'.format(i))
+
+
+    else:
+        quantity_modifiers = {
+            'galaxy_id': 'truth/ID',
+            'redshift': (_calc_redshift,
+                         'truth/Z', 'truth/PX', 'truth/PY', 'truth/PZ', 'truth/VX', 'truth/VY', 'truth/VZ'),
+            'redshift_true': 'truth/Z',
+            'ra': 'truth/RA',
+            'dec': 'truth/DEC',
+            'ra_true': 'truth/TRA',
+            'dec_true': 'truth/TDEC',
+            'halo_id': 'truth/HALOID',
+            'halo_mass': (divide_by_h, 'truth/M200'),
+            'is_central': (_to_bool, 'truth/CENTRAL'),
+            'ellipticity_1': 'truth/EPSILON/0',
+            'ellipticity_2': 'truth/EPSILON/1',
+            'ellipticity': (np.hypot, 'truth/EPSILON/0', 'truth/EPSILON/1'),
+            'position_angle': (_ellip2pa, 'truth/EPSILON/0', 'truth/EPSILON/1'),
+            'ellipticity_1_true': 'truth/TE/0',
+            'ellipticity_2_true': 'truth/TE/1',
+            'ellipticity_true': (np.hypot, 'truth/TE/0', 'truth/TE/1'),
+            'position_angle_true': (_ellip2pa, 'truth/TE/0', 'truth/TE/1'),
+            'size': 'truth/SIZE',
+            'size_true': 'truth/TSIZE',
+            'shear_1': 'truth/GAMMA1',
+            'shear_2': (np.negative, 'truth/GAMMA2'),
+            'shear_2_treecorr': (np.negative, 'truth/GAMMA2'),
+            'shear_2_phosim':   'truth/GAMMA2',
+            'convergence': 'truth/KAPPA',
+            'magnification': 'truth/MU',
+            'position_x': (divide_by_h, 'truth/PX'),
+            'position_y': (divide_by_h, 'truth/PY'),
+            'position_z': (divide_by_h, 'truth/PZ'),
+            'velocity_x': 'truth/VX',
+            'velocity_y': 'truth/VY',
+            'velocity_z': 'truth/VZ',
+        }
+
+        for i, b in enumerate('ugrizyY'):
+            if b == 'Y':
+                i -= 1
+            quantity_modifiers['Mag_true_{}_lsst_z0'.format(b)] = (abs_mask_func, 'lsst/AMAG/{}'.format(i))
+            quantity_modifiers['mag_true_{}_lsst'.format(b)] = (_mask_func, 'lsst/TMAG/{}'.format(i))
+            if b != 'Y':
+                quantity_modifiers['mag_true_{}'.format(b)] = quantity_modifiers['mag_true_{}_lsst'.format(b)]
+            if b != 'u':
+                i -= 1
+                quantity_modifiers['Mag_true_{}_des_z01'.format(b)] = (abs_mask_func, 'truth/AMAG/{}'.format(i))
+                quantity_modifiers['mag_true_{}_des'.format(b)] = (_mask_func, 'truth/TMAG/{}'.format(i))
+                quantity_modifiers['mag_{}_des'.format(b)] = (_mask_func, 'truth/OMAG/{}'.format(i))
+                quantity_modifiers['magerr_{}_des'.format(b)] = (_mask_func, 'truth/OMAGERR/{}'.format(i))
+
+    return quantity_modifiers
+
+
 class FitsFile(object):
     def __init__(self, path):
         self._path = path
@@ -30,12 +191,26 @@ class FitsFile(object):
         del self._file_handle
 
 
-class BuzzardGalaxyCatalog(BaseGenericCatalog):
+class BuzzardGalaxyCatalog(BaseCatalog):
     """
     Buzzard galaxy catalog class. Uses generic quantity and filter mechanisms
     defined by BaseGenericCatalog class.
     """
 
+    _snapshot_attributes = (
+        '_catalog_path_template',
+        '_default_subset',
+        '_default_healpix_pixels',
+        '_native_filter_quantities',
+        'cosmology',
+        'halo_mass_def',
+        'lightcone',
+        'sky_area',
+        'version',
+    )
+
+    _resource_attributes = ('cache', '_cache_lock')
+
     def _subclass_init(self,
                        catalog_root_dir,
                        catalog_path_template,
@@ -60,6 +235,7 @@ class BuzzardGalaxyCatalog(BaseGenericCatalog):
         self._native_filter_quantities = {'healpix_pixel'}
 
         self.cache = dict() if use_cache else None
+        self._cache_lock = threading.Lock()
 
         cosmo_astropy_allowed = FlatLambdaCDM.__init__.__code__.co_varnames[1:]
         cosmo_astropy = {k: v for k, v in cosmology.items() if k in cosmo_astropy_allowed}
@@ -73,121 +249,23 @@ class BuzzardGalaxyCatalog(BaseGenericCatalog):
         self.sky_area  = float(sky_area or np.nan)
         self.version = kwargs.get('version', '0.0.0')
 
-        _c = 299792.458
-        _abs_mask_func = lambda x: np.where(x==99.0, np.nan, x + 5 * np.log10(self.cosmology.h))
-        _mask_func = lambda x: np.where(x==99.0, np.nan, x)
-
-        if high_res:
-            self._quantity_modifiers = {
-                'redshift': 'truth/Z',
-                'ra_true': 'truth/RA',
-                'dec_true': 'truth/DEC',
-                'redshift_true' : (lambda zt, x, y, z, vx, vy, vz: zt - (x*vx+y*vy+z*vz)/np.sqrt(x*x+y*y+z*z)/_c,
-                                   'truth/Z', 'truth/PX', 'truth/PY', 'truth/PZ', 'truth/VX', 'truth/VY', 'truth/VZ'),
-                'halo_id': 'truth/HALOID',
-                'halo_mass': (lambda x: x/self.cosmology.h, 'truth/M200'),
-                'is_central': (lambda x: x.astype(np.bool), 'truth/CENTRAL'),
-                'ellipticity_1_true': 'truth/TE/0',
-                'ellipticity_2_true': 'truth/TE/1',
-                'ellipticity_true': (np.hypot, 'truth/TE/0', 'truth/TE/1'),
-                'position_angle_true': (_ellip2pa, 'truth/TE/0', 'truth/TE/1'),
-                'size_true': 'truth/TSIZE',
-                'position_x': (lambda x: x/self.cosmology.h, 'truth/PX'),
-                'position_y': (lambda x: x/self.cosmology.h, 'truth/PY'),
-                'position_z': (lambda x: x/self.cosmology.h, 'truth/PZ'),
-                'velocity_x': 'truth/VX',
-                'velocity_y': 'truth/VY',
-                'velocity_z': 'truth/VZ',
-            }
-
-            for i, b in enumerate('ugrizyY'):
-                if b == 'Y':
-                    i -= 1
-                self._quantity_modifiers['Mag_true_{}_lsst_z0'.format(b)] = (_abs_mask_func, 'lsst/AMAG/{}'.format(i))
-                self._quantity_modifiers['mag_{}_lsst'.format(b)] = (_mask_func, 'lsst/OMAG/{}'.format(i))
-                if b != 'Y':
-                    self._quantity_modifiers['mag_{}'.format(b)] = self._quantity_modifiers['mag_{}_lsst'.format(b)]
-                if b != 'y' and b != 'Y':
-                    self._quantity_modifiers['Mag_true_{}_sdss_z01'.format(b)] = (_abs_mask_func, 'truth/AMAG/{}'.format(i))
-                    self._quantity_modifiers['mag_true_{}_stripe82'.format(b)] = (_mask_func, 'stripe82/TMAG/{}'.format(i))
-                    self._quantity_modifiers['mag_{}_stripe82'.format(b)] = (_mask_func, 'stripe82/OMAG/{}'.format(i))
-                    self._quantity_modifiers['magerr_{}_stripe82'.format(b)] = (_mask_func, 'stripe82/OMAGERR/{}'.format(i))
-                if b != 'u':
-                    i -= 1
-                    self._quantity_modifiers['Mag_true_{}_des_z01'.format(b)] = (_abs_mask_func, 'desy5/AMAG/{}'.format(i))
-                    self._quantity_modifiers['mag_true_{}_des'.format(b)] = (_mask_func, 'desy5/TMAG/{}'.format(i))
-                    self._quantity_modifiers['mag_{}_des'.format(b)] = (_mask_func, 'desy5/OMAG/{}'.format(i))
-                    self._quantity_modifiers['magerr_{}_des'.format(b)] = (_mask_func, 'desy5/OMAGERR/{}'.format(i))
-
-            for i, b in enumerate('ZYJHK'):
-                self._quantity_modifiers['Mag_true_{}_vista_z01'.format(b)] = (_abs_mask_func, 'vista/AMAG/{}'.format(i))
-                self._quantity_modifiers['mag_{}_vista'.format(b)] = (_mask_func, 'vista/OMAG/{}'.format(i))
-
-            for i, b in enumerate(['acsf435w', 'acsf606w', 'acsf775w', 'acsf814w', 'acsf850lp', 'wfc3f275w', 'wfc3f336w',
-                                   'wfc3f336w', 'wfc3f125w', 'wfc3f160w']):
-
-                self._quantity_modifiers['Mag_true_{}_candels_z0'.format(b)] = (_abs_mask_func, 'candels/AMAG/{}'.format(i))
-                self._quantity_modifiers['mag_{}_candels'.format(b)] = (_mask_func, 'candels/OMAG/{}'.format(i))
-
-            for i, b in enumerate(['W1', 'W2', 'W3', 'W4']):
-                self._quantity_modifiers['Mag_true_{}_wise_z0'.format(b)] = (_abs_mask_func, 'wise/AMAG/{}'.format(i))
-                self._quantity_modifiers['mag_{}_wise'.format(b)] = (_mask_func, 'wise/OMAG/{}'.format(i))
-
-            for i, b in enumerate(['1234']):
-                self._quantity_modifiers['Mag_true_{}_irac_z0'.format(b)] = (_abs_mask_func, 'irac/AMAG/{}'.format(i))
-                self._quantity_modifiers['mag_{}_irac'.format(b)] = (_mask_func, 'irac/OMAG/{}'.format(i))
-
-
-        else:
-            self._quantity_modifiers = {
-                'galaxy_id': 'truth/ID',
-                'redshift': (lambda zt, x, y, z, vx, vy, vz: zt + (x*vx+y*vy+z*vz)/np.sqrt(x*x+y*y+z*z)/_c,
-                             'truth/Z', 'truth/PX', 'truth/PY', 'truth/PZ', 'truth/VX', 'truth/VY', 'truth/VZ'),
-                'redshift_true': 'truth/Z',
-                'ra': 'truth/RA',
-                'dec': 'truth/DEC',
-                'ra_true': 'truth/TRA',
-                'dec_true': 'truth/TDEC',
-                'halo_id': 'truth/HALOID',
-                'halo_mass': (lambda x: x/self.cosmology.h, 'truth/M200'),
-                'is_central': (lambda x: x.astype(np.bool), 'truth/CENTRAL'),
-                'ellipticity_1': 'truth/EPSILON/0',
-                'ellipticity_2': 'truth/EPSILON/1',
-                'ellipticity': (np.hypot, 'truth/EPSILON/0', 'truth/EPSILON/1'),
-                'position_angle': (_ellip2pa, 'truth/EPSILON/0', 'truth/EPSILON/1'),
-                'ellipticity_1_true': 'truth/TE/0',
-                'ellipticity_2_true': 'truth/TE/1',
-                'ellipticity_true': (np.hypot, 'truth/TE/0', 'truth/TE/1'),
-                'position_angle_true': (_ellip2pa, 'truth/TE/0', 'truth/TE/1'),
-                'size': 'truth/SIZE',
-                'size_true': 'truth/TSIZE',
-                'shear_1': 'truth/GAMMA1',
-                'shear_2': (np.negative, 'truth/GAMMA2'),
-                'shear_2_treecorr': (np.negative, 'truth/GAMMA2'),
-                'shear_2_phosim':   'truth/GAMMA2',
-                'convergence': 'truth/KAPPA',
-                'magnification': 'truth/MU',
-                'position_x': (lambda x: x/self.cosmology.h, 'truth/PX'),
-                'position_y': (lambda x: x/self.cosmology.h, 'truth/PY'),
-                'position_z': (lambda x: x/self.cosmology.h, 'truth/PZ'),
-                'velocity_x': 'truth/VX',
-                'velocity_y': 'truth/VY',
-                'velocity_z': 'truth/VZ',
-            }
-
-            for i, b in enumerate('ugrizyY'):
-                if b == 'Y':
-                    i -= 1
-                self._quantity_modifiers['Mag_true_{}_lsst_z0'.format(b)] = (_abs_mask_func, 'lsst/AMAG/{}'.format(i))
-                self._quantity_modifiers['mag_true_{}_lsst'.format(b)] = (_mask_func, 'lsst/TMAG/{}'.format(i))
-                if b != 'Y':
-                    self._quantity_modifiers['mag_true_{}'.format(b)] = self._quantity_modifiers['mag_true_{}_lsst'.format(b)]
-                if b != 'u':
-                    i -= 1
-                    self._quantity_modifiers['Mag_true_{}_des_z01'.format(b)] = (_abs_mask_func, 'truth/AMAG/{}'.format(i))
-                    self._quantity_modifiers['mag_true_{}_des'.format(b)] = (_mask_func, 'truth/TMAG/{}'.format(i))
-                    self._quantity_modifiers['mag_{}_des'.format(b)] = (_mask_func, 'truth/OMAG/{}'.format(i))
-                    self._quantity_modifiers['magerr_{}_des'.format(b)] = (_mask_func, 'truth/OMAGERR/{}'.format(i))
+        self._quantity_modifiers = _get_quantity_modifiers(high_res, self.cosmology.h)
+
+
+    def _get_snapshot_paths(self, **kwargs):
+        paths = [os.path.join(kwargs['catalog_root_dir'], v) for v in kwargs['catalog_path_template'].values()]
+        return sorted(set(os.path.dirname(p) for p in paths))
+
+    def _init_from_snapshot(self, **kwargs):
+        self.healpix_pixels = None
+        self.reset_healpix_pixels()
+        self._reopen_resources()
+        self._quantity_modifiers = _get_quantity_modifiers(kwargs.get('high_res', False), self.cosmology.h)
+
+    def _reopen_resources(self):
+        # the FITS files are opened again (memory-mapped) when needed
+        self.cache = dict() if self._init_kwargs.get('use_cache', True) else None
+        self._cache_lock = threading.Lock()
 
 
     def _get_healpix_pixels(self):
@@ -228,10 +306,35 @@ class BuzzardGalaxyCatalog(BaseGenericCatalog):
         return native_quantities
 
 
+    def _get_native_partitions(self, native_filters=None):
+        return [healpix for healpix in self.healpix_pixels
+                if native_filters is None or native_filters.check_scalar({'healpix_pixel': healpix})]
+
+
+    def _get_native_partition_info(self, partition):
+        return {'healpix_pixel': partition}
+
+
+    def _get_native_partition_size(self, partition):
+        try:
+            return sum(os.path.getsize(path.format(partition)) for path in self._catalog_path_template.values())
+        except OSError:
+            return None
+
+
+    def _iter_native_partitions(self, partitions):
+        for healpix in partitions:
+            if healpix not in self.healpix_pixels:
+                raise ValueError('Healpix pixel {} is not used by this reader'.format(healpix))
+            yield NativeChunk(
+                functools.partial(self._native_quantity_getter, healpix=healpix),
+                functools.partial(self._get_nrows, healpix=healpix),
+                {'healpix_pixel': healpix},
+            )
+
+
     def _iter_native_dataset(self, native_filters=None):
-        for healpix in self.healpix_pixels:
-            if native_filters is None or native_filters.check_scalar({'healpix_pixel': healpix}):
-                yield functools.partial(self._native_quantity_getter, healpix=healpix)
+        return self._iter_native_partitions(self._get_native_partitions(native_filters))
 
 
     def _open_dataset(self, healpix, subset):
@@ -241,22 +344,33 @@ class BuzzardGalaxyCatalog(BaseGenericCatalog):
             return FitsFile(path)
 
         key = (healpix, subset)
-        if key not in self.cache:
-            self.cache[key] = FitsFile(path)
-        return self.cache[key]
+        with self._cache_lock:
+            if key not in self.cache:
+                self.cache[key] = FitsFile(path)
+            return self.cache[key]
+
+
+    def _get_nrows(self, healpix):
+        return len(self._open_dataset(healpix, self._default_subset).data)
 
 
-    def _native_quantity_getter(self, native_quantity, healpix):
+    def _native_quantity_getter(self, native_quantity, rows=None, healpix=None, dtype=None):
         if native_quantity == 'healpix_pixel':
-            data = np.empty(self._open_dataset(healpix, self._default_subset).data.shape, np.int)
-            data.fill(healpix)
-            return data
+            values = constant_array(healpix, self._get_nrows(healpix) if rows is None else len(rows), np.int64)
+            return cast_values(values, resolve_dtype(dtype, values.dtype))
 
         native_quantity = native_quantity.split('/')
         assert len(native_quantity) in {2,3}, 'something wrong with the native_quantity {}'.format(native_quantity)
         subset = native_quantity.pop(0)
         column = native_quantity.pop(0)
         data = self._open_dataset(healpix, subset).data[column]
+        if rows is not None:
+            # only the selected rows are read from the memory-mapped file
+            data = data[rows]
         if native_quantity:
             data = data[:,int(native_quantity.pop(0))]
+        dtype = resolve_dtype(dtype, data.dtype)
+        if dtype is not None:
+            # converts the byte order at the same time
+            return data.astype(dtype)
         return data.byteswap().newbyteorder()
@@ -0,0 +1,113 @@
+"""
+Dictionary-encoded (categorical) string columns
+
+Readers that support the `categorical_strings` option return string
+quantities as `CategoricalArray`: integer codes plus a small array of
+categories. Comparing with a string (`patch == '3,1'`, in callables or in
+string filters, see query.convert_string_comparisons) works on the codes;
+use `decode()` to get the strings back.
+"""
+import numpy as np
+from .utils import is_string_like
+
+__all__ = ['CategoricalArray', 'concatenate_categorical']
+
+
+def _get_code_dtype(ncategories):
+    for dtype in (np.int8, np.int16, np.int32):
+        if ncategories < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+class CategoricalArray(np.ndarray):
+    """
+    An array of integer codes into `categories` (-1 for missing values).
+
+    Create one with `CategoricalArray.encode(values)`, `CategoricalArray.constant(value, size)`
+    or `CategoricalArray.from_pandas(pd.Categorical)`. Slicing, indexing and masking
+    keep the categories.
+    """
+
+    def __new__(cls, codes, categories):
+        obj = np.asarray(codes).view(cls)
+        categories = np.asarray(categories)
+        obj.categories = categories.astype(str) if categories.dtype == object else categories
+        return obj
+
+    def __array_finalize__(self, obj):
+        # pylint: disable=attribute-defined-outside-init
+        self.categories = getattr(obj, 'categories', np.array([], dtype=str))
+
+    @classmethod
+    def encode(cls, values):
+        """encode an array of strings"""
+        categories, codes = np.unique(np.asarray(values), return_inverse=True)
+        return cls(codes.astype(_get_code_dtype(len(categories))), categories)
+
+    @classmethod
+    def constant(cls, value, size):
+        """a (zero-stride) array of `size` elements that all equal `value`"""
+        return cls(np.broadcast_to(np.zeros(1, dtype=np.int8), (int(size),)), [value])
+
+    @classmethod
+    def from_pandas(cls, values):
+        """convert a pandas Categorical (or Series of category dtype)"""
+        values = getattr(values, 'cat', values)
+        return cls(np.asarray(values.codes), np.asarray(values.categories))
+
+    @property
+    def codes(self):
+        """integer codes as a plain array"""
+        return self.view(np.ndarray)
+
+    def get_code(self, value):
+        """the code of `value`, or -1 if `value` is not a category"""
+        idx = np.flatnonzero(self.categories == value)
+        return int(idx[0]) if idx.size else -1
+
+    def decode(self, missing=''):
+        """return the values as a plain array of strings"""
+        categories = np.append(self.categories, np.asarray(missing, dtype=self.categories.dtype))
+        return categories[self.codes]
+
+    def isin(self, values):
+        """boolean mask of the elements that are in `values`"""
+        codes = [self.get_code(v) for v in values]
+        return np.isin(self.codes, [c for c in codes if c >= 0])
+
+    def __eq__(self, other):
+        if is_string_like(other):
+            code = self.get_code(other)
+            if code < 0:
+                # not a category; -1 is also the code of missing entries
+                return np.zeros(self.shape, dtype=np.bool_)
+            return self.codes == code
+        return self.codes == np.asarray(other)
+
+    def __ne__(self, other):
+        return np.logical_not(self.__eq__(other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'CategoricalArray({!r}, categories={!r})'.format(self.decode(), self.categories)
+
+
+def concatenate_categorical(arrays):
+    """
+    Concatenate CategoricalArrays (which may have different categories)
+    into one CategoricalArray with the union of all categories.
+    """
+    if all(a.size and a.strides == (0,) and a.codes[0] >= 0 for a in arrays):
+        values = set(a.categories[a.codes[0]] for a in arrays)
+        if len(values) == 1:
+            return CategoricalArray.constant(values.pop(), sum(a.size for a in arrays))
+
+    categories = np.unique(np.concatenate([a.categories for a in arrays]))
+    codes = []
+    for a in arrays:
+        mapping = np.append(np.searchsorted(categories, a.categories), -1)
+        codes.append(mapping[a.codes])
+    codes = np.concatenate(codes) if codes else np.array([], dtype=np.int8)
+    return CategoricalArray(codes.astype(_get_code_dtype(len(categories))), categories)
@@ -1,25 +1,517 @@
 """
 composite reader
 """
-from GCR import CompositeCatalog, MATCHING_FORMAT, MATCHING_ORDER
+import os
+import json
+import hashlib
+import warnings
+from collections import defaultdict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from GCR import CompositeCatalog, CompositeSpecs
 from .register import load_catalog, load_catalog_from_config_dict
+from .crossmatch import PartitionedSkyMatcher, MAX_CACHED_PARTITIONS
+from .utils import get_cache_dir
+
+__all__ = ['CompositeReader']
+
+JOIN_INDEX_FORMAT_VERSION = 1
+
+# which side of a column matching is read chunk by chunk (see ColumnMatchingSpecs)
+STREAM_SIDES = ('auto', 'main', 'matched')
+
+
+def _iter_config_paths(config):
+    """yield all string values in a (nested) config dict that are existing paths"""
+    if isinstance(config, dict):
+        for value in config.values():
+            for path in _iter_config_paths(value):
+                yield path
+    elif isinstance(config, (list, tuple)):
+        for value in config:
+            for path in _iter_config_paths(value):
+                yield path
+    elif isinstance(config, str) and os.path.exists(config):
+        yield os.path.abspath(config)
+
+
+def get_catalog_fingerprint(instance):
+    """
+    Return a hash of a catalog's config and of the modification times
+    of the files or directories that its config refers to
+    """
+    config = instance.get_catalog_info()
+    paths = sorted(set(_iter_config_paths(config)))
+    fingerprint = {
+        'config': config,
+        'files': [(path, os.stat(path).st_mtime) for path in paths],
+    }
+    return hashlib.md5(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _get_native_partitions(instance, native_filters=None):
+    """partitions of `instance` that may pass `native_filters`; None if not supported"""
+    if not hasattr(instance, '_get_native_partitions'):
+        return None
+    return instance._get_native_partitions(native_filters) # pylint: disable=protected-access
+
+
+def count_rows(instance):
+    """
+    Return the number of rows of `instance` from the lengths of its native
+    chunks (e.g., NativeChunk), or None if a chunk does not know its length
+    (counting would then read a full quantity)
+    """
+    nrows = 0
+    for getter in instance._iter_native_dataset(): # pylint: disable=protected-access
+        if not hasattr(getter, '__len__'):
+            return None
+        nrows += len(getter)
+    return nrows
+
+
+class ColumnCache(object):
+    """
+    Columns of a catalog, loaded on demand and kept until `clear` is called.
+    """
+    def __init__(self, instance):
+        self._instance = instance
+        self._data = dict()
+
+    def load(self, quantities):
+        """load all `quantities` that are not yet loaded in a single pass"""
+        missing = set(quantities).difference(self._data)
+        if missing:
+            self._data.update(self._instance.get_quantities(list(missing)))
+
+    def __getitem__(self, quantity):
+        self.load([quantity])
+        return self._data[quantity]
+
+    def __contains__(self, quantity):
+        return quantity in self._data
+
+    def clear(self):
+        """drop all loaded columns"""
+        self._data.clear()
+
+    def __getstate__(self):
+        # loaded columns are not pickled
+        return {'_instance': self._instance, '_data': dict()}
+
+
+class ColumnMatchingSpecs(CompositeSpecs):
+    """
+    CompositeSpecs for a catalog that is matched to the main catalog by a column.
+
+    Within a query, the main catalog is iterated chunk by chunk, and the other
+    side of the join is loaded once:
+
+    - if the main catalog is streamed, the columns needed from this catalog
+      are loaded in one pass, and each chunk of the main catalog is matched
+      with the sort order of the matching column (the join index). The join
+      index is computed once and saved on disk, keyed by the catalog config
+      and its files' modification times.
+    - if this catalog is streamed, the matching column of the main catalog
+      (for the rows in the query) is loaded instead, and this catalog is read
+      chunk by chunk to fill in the quantities of the matching main rows.
+
+    Either way, the loaded columns are dropped at the end of each query.
+
+    Parameters
+    ----------
+    use_join_index_cache : bool, optional (default: True)
+        whether to save and load the join index in the cache directory
+    stream : str, optional (default: 'auto')
+        side of the join to read chunk by chunk: 'main', 'matched' (this catalog),
+        or 'auto' (the one with more rows; the main catalog if either number of rows is unknown)
+    Other parameters are passed to CompositeSpecs.
+    """
+    def __init__(self, instance, identifier=None, use_join_index_cache=True, stream='auto', **kwargs):
+        if stream not in STREAM_SIDES:
+            raise ValueError('`stream` must be one of {}'.format(', '.join(STREAM_SIDES)))
+        self.column_cache = ColumnCache(instance)
+        self._sorter = None
+        self.use_join_index_cache = bool(use_join_index_cache)
+        self.stream = stream
+        self._stream_matched = None
+        self._native_filters = None
+        self._joined = None
+        super(ColumnMatchingSpecs, self).__init__(instance, identifier, **kwargs)
+
+    @property
+    def cache(self):
+        return self.column_cache
+
+    @cache.setter
+    def cache(self, value):
+        # columns are kept until the end of the query; see `clear_cache`
+        pass
+
+    def streams_matched(self, main_instance):
+        """whether this catalog (rather than the main catalog) is read chunk by chunk"""
+        if self._stream_matched is None:
+            if self.stream == 'auto':
+                nrows = count_rows(self.instance)
+                nrows_main = count_rows(main_instance) if nrows is not None else None
+                self._stream_matched = nrows_main is not None and nrows > nrows_main
+            else:
+                self._stream_matched = self.stream == 'matched'
+        return self._stream_matched
+
+    def start_query(self, native_filters=None):
+        """set the native filters (of the main catalog) of the query that starts"""
+        self._native_filters = native_filters
+        self._joined = None
+
+    def take_joined(self, main_instance, main_keys, quantities):
+        """
+        Return the `quantities` of this catalog for the next rows (`main_keys`,
+        the matching column) of the main catalog in this query, as a dict,
+        and the mask of main rows that have no match.
+        """
+        if self._joined is None:
+            keys = main_instance.get_quantities([self.matching_column_in_main],
+                                                native_filters=self._native_filters)[self.matching_column_in_main]
+            self._joined = {'keys': keys, 'sorter': np.argsort(keys, kind='mergesort'),
+                            'data': dict(), 'matched': np.zeros(len(keys), dtype=bool), 'counter': 0}
+        joined = self._joined
+
+        missing = set(quantities).difference(joined['data'])
+        if missing:
+            self._join_streamed(sorted(missing))
+
+        start = joined['counter']
+        stop = joined['counter'] = start + len(main_keys)
+        if not np.array_equal(joined['keys'][start:stop], main_keys):
+            raise ValueError('The main catalog was not iterated in the same order when matching catalog {}'.format(
+                self.identifier))
+        data = {q: joined['data'][q][start:stop] for q in quantities}
+        return data, ~joined['matched'][start:stop]
+
+    def _join_streamed(self, quantities):
+        """read this catalog chunk by chunk, and fill in `quantities` of the main rows of this query"""
+        joined = self._joined
+        keys_main = joined['keys']
+        sorter = joined['sorter']
+        sorted_keys_main = keys_main[sorter]
+        data = joined['data']
+        matched = np.zeros(len(keys_main), dtype=bool)
+
+        columns = list(set(quantities).union({self.matching_by_column}))
+        for chunk in self.instance.get_quantities(columns, return_iterator=True):
+            for q in quantities:
+                if q not in data:
+                    data[q] = np.zeros(len(keys_main), dtype=chunk[q].dtype)
+            keys = chunk[self.matching_by_column]
+            start = np.searchsorted(sorted_keys_main, keys, side='left')
+            counts = np.searchsorted(sorted_keys_main, keys, side='right') - start
+            total = counts.sum()
+            if not total:
+                continue
+            # all main rows that have the key of each row of this chunk
+            source = np.repeat(np.arange(len(keys)), counts)
+            target = sorter[np.arange(total) - np.repeat(np.cumsum(counts) - counts - start, counts)]
+            # as with the join index, a main row matches the first row with its key
+            target, first = np.unique(target, return_index=True)
+            source = source[first]
+            new = ~matched[target]
+            target = target[new]
+            source = source[new]
+            matched[target] = True
+            for q in quantities:
+                data[q][target] = chunk[q][source]
+
+        for q in quantities:
+            # this catalog has no rows
+            data.setdefault(q, np.zeros(len(keys_main)))
+        joined['matched'] = matched
+
+    @property
+    def sorter(self):
+        if self._sorter is None and self.matching_by_column:
+            self._sorter = self._load_or_build_join_index()
+        return self._sorter
+
+    @sorter.setter
+    def sorter(self, value):
+        if value is None or self._sorter is None:
+            self._sorter = value
+
+    def clear_cache(self):
+        """drop loaded columns and the in-memory join index"""
+        self.column_cache.clear()
+        self._sorter = None
+        self._joined = None
+
+    def _get_join_index_path(self):
+        if not self.use_join_index_cache:
+            return
+        cache_dir = get_cache_dir('composite')
+        if cache_dir is None:
+            return
+        key = '{}:{}:{}'.format(JOIN_INDEX_FORMAT_VERSION, get_catalog_fingerprint(self.instance), self.matching_by_column)
+        return os.path.join(cache_dir, 'join_index_{}.npy'.format(hashlib.md5(key.encode()).hexdigest()))
+
+    def _load_or_build_join_index(self):
+        keys = self.column_cache[self.matching_by_column]
+        path = self._get_join_index_path()
+
+        if path is not None and os.path.isfile(path):
+            try:
+                sorter = np.load(path)
+            except (IOError, OSError, ValueError):
+                pass
+            else:
+                if sorter.shape == keys.shape:
+                    return sorter
+
+        sorter = np.argsort(keys, kind='mergesort')
+
+        if path is not None:
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            try:
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, sorter)
+                os.rename(tmp_path, path)
+            except (IOError, OSError) as e:
+                warnings.warn('Cannot save join index to {}: {}'.format(path, e))
+
+        return sorter
+
+
+class PositionMatchingSpecs(CompositeSpecs):
+    """
+    CompositeSpecs for a catalog that is matched to the main catalog by sky position.
+    Each row of the main catalog is matched to the nearest object within `radius`.
+    Only the partitions of this catalog that overlap each chunk of the main
+    catalog are read (see crossmatch.PartitionedSkyMatcher).
+
+    Parameters
+    ----------
+    ra, dec : str, optional (default: 'ra', 'dec')
+        quantities in this catalog to match on (in degrees)
+    ra_in_main, dec_in_main : str, optional (default: 'ra', 'dec')
+        quantities in the main catalog to match on (in degrees)
+    radius : float, optional (default: 1)
+        matching radius in arcsec
+    max_cached_partitions : int, optional
+        number of partitions of this catalog to keep in memory
+    Other parameters are passed to CompositeSpecs.
+    """
+    def __init__(self, instance, identifier=None, ra='ra', dec='dec', ra_in_main='ra', dec_in_main='dec',
+                 radius=1.0, max_cached_partitions=MAX_CACHED_PARTITIONS, **kwargs):
+        kwargs['matching_partition'] = False
+        kwargs['matching_row_order'] = False
+        super(PositionMatchingSpecs, self).__init__(instance, identifier, **kwargs)
+        self.ra_in_main = ra_in_main
+        self.dec_in_main = dec_in_main
+        self.matcher = PartitionedSkyMatcher(instance, [], ra, dec, float(radius) / 3600.0, max_cached_partitions)
+
+    @property
+    def is_valid_matching(self):
+        return True
+
+    def clear_cache(self):
+        """drop the partitions kept in memory"""
+        self.matcher.clear_cache()
+
 
 class CompositeReader(CompositeCatalog):
     def __init__(self, **kwargs):
-        instances = []
-        identifiers = []
-        methods = []
-        for catalog_dict in kwargs['catalogs']:
+        catalogs = []
+        for i, catalog_dict in enumerate(kwargs['catalogs']):
             if 'subclass_name' in catalog_dict:
                 catalog = load_catalog_from_config_dict(catalog_dict)
             else:
                 catalog = load_catalog(catalog_dict['catalog_name'])
-            instances.append(catalog)
-            identifiers.append(catalog_dict.get('catalog_name'))
+            identifier = catalog_dict.get('catalog_name')
             method = catalog_dict.get('matching_method', 'MATCHING_FORMAT')
-            if method == 'MATCHING_FORMAT':
-                method = MATCHING_FORMAT
-            elif method == 'MATCHING_ORDER':
-                method = MATCHING_ORDER
-            methods.append(method)
-        super(CompositeReader, self).__init__(instances, identifiers, methods, **kwargs)
+            if i == 0 or method in ('MATCHING_FORMAT', 'MATCHING_ORDER'):
+                catalogs.append(CompositeSpecs(catalog, identifier, matching_method=method))
+            elif method == 'MATCHING_POSITION':
+                catalogs.append(PositionMatchingSpecs(
+                    catalog,
+                    identifier,
+                    ra=catalog_dict.get('matching_ra', 'ra'),
+                    dec=catalog_dict.get('matching_dec', 'dec'),
+                    ra_in_main=catalog_dict.get('matching_ra_in_main', 'ra'),
+                    dec_in_main=catalog_dict.get('matching_dec_in_main', 'dec'),
+                    radius=catalog_dict.get('matching_radius', 1.0),
+                    max_cached_partitions=catalog_dict.get('matching_max_cached_partitions', MAX_CACHED_PARTITIONS),
+                ))
+            else:
+                catalogs.append(ColumnMatchingSpecs(
+                    catalog,
+                    identifier,
+                    use_join_index_cache=kwargs.get('use_join_index_cache', True),
+                    stream=catalog_dict.get('matching_stream', 'auto'),
+                    matching_method=method,
+                ))
+        super(CompositeReader, self).__init__(catalogs, **kwargs)
+
+    def __getstate__(self):
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        # needed because CompositeCatalog.__getattr__ fails before `_catalogs` is set
+        self.__dict__.update(state)
+
+    def _get_format_matching_catalogs(self):
+        """non-main catalogs that have the same partitions and row order as the main catalog"""
+        return [cat for cat in self._catalogs[1:] if cat.matching_partition and cat.matching_row_order]
+
+    def _get_column_matching_catalogs(self):
+        return [cat for cat in self._catalogs if isinstance(cat, ColumnMatchingSpecs)]
+
+    def _iter_native_dataset(self, native_filters=None):
+        column_matching_catalogs = self._get_column_matching_catalogs()
+        for cat in column_matching_catalogs:
+            cat.start_query(native_filters)
+        try:
+            for native_quantity_getters in self._iter_paired_native_dataset(native_filters):
+                yield native_quantity_getters
+        finally:
+            # columns loaded for column matching are only kept during a query
+            for cat in column_matching_catalogs:
+                cat.clear_cache()
+
+    def _iter_paired_native_dataset(self, native_filters=None):
+        # Catalogs with matching formats are iterated partition by partition, using
+        # the partitions of the main catalog that pass `native_filters`, so that the
+        # paired files are opened together and the pruning is decided only once.
+        format_matching_catalogs = self._get_format_matching_catalogs()
+        partitions = _get_native_partitions(self._main.instance, native_filters)
+        if (partitions is None or not format_matching_catalogs or
+                any(_get_native_partitions(cat.instance) is None for cat in format_matching_catalogs)):
+            for native_quantity_getters in super(CompositeReader, self)._iter_native_dataset(native_filters):
+                yield native_quantity_getters
+            return
+
+        for cat in format_matching_catalogs:
+            missing = set(partitions).difference(_get_native_partitions(cat.instance))
+            if missing:
+                raise ValueError('Catalog {} does not have partitions {}'.format(cat.identifier, sorted(missing)))
+
+        iterators = []
+        for cat in self._catalogs:
+            if cat.is_main or cat in format_matching_catalogs:
+                cat.clear()
+                iterators.append(cat.instance._iter_native_partitions(partitions)) # pylint: disable=protected-access
+            else:
+                iterators.append(cat.get_data_iterator(native_filters))
+
+        identifiers = tuple((cat.identifier for cat in self._catalogs))
+        for getters in zip(*iterators):
+            getters = dict(zip(identifiers, getters))
+            main_getter = getters[self._main.identifier]
+            for cat in format_matching_catalogs:
+                getter = getters[cat.identifier]
+                if hasattr(main_getter, '__len__') and hasattr(getter, '__len__') and len(main_getter) != len(getter):
+                    raise ValueError('Catalog {} has {} rows in partition {}, but the main catalog has {}'.format(
+                        cat.identifier, len(getter), getattr(getter, 'info', ''), len(main_getter)))
+            yield getters
+
+    def _prefetch_format_matching_data(self, quantities_needed, native_quantity_getter):
+        """
+        read the native quantities of the main catalog and of catalogs with
+        matching formats in parallel; returns getters that serve the data read
+        """
+        catalogs = [cat for cat in self._catalogs
+                    if (cat.is_main or (cat.matching_partition and cat.matching_row_order)) and
+                    quantities_needed.get(cat.identifier)]
+        if len(catalogs) < 2:
+            return native_quantity_getter
+
+        def read(cat):
+            # pylint: disable=protected-access
+            native_quantities = cat.instance._translate_quantities(quantities_needed[cat.identifier])
+            return cat.instance._obtain_native_data_dict(native_quantities, native_quantity_getter[cat.identifier])
+
+        with ThreadPoolExecutor(max_workers=len(catalogs)) as executor:
+            native_data = dict(zip((cat.identifier for cat in catalogs), executor.map(read, catalogs)))
+
+        def prefetched_getter(native_quantity, data, getter):
+            if native_quantity in data:
+                return data[native_quantity]
+            return getter(native_quantity)
+
+        native_quantity_getter = dict(native_quantity_getter)
+        for identifier, data in native_data.items():
+            native_quantity_getter[identifier] = partial(
+                prefetched_getter, data=data, getter=native_quantity_getter[identifier])
+        return native_quantity_getter
+
+    def _obtain_native_data_dict(self, native_quantities_needed, native_quantity_getter):
+        quantities_needed = defaultdict(set)
+        for identifier, quantity in native_quantities_needed:
+            quantities_needed[identifier].add(quantity)
+
+        # load the columns needed from each column-matched catalog in a single pass,
+        # unless that catalog is streamed (then it is joined after the main catalog is loaded)
+        streamed_catalogs = []
+        for cat in self._get_column_matching_catalogs():
+            if cat.identifier not in quantities_needed:
+                continue
+            quantities_needed[self._main.identifier].add(cat.matching_column_in_main)
+            if cat.streams_matched(self._main.instance):
+                streamed_catalogs.append(cat)
+            else:
+                cat.column_cache.load(quantities_needed[cat.identifier].union({cat.matching_by_column}))
+        streamed_quantities = dict()
+        if streamed_catalogs:
+            skipped = set(cat.identifier for cat in streamed_catalogs)
+            native_quantities_needed = [key for key in native_quantities_needed if key[0] not in skipped]
+            for cat in streamed_catalogs:
+                streamed_quantities[cat.identifier] = sorted(quantities_needed.pop(cat.identifier))
+                native_quantities_needed.append((self._main.identifier, cat.matching_column_in_main))
+
+        # catalogs matched by position are handled here, after the main catalog is loaded
+        position_matching_catalogs = [cat for cat in self._catalogs
+                                      if isinstance(cat, PositionMatchingSpecs) and cat.identifier in quantities_needed]
+        position_matching_quantities = dict()
+        if position_matching_catalogs:
+            skipped = set(cat.identifier for cat in position_matching_catalogs)
+            native_quantities_needed = [key for key in native_quantities_needed if key[0] not in skipped]
+            for cat in position_matching_catalogs:
+                position_matching_quantities[cat.identifier] = sorted(quantities_needed.pop(cat.identifier))
+                for q in (cat.ra_in_main, cat.dec_in_main):
+                    quantities_needed[self._main.identifier].add(q)
+                    native_quantities_needed.append((self._main.identifier, q))
+
+        native_quantity_getter = self._prefetch_format_matching_data(quantities_needed, native_quantity_getter)
+
+        data = super(CompositeReader, self)._obtain_native_data_dict(native_quantities_needed, native_quantity_getter)
+
+        for cat in streamed_catalogs:
+            matched, not_matched_mask = cat.take_joined(
+                self._main.instance,
+                data[(self._main.identifier, cat.matching_column_in_main)],
+                streamed_quantities[cat.identifier],
+            )
+            for q, data_this in matched.items():
+                if self.always_return_masked_array or not_matched_mask.any():
+                    data_this = np.ma.array(data_this, mask=not_matched_mask)
+                data[(cat.identifier, q)] = data_this
+
+        for cat in position_matching_catalogs:
+            quantities = position_matching_quantities[cat.identifier]
+            matched = cat.matcher.match(
+                data[(self._main.identifier, cat.ra_in_main)],
+                data[(self._main.identifier, cat.dec_in_main)],
+                quantities,
+            )
+            for q in quantities:
+                data_this = matched[q]
+                if not self.always_return_masked_array and not np.ma.getmaskarray(data_this).any():
+                    data_this = data_this.data
+                data[(cat.identifier, q)] = data_this
+
+        return data
+
+    def clear_cache(self):
+        """Drop the columns and join indices kept in memory for column-matched catalogs"""
+        for cat in self._catalogs:
+            if isinstance(cat, ColumnMatchingSpecs):
+                cat.clear_cache()
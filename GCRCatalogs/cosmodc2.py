@@ -13,21 +13,36 @@ import numpy as np
 import h5py
 import healpy as hp
 from astropy.cosmology import FlatLambdaCDM
-from GCR import BaseGenericCatalog
-from .utils import md5, first
+from .base import BaseCatalog, NativeChunk, read_rows, MAX_ROW_RUNS, ROW_INDEX
+from .buffers import scratch
+from .utils import md5, first, seeded_uniform
 
 __all__ = ['CosmoDC2GalaxyCatalog', 'BaseDC2GalaxyCatalog', 'BaseDC2ShearCatalog', 'CosmoDC2AddonCatalog']
 __version__ = '1.0.0'
 
 CHECK_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog_configs/_cosmoDC2_check.yaml')
 
+# tables that do not depend on the data, built once per process
+_FILE_CHECK_INFO_CACHE = dict()
+_QUANTITY_MODIFIERS_CACHE = dict()
+
+_SED_RE = re.compile(r'^SEDs/([a-z]+)LuminositiesStellar:SED_(\d+)_(\d+):rest((?::dustAtlas)?)$')
+
 def _calc_weighted_size(size1, size2, lum1, lum2):
-    return ((size1*lum1) + (size2*lum2)) / (lum1+lum2)
+    # ((size1*lum1) + (size2*lum2)) / (lum1+lum2), with one output array
+    size = np.multiply(size1, lum1, dtype=np.result_type(size1, size2, lum1, lum2))
+    with scratch(size.shape, size.dtype) as tmp:
+        size += np.multiply(size2, lum2, out=tmp)
+        size /= np.add(lum1, lum2, out=tmp)
+    return size
 
 
 def _calc_weighted_size_minor(size1, size2, lum1, lum2, ell):
     size = _calc_weighted_size(size1, size2, lum1, lum2)
-    return size * (1.0 - ell) / (1.0 + ell)
+    with scratch(size.shape, size.dtype) as tmp:
+        size *= np.subtract(1.0, ell, out=tmp)
+        size /= np.add(1.0, ell, out=tmp)
+    return size
 
 
 def _calc_mag(conv, shear1, shear2):
@@ -55,35 +70,76 @@ def _calc_Av(lum_v, lum_v_dust):
         return Av
 
 
-def _gen_position_angle(size_reference):
-    # pylint: disable=protected-access
-    size = size_reference.size
-    if not hasattr(_gen_position_angle, "_pos_angle") or _gen_position_angle._pos_angle.size != size:
-        _gen_position_angle._pos_angle = np.random.RandomState(123497).uniform(0, 180, size)
-    return _gen_position_angle._pos_angle
+def _gen_position_angle(size_reference, row_index): # pylint: disable=W0613
+    # a fixed random angle for each row of a file, so that the angle of a galaxy
+    # does not depend on which other rows are read
+    if not row_index.size:
+        return np.empty(0)
+    return seeded_uniform(123497, 0, 180, int(row_index.max()) + 1)[row_index]
 
 
-def _calc_ellipticity_1(ellipticity):
-    # position angle using ellipticity as reference for the size or
-    # the array. The angle is converted from degrees to radians
-    pos_angle = _gen_position_angle(ellipticity)*np.pi/180.0
+def _calc_ellipticity_1(ellipticity, row_index):
+    # position angle of each row (see _gen_position_angle).
+    # The angle is converted from degrees to radians
+    pos_angle = _gen_position_angle(ellipticity, row_index)*np.pi/180.0
     # use the correct conversion for ellipticity 1 from ellipticity
     # and position angle
     return ellipticity*np.cos(2.0*pos_angle)
 
 
-def _calc_ellipticity_2(ellipticity):
-    # position angle using ellipticity as reference for the size or
-    # the array. The angle is converted from degrees to radians
-    pos_angle = _gen_position_angle(ellipticity)*np.pi/180.0
+def _calc_ellipticity_2(ellipticity, row_index):
+    # position angle of each row (see _gen_position_angle).
+    # The angle is converted from degrees to radians
+    pos_angle = _gen_position_angle(ellipticity, row_index)*np.pi/180.0
     # use the correct conversion for ellipticity 2 from ellipticity
     # and position angle
     return ellipticity*np.sin(2.0*pos_angle)
 
 
 def _calc_lensed_magnitude(magnitude, magnification):
-    magnification[magnification == 0] = 1.0
-    return magnitude -2.5*np.log10(magnification)
+    # magnitude - 2.5*log10(magnification), where a magnification of 0 counts as 1;
+    # `magnification` is shared by all bands, so it is not modified
+    dtype = np.result_type(magnitude, magnification)
+    out = np.empty(np.broadcast(magnitude, magnification).shape, dtype)
+    with scratch(out.shape, dtype) as tmp:
+        tmp.fill(0.0)
+        np.log10(magnification, out=tmp, where=(magnification != 0))
+        tmp *= -2.5
+        np.add(magnitude, tmp, out=out)
+    return out
+
+
+def _calc_magnification(magnification):
+    return np.where(magnification < 0.2, 1.0, magnification)
+
+
+def _calc_bulge_to_total_ratio(bulge, disk):
+    return bulge/(bulge+disk)
+
+
+def _to_bool(x):
+    return x.astype(np.bool)
+
+
+def _is_central_from_upid(upid):
+    return upid == -1
+
+
+def load_file_check_info(version, path=CHECK_FILE_PATH):
+    """
+    Return the file check info ({'size': {...}, 'md5': {...}}) of `version` in `path`.
+    The file is large, so it is only parsed again when it has been modified.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return dict()
+    cached = _FILE_CHECK_INFO_CACHE.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'r') as f:
+            cached = (mtime, yaml.load(f) or dict())
+        _FILE_CHECK_INFO_CACHE[path] = cached
+    return cached[1].get(version, dict())
 
 
 def _add_to_native_quantity_collector(name, obj, collector):
@@ -91,12 +147,36 @@ def _add_to_native_quantity_collector(name, obj, collector):
         collector.add(name)
 
 
-class CosmoDC2ParentClass(BaseGenericCatalog):
+def _read_group_rows(group, native_quantity, rows=None, use_memmap=False, dtype=None):
+    return read_rows(group[native_quantity], rows, use_memmap=use_memmap, dtype=dtype)
+
+
+def _get_group_nrows(group, native_quantity):
+    return group[native_quantity].shape[0]
+
+
+class CosmoDC2ParentClass(BaseCatalog):
     """
     CosmoDC2ParentClass: the parent class for
     CosmoDC2GalaxyCatalog, BaseDC2GalaxyCatalog, and BaseDC2ShearCatalog
+
+    Set `use_memmap: true` in the config to memory-map contiguous (unchunked,
+    hence uncompressed) datasets instead of reading (copying) them; quantities
+    may then be returned as read-only arrays (e.g., when one file is read without
+    filters), so copy them before modifying them in place.
     """
 
+    _snapshot_attributes = (
+        '_healpix_files',
+        'cosmology',
+        'version',
+        'lightcone',
+        '_sky_area',
+        '_quantity_info',
+        '_native_filter_quantities',
+        '_healpix_nside',
+    )
+
     def _subclass_init(self, catalog_root_dir, catalog_filename_template, **kwargs):
         # pylint: disable=W0221
         if not os.path.isdir(catalog_root_dir):
@@ -123,22 +203,34 @@ class CosmoDC2ParentClass(BaseGenericCatalog):
         if StrictVersion(__version__) < self.version:
             raise ValueError('Reader version {} is less than config version {} for'.format(__version__, self.version))
 
-        self.file_check_info = dict()
         if kwargs.get('check_md5', True) or kwargs.get('check_size', True):
-            try:
-                with open(CHECK_FILE_PATH, 'r') as f:
-                    self.file_check_info = yaml.load(f)
-            except (IOError, OSError):
-                pass
-            else:
-                self.file_check_info = self.file_check_info.get(self.version, dict())
             if not self.file_check_info:
                 warnings.warn('Cannot find valid infomation for file checks! Version {} not available in {}'.format(self.version, CHECK_FILE_PATH))
 
         self.lightcone = kwargs.get('lightcone', True)
         self.sky_area, self._native_quantities, self._quantity_info = self._process_metadata(**kwargs)
+        self._native_quantities.add(ROW_INDEX)
         self._quantity_modifiers = self._generate_quantity_modifiers()
         self._native_filter_quantities = {'healpix_pixel', 'redshift_block_lower'}
+        self._healpix_nside = int(kwargs.get('healpix_nside', 32))
+
+    def _get_snapshot_paths(self, **kwargs):
+        return [kwargs['catalog_root_dir'], CHECK_FILE_PATH]
+
+    _file_check_info = None
+
+    @property
+    def file_check_info(self):
+        """
+        sizes and md5 sums of the files of this version (see `load_file_check_info`);
+        loaded on first use, and not saved in snapshots, as the table is large
+        """
+        if self._file_check_info is None:
+            self._file_check_info = load_file_check_info(self.version)
+        return self._file_check_info
+
+    def _init_from_snapshot(self, **kwargs):
+        self._quantity_modifiers = self._generate_quantity_modifiers()
 
     def _get_group_names(self, fh): # pylint: disable=W0613
         return ['galaxyProperties']
@@ -232,9 +324,7 @@ class CosmoDC2ParentClass(BaseGenericCatalog):
         native_quantities = None
         quantity_info = None
 
-        max_healpixel = max(hpx_this for _, hpx_this in self._healpix_files)
-        min_valid_nside = hp.pixelfunc.get_min_valid_nside(max_healpixel)
-        default_sky_area = hp.nside2pixarea(min_valid_nside, degrees=True)
+        default_sky_area = self._get_default_sky_area(self._healpix_files)
 
         if check_size and 'size' not in self.file_check_info:
             check_size = False
@@ -244,7 +334,16 @@ class CosmoDC2ParentClass(BaseGenericCatalog):
             check_md5 = False
             warnings.warn('Not able to perform md5 check: no md5 sum specified in {}'.format(CHECK_FILE_PATH))
 
+        # without any per-file check, only the first file needs to be opened here,
+        # and the sky area is computed when first accessed (see `sky_area`)
+        scan_all_files = (check_version or check_md5 or check_size or check_cosmology or
+                          ensure_quantity_consistent)
+
         for (_, hpx_this), file_path in self._healpix_files.items():
+            if native_quantities is not None and not scan_all_files:
+                sky_area = None
+                break
+
             file_name = os.path.basename(file_path)
 
             if check_size and os.path.getsize(file_path) != self.file_check_info['size'].get(file_name):
@@ -261,10 +360,7 @@ class CosmoDC2ParentClass(BaseGenericCatalog):
                     self._check_cosmology(fh, file_name, cosmology_atol)
 
                 # get sky area
-                try:
-                    sky_area_this = float(fh['metaData/skyArea'].value) # pylint: disable=E1101
-                except KeyError:
-                    sky_area_this = default_sky_area
+                sky_area_this = self._get_file_sky_area(fh, default_sky_area)
                 if sky_area.get(hpx_this, 0) < sky_area_this:
                     sky_area[hpx_this] = sky_area_this
 
@@ -275,18 +371,99 @@ class CosmoDC2ParentClass(BaseGenericCatalog):
                       native_quantities != self._collect_native_quantities(fh)):
                     raise ValueError('native quantities are not consistent among different files')
 
-        sky_area = sum(sky_area.values())
+        if sky_area is not None:
+            sky_area = sum(sky_area.values())
         return sky_area, native_quantities, quantity_info
 
-    def _iter_native_dataset(self, native_filters=None):
-        for (zlo_this, hpx_this), file_path in self._healpix_files.items():
+    @staticmethod
+    def _get_default_sky_area(healpix_files):
+        max_healpixel = max(hpx_this for _, hpx_this in healpix_files)
+        min_valid_nside = hp.pixelfunc.get_min_valid_nside(max_healpixel)
+        return hp.nside2pixarea(min_valid_nside, degrees=True)
+
+    @staticmethod
+    def _get_file_sky_area(fh, default_sky_area):
+        try:
+            return float(fh['metaData/skyArea'][()]) # pylint: disable=E1101
+        except KeyError:
+            return default_sky_area
+
+    def _compute_sky_area(self):
+        sky_area = dict()
+        default_sky_area = self._get_default_sky_area(self._healpix_files)
+        for (_, hpx_this), file_path in self._healpix_files.items():
+            with h5py.File(file_path, 'r') as fh:
+                sky_area_this = self._get_file_sky_area(fh, default_sky_area)
+            if sky_area.get(hpx_this, 0) < sky_area_this:
+                sky_area[hpx_this] = sky_area_this
+        return sum(sky_area.values())
+
+    @property
+    def sky_area(self):
+        """total sky area (in sq. deg.) covered by this catalog"""
+        if self._sky_area is None:
+            self._sky_area = self._compute_sky_area()
+        return self._sky_area
+
+    @sky_area.setter
+    def sky_area(self, value):
+        self._sky_area = value
+
+    def _get_native_partitions(self, native_filters=None):
+        partitions = list()
+        for zlo_this, hpx_this in self._healpix_files:
             d = {'healpix_pixel': hpx_this, 'redshift_block_lower': zlo_this}
             if native_filters is not None and not native_filters.check_scalar(d):
                 continue
+            partitions.append((zlo_this, hpx_this))
+        return partitions
+
+    def _get_native_partition_sky_bounds(self, partition):
+        hpx_this = partition[1]
+        nside = self._healpix_nside
+        ra, dec = hp.vec2ang(hp.boundaries(nside, hpx_this, step=8).T, lonlat=True)
+        if ra.max() - ra.min() > 180.0:
+            ra = np.where(ra > 180.0, ra - 360.0, ra)
+        # healpix pixel edges are not great circles; pad the box a little
+        pad = np.rad2deg(hp.nside2resol(nside)) / 8.0
+        return ra.min() - pad, ra.max() + pad, max(dec.min() - pad, -90.0), min(dec.max() + pad, 90.0)
+
+    def _get_native_partition_info(self, partition):
+        zlo_this, hpx_this = partition
+        return {'healpix_pixel': hpx_this, 'redshift_block_lower': zlo_this}
+
+    def _get_native_partition_size(self, partition):
+        file_path = self._healpix_files.get(tuple(partition))
+        if file_path is None:
+            return None
+        sizes = self.file_check_info.get('size', {})
+        size = sizes.get(os.path.basename(file_path))
+        if size is None:
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                return None
+        return int(size)
+
+    def _iter_native_partitions(self, partitions):
+        use_memmap = bool(self._init_kwargs.get('use_memmap', False))
+        for zlo_this, hpx_this in partitions:
+            try:
+                file_path = self._healpix_files[(zlo_this, hpx_this)]
+            except KeyError:
+                raise ValueError('No file for redshift block {} and healpix pixel {}'.format(zlo_this, hpx_this))
+            d = {'healpix_pixel': hpx_this, 'redshift_block_lower': zlo_this}
             with h5py.File(file_path, 'r') as fh:
                 for group in self._get_group_names(fh):
-                    # pylint: disable=E1101,W0640
-                    yield lambda native_quantity: fh['{}/{}'.format(group, native_quantity)].value
+                    yield NativeChunk(
+                        partial(_read_group_rows, fh[group], use_memmap=use_memmap),
+                        partial(_get_group_nrows, fh[group], first(q for q in self._native_quantities if q != ROW_INDEX)),
+                        d,
+                        MAX_ROW_RUNS,
+                    )
+
+    def _iter_native_dataset(self, native_filters=None):
+        return self._iter_native_partitions(self._get_native_partitions(native_filters))
 
     def _get_quantity_info_dict(self, quantity, default=None):
         q_mod = self.get_quantity_modifier(quantity)
@@ -301,7 +478,9 @@ class CosmoDC2GalaxyCatalog(CosmoDC2ParentClass):
     CosmoDC2 galaxy catalog reader, inherited from CosmoDC2ParentClass
     """
 
-    def _generate_quantity_modifiers(self):
+    @staticmethod
+    def _generate_static_quantity_modifiers(version):
+        """quantity modifiers that only depend on the catalog version"""
         quantity_modifiers = {
             'galaxy_id' :    'galaxyID',
             'ra':            'ra',
@@ -315,10 +494,10 @@ class CosmoDC2GalaxyCatalog(CosmoDC2ParentClass):
             'shear_2_treecorr': (np.negative, 'shear2'),
             'shear_2_phosim':   'shear2',
             'convergence': 'convergence',
-            'magnification': (lambda mag: np.where(mag < 0.2, 1.0, mag), 'magnification'),
+            'magnification': (_calc_magnification, 'magnification'),
             'halo_id':       'uniqueHaloID',
             'halo_mass':     'hostHaloMass',
-            'is_central':    (lambda x: x.astype(np.bool), 'isCentral'),
+            'is_central':    (_to_bool, 'isCentral'),
             'stellar_mass':  'totalMassStellar',
             'stellar_mass_disk':        'diskMassStellar',
             'stellar_mass_bulge':       'spheroidMassStellar',
@@ -326,18 +505,18 @@ class CosmoDC2GalaxyCatalog(CosmoDC2ParentClass):
             'size_bulge_true':          'morphology/spheroidMajorAxisArcsec',
             'size_minor_disk_true':     'morphology/diskMinorAxisArcsec',
             'size_minor_bulge_true':    'morphology/spheroidMinorAxisArcsec',
-            'position_angle_true':      (_gen_position_angle, 'morphology/positionAngle'),
+            'position_angle_true':      (_gen_position_angle, 'morphology/positionAngle', ROW_INDEX),
             'sersic_disk':              'morphology/diskSersicIndex',
             'sersic_bulge':             'morphology/spheroidSersicIndex',
             'ellipticity_true':         'morphology/totalEllipticity',
-            'ellipticity_1_true':       (_calc_ellipticity_1, 'morphology/totalEllipticity'),
-            'ellipticity_2_true':       (_calc_ellipticity_2, 'morphology/totalEllipticity'),
+            'ellipticity_1_true':       (_calc_ellipticity_1, 'morphology/totalEllipticity', ROW_INDEX),
+            'ellipticity_2_true':       (_calc_ellipticity_2, 'morphology/totalEllipticity', ROW_INDEX),
             'ellipticity_disk_true':    'morphology/diskEllipticity',
-            'ellipticity_1_disk_true':  (_calc_ellipticity_1, 'morphology/diskEllipticity'),
-            'ellipticity_2_disk_true':  (_calc_ellipticity_2, 'morphology/diskEllipticity'),
+            'ellipticity_1_disk_true':  (_calc_ellipticity_1, 'morphology/diskEllipticity', ROW_INDEX),
+            'ellipticity_2_disk_true':  (_calc_ellipticity_2, 'morphology/diskEllipticity', ROW_INDEX),
             'ellipticity_bulge_true':   'morphology/spheroidEllipticity',
-            'ellipticity_1_bulge_true': (_calc_ellipticity_1, 'morphology/spheroidEllipticity'),
-            'ellipticity_2_bulge_true': (_calc_ellipticity_2, 'morphology/spheroidEllipticity'),
+            'ellipticity_1_bulge_true': (_calc_ellipticity_1, 'morphology/spheroidEllipticity', ROW_INDEX),
+            'ellipticity_2_bulge_true': (_calc_ellipticity_2, 'morphology/spheroidEllipticity', ROW_INDEX),
             'size_true': (
                 _calc_weighted_size,
                 'morphology/diskMajorAxisArcsec',
@@ -354,7 +533,7 @@ class CosmoDC2GalaxyCatalog(CosmoDC2ParentClass):
                 'morphology/totalEllipticity',
             ),
             'bulge_to_total_ratio_i': (
-                lambda x, y: x/(x+y),
+                _calc_bulge_to_total_ratio,
                 'SDSS_filters/spheroidLuminositiesStellar:SDSS_i:observed',
                 'SDSS_filters/diskLuminositiesStellar:SDSS_i:observed',
             ),
@@ -423,11 +602,28 @@ class CosmoDC2GalaxyCatalog(CosmoDC2ParentClass):
                 quantity_modifiers['mag_{}'.format(band)] = quantity_modifiers['mag_{}_lsst'.format(band)]
                 quantity_modifiers['mag_true_{}'.format(band)] = quantity_modifiers['mag_true_{}_lsst'.format(band)]
 
+        # make quantity modifiers work in older versions
+        version = StrictVersion(version)
+        if version < StrictVersion('0.4.6'):
+            quantity_modifiers['halo_id'] = 'UMachineNative/halo_id'
+
+        if version <= StrictVersion('0.2'):
+            quantity_modifiers['halo_id'] = 'hostHaloTag'
+
+        return quantity_modifiers
+
+    def _generate_quantity_modifiers(self):
+        key = (type(self), self.version)
+        if key not in _QUANTITY_MODIFIERS_CACHE:
+            _QUANTITY_MODIFIERS_CACHE[key] = self._generate_static_quantity_modifiers(self.version)
+        quantity_modifiers = dict(_QUANTITY_MODIFIERS_CACHE[key])
+
         # add SEDs
         translate_component_name = {'total': '', 'disk': '_disk', 'spheroid': '_bulge'}
-        sed_re = re.compile(r'^SEDs/([a-z]+)LuminositiesStellar:SED_(\d+)_(\d+):rest((?::dustAtlas)?)$')
         for quantity in self._native_quantities:
-            m = sed_re.match(quantity)
+            if not quantity.startswith('SEDs/'):
+                continue
+            m = _SED_RE.match(quantity)
             if m is None:
                 continue
             component, start, width, dust = m.groups()
@@ -439,14 +635,6 @@ class CosmoDC2GalaxyCatalog(CosmoDC2ParentClass):
             q.startswith('emissionLines/') or q.endswith('ContinuumLuminosity')
         )))
 
-        # make quantity modifiers work in older versions
-        version = StrictVersion(self.version)
-        if version < StrictVersion('0.4.6'):
-            quantity_modifiers['halo_id'] = 'UMachineNative/halo_id'
-
-        if version <= StrictVersion('0.2'):
-            quantity_modifiers['halo_id'] = 'hostHaloTag'
-
         return quantity_modifiers
 
 
@@ -473,7 +661,7 @@ class BaseDC2GalaxyCatalog(CosmoDC2ParentClass):
             'velocity_x': 'vx',
             'velocity_y': 'vy',
             'velocity_z': 'vz',
-            'is_central': (lambda x: x == -1, 'upid'),
+            'is_central': (_is_central_from_upid, 'upid'),
         }
 
         # add magnitudes
@@ -0,0 +1,225 @@
+"""
+Positional cross-matching between catalogs
+"""
+from collections import OrderedDict
+import numpy as np
+from .utils import sky_boxes_overlap
+
+__all__ = ['SkyMatcher', 'match_nearest', 'PartitionedSkyMatcher']
+
+MAX_CACHED_PARTITIONS = 8
+
+
+def radec_to_unit_vectors(ra, dec):
+    """
+    convert `ra` and `dec` (in degrees) to an (N, 3) array of unit vectors
+    """
+    ra = np.deg2rad(np.asarray(ra, dtype=np.float64))
+    dec = np.deg2rad(np.asarray(dec, dtype=np.float64))
+    cos_dec = np.cos(dec)
+    return np.stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)), axis=-1)
+
+
+def separation_to_chord(separation):
+    """convert angular separation (in degrees) to chord length between unit vectors"""
+    return 2.0 * np.sin(np.deg2rad(separation) * 0.5)
+
+
+def chord_to_separation(chord):
+    """convert chord length between unit vectors to angular separation (in degrees)"""
+    return np.rad2deg(2.0 * np.arcsin(np.minimum(chord * 0.5, 1.0)))
+
+
+def get_sky_bounds(ra, dec, margin=0.0):
+    """
+    Return the bounding box (ra_min, ra_max, dec_min, dec_max) of `ra`, `dec`
+    (in degrees), expanded by `margin` degrees (in ra, the margin is scaled by 1/cos(dec)).
+    """
+    ra = np.asarray(ra)
+    dec = np.asarray(dec)
+    if not ra.size:
+        return None
+    dec_min = max(float(np.nanmin(dec)) - margin, -90.0)
+    dec_max = min(float(np.nanmax(dec)) + margin, 90.0)
+    cos_dec = np.cos(np.deg2rad(max(abs(dec_min), abs(dec_max))))
+    ra_margin = 180.0 if cos_dec < 1e-8 else min(margin / cos_dec, 180.0)
+    return (float(np.nanmin(ra)) - ra_margin, float(np.nanmax(ra)) + ra_margin, dec_min, dec_max)
+
+
+def boxes_overlap(box1, box2):
+    """
+    whether two sky boxes (ra_min, ra_max, dec_min, dec_max) overlap,
+    allowing for ra wrapping; a box of None is assumed to overlap everything
+    """
+    if box1 is None or box2 is None:
+        return True
+    if np.isnan(box2).any():
+        # an empty partition
+        return False
+    return sky_boxes_overlap(box1, box2)
+
+
+class SkyMatcher(object):
+    """
+    Nearest-neighbour matcher on the sky, using a KD-tree of unit vectors.
+
+    Parameters
+    ----------
+    ra, dec : array_like
+        positions (in degrees) to match to
+    """
+    def __init__(self, ra, dec):
+        from scipy.spatial import cKDTree # pylint: disable=import-error
+        self.size = len(ra)
+        self._tree = cKDTree(radec_to_unit_vectors(ra, dec)) if self.size else None
+
+    def query(self, ra, dec, radius):
+        """
+        Find the nearest neighbour within `radius` (in degrees) for each (`ra`, `dec`).
+
+        Returns
+        -------
+        idx : array of int
+            index of the nearest neighbour, -1 if there is none within `radius`
+        separation : array of float
+            separation in degrees (inf if there is no match)
+        """
+        n = len(ra)
+        if self._tree is None or not n:
+            return np.full(n, -1, dtype=np.int64), np.full(n, np.inf)
+        chord, idx = self._tree.query(radec_to_unit_vectors(ra, dec), distance_upper_bound=separation_to_chord(radius))
+        not_matched = ~np.isfinite(chord)
+        idx = np.where(not_matched, -1, idx).astype(np.int64)
+        separation = np.where(not_matched, np.inf, chord_to_separation(np.where(not_matched, 0.0, chord)))
+        return idx, separation
+
+
+def match_nearest(ra1, dec1, ra2, dec2, radius):
+    """
+    For each position in (`ra1`, `dec1`), find the nearest position in (`ra2`, `dec2`)
+    within `radius`. All in degrees. See `SkyMatcher.query` for the returned values.
+    """
+    return SkyMatcher(ra2, dec2).query(ra1, dec1, radius)
+
+
+class PartitionedSkyMatcher(object):
+    """
+    Match positions to a catalog, reading only the partitions of that catalog
+    whose sky bounds overlap the positions being matched. Partitions are read one
+    at a time, and the most recently used ones are kept in memory.
+
+    Parameters
+    ----------
+    catalog : instance of a GCRCatalogs reader
+    quantities : list of str
+        quantities of `catalog` to return for the matched rows
+    ra, dec : str
+        quantities of `catalog` that hold the positions (in degrees)
+    radius : float
+        matching radius in degrees
+    max_cached_partitions : int, optional
+    """
+    def __init__(self, catalog, quantities, ra='ra', dec='dec', radius=1.0/3600.0,
+                 max_cached_partitions=MAX_CACHED_PARTITIONS):
+        self.catalog = catalog
+        self.quantities = list(quantities)
+        self.ra = ra
+        self.dec = dec
+        self.radius = float(radius)
+        self.max_cached_partitions = max(int(max_cached_partitions), 1)
+        self._cache = OrderedDict()
+
+    def clear_cache(self):
+        """drop all partitions kept in memory"""
+        self._cache.clear()
+
+    def __getstate__(self):
+        # partitions kept in memory are not pickled
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+
+    def _get_partitions(self):
+        # pylint: disable=protected-access
+        if not hasattr(self.catalog, '_get_native_partitions'):
+            return None
+        return self.catalog._get_native_partitions()
+
+    def _load(self, partition, quantities):
+        """load `quantities` of `partition` (None for the full catalog) and build its matcher"""
+        # pylint: disable=protected-access
+        key = partition
+        cached = self._cache.get(key)
+        if cached is not None and all(q in cached[0] for q in quantities):
+            self._cache.move_to_end(key)
+            return cached
+
+        if partition is None:
+            data = self.catalog.get_quantities(quantities)
+        else:
+            data = dict()
+            for getter in self.catalog._iter_native_partitions([partition]):
+                chunk = self.catalog._load_quantities(set(quantities), getter)
+                for q in quantities:
+                    data.setdefault(q, []).append(chunk[q])
+            data = {q: np.concatenate(v) if v else np.array([]) for q, v in data.items()}
+
+        cached = (data, SkyMatcher(data[self.ra], data[self.dec]))
+        self._cache[key] = cached
+        while len(self._cache) > self.max_cached_partitions:
+            self._cache.popitem(last=False)
+        return cached
+
+    def match(self, ra, dec, quantities=None):
+        """
+        Match positions (`ra`, `dec`) to the catalog.
+
+        Returns
+        -------
+        data : dict
+            matched values of `quantities` (masked arrays; masked where not matched)
+            and the separation (in degrees) under the key 'separation'
+        """
+        quantities = self.quantities if quantities is None else list(quantities)
+        quantities_to_load = list(set(quantities).union({self.ra, self.dec}))
+
+        n = len(ra)
+        best_separation = np.full(n, np.inf)
+        best = dict()
+
+        partitions = self._get_partitions()
+        if partitions is None:
+            partitions = [None]
+        else:
+            box = get_sky_bounds(ra, dec, self.radius)
+            partitions = [p for p in partitions
+                          if boxes_overlap(box, self.catalog._get_native_partition_sky_bounds(p))] # pylint: disable=protected-access
+
+        for partition in partitions:
+            data, matcher = self._load(partition, quantities_to_load)
+            idx, separation = matcher.query(ra, dec, self.radius)
+            better = separation < best_separation
+            if not better.any():
+                continue
+            best_separation[better] = separation[better]
+            for q in quantities:
+                values = data[q][idx[better]]
+                if q not in best:
+                    best[q] = np.zeros(n, dtype=values.dtype)
+                best[q][better] = values
+
+        not_matched = ~np.isfinite(best_separation)
+        result = dict()
+        for q in quantities:
+            values = best.get(q)
+            if values is None:
+                values = np.zeros(n, dtype=self._get_dtype(q))
+            result[q] = np.ma.array(values, mask=not_matched)
+        result['separation'] = np.ma.array(best_separation, mask=not_matched)
+        return result
+
+    def _get_dtype(self, quantity):
+        for data, _ in self._cache.values():
+            if quantity in data:
+                return data[quantity].dtype
+        return np.float64
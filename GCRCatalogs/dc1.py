@@ -9,24 +9,24 @@ from sqlalchemy.orm import scoped_session, sessionmaker
 import numpy as np
 from astropy.cosmology import FlatLambdaCDM
 
-from GCR import BaseGenericCatalog
+from .base import BaseCatalog
 
 
 __all__ = ['DC1GalaxyCatalog']
 
 
-class DC1GalaxyCatalog(BaseGenericCatalog):
+class DC1GalaxyCatalog(BaseCatalog):
     """
     DC1 galaxy catalog class.
     """
     
     native_filter_string_only = True
 
+    _resource_attributes = ('_Session',)
+
     def _subclass_init(self, **kwargs):
 
-        db_url = engine.url.URL('mssql+pymssql', **self._read_database_info_from_file(kwargs['db_info_fname']))
-        session_factory = sessionmaker(autoflush=True, bind=create_engine(db_url))
-        self._Session = scoped_session(session_factory)
+        self._Session = self._create_session(kwargs['db_info_fname'])
 
         self._quantity_modifiers = {
             'ra_true': 'ra',
@@ -50,6 +50,17 @@ class DC1GalaxyCatalog(BaseGenericCatalog):
         self.sky_area = float(kwargs.get('sky_area', np.nan))
 
 
+    def _reopen_resources(self):
+        # the engine only connects to the database when the session is first used
+        self._Session = self._create_session(self._init_kwargs['db_info_fname'])
+
+
+    def _create_session(self, db_info_fname):
+        db_url = engine.url.URL('mssql+pymssql', **self._read_database_info_from_file(db_info_fname))
+        session_factory = sessionmaker(autoflush=True, bind=create_engine(db_url))
+        return scoped_session(session_factory)
+
+
     @staticmethod
     def _read_database_info_from_file(db_info_fname):
         msg = ("The file {0} does not exist.\n"
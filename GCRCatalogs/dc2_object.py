@@ -4,12 +4,20 @@ DC2 Object Catalog Reader
 
 import os
 import re
+import json
+import hashlib
+import threading
 import warnings
+from collections import OrderedDict
+from functools import partial
 
 import numpy as np
 import pandas as pd
 import yaml
-from GCR import BaseGenericCatalog
+from .base import BaseCatalog, NativeChunk, get_row_runs, constant_array, resolve_dtype, cast_values, MAX_ROW_RUNS
+from .buffers import scratch
+from .categorical import CategoricalArray
+from .utils import get_cache_dir, is_string_like
 
 __all__ = ['DC2ObjectCatalog']
 
@@ -18,6 +26,34 @@ FILE_PATTERN = r'(?:merged|object)_tract_\d+\.hdf5$'
 GROUP_PATTERN = r'(?:coadd|object)_\d+_\d\d$'
 SCHEMA_PATH = 'schema.yaml'
 META_PATH = os.path.join(FILE_DIR, 'catalog_configs/_dc2_object_meta.yaml')
+MANIFEST_FORMAT_VERSION = 1
+MAX_OPEN_FILES = 16
+SKY_QUANTITIES = {'ra', 'dec'}
+_SKY_CONDITION_RE = re.compile(r'^\s*(ra|dec)\s*(<=|>=|<|>|==)\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*$')
+_SKY_CONDITION_REVERSED_RE = re.compile(r'^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(<=|>=|<|>|==)\s*(ra|dec)\s*$')
+_REVERSED_OPERATORS = {'<': '>', '<=': '>=', '>': '<', '>=': '<=', '==': '=='}
+
+# modifiers and quantity info only depend on the pixel scale and the bands,
+# so they are generated once per process (see DC2ObjectCatalog._set_quantity_modifiers)
+_QUANTITY_MODIFIERS_CACHE = dict()
+_QUANTITY_INFO_CACHE = dict()
+# parsed schema files, keyed by (path, mtime)
+_SCHEMA_CACHE = dict()
+
+# PyTables is not thread-safe: all access to open stores (opening and closing
+# files, reading storers) happens while holding this lock, so that a catalog
+# can be read from several threads at once (see TableWrapper)
+_HDF5_LOCK = threading.RLock()
+
+
+def _reset_hdf5_lock():
+    # a forked child must not inherit the lock in a state held by another thread
+    global _HDF5_LOCK # pylint: disable=global-statement
+    _HDF5_LOCK = threading.RLock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_hdf5_lock)
 
 
 def calc_cov(ixx_err, iyy_err, ixy_err):
@@ -65,50 +101,240 @@ def create_basic_flag_mask(*flags):
     return out
 
 
+def calc_cmodel_mag(flux):
+    """Convert cModel fluxes (with a zero point of 27) to magnitudes"""
+    mag = np.log10(flux)
+    mag *= -2.5
+    mag += 27.0
+    return mag
+
+
+def calc_cmodel_magerr(flux, err):
+    """Convert cModel flux errors to magnitude errors"""
+    magerr = np.multiply(err, 2.5, dtype=np.result_type(flux, err))
+    with scratch(magerr.shape, magerr.dtype) as tmp:
+        magerr /= np.multiply(flux, np.log(10), out=tmp)
+    return magerr
+
+
+def calc_psf_fwhm(xx, yy, xy, pixel_scale=0.2):
+    """Return the PSF FWHM (in arcsec) from its second moments (in pixels^2)"""
+    return pixel_scale * 2.355 * (xx * yy - xy * xy) ** 0.25
+
+
+def _open_hdf_store(file_path):
+    return pd.HDFStore(file_path, 'r')
+
+
+def get_storer_columns(storer):
+    """Return the set of column names of a 'fixed' or 'table' formatted storer"""
+    if storer.is_table:
+        return set(storer.non_index_axes[0][1])
+    return set(c.decode() for c in storer.group.axis0)
+
+
+def get_storer_nrows(storer):
+    """Return the number of rows of a 'fixed' or 'table' formatted storer"""
+    if storer.is_table:
+        return storer.nrows
+    return storer.group.axis1.nrows
+
+
+def _sky_condition_may_pass(condition, sky_bounds):
+    """Check if a string condition on ra/dec may be satisfied within sky_bounds
+
+    Returns None if `condition` is not a simple comparison like 'ra > 50.5'.
+    """
+    m = _SKY_CONDITION_RE.match(condition)
+    if m is not None:
+        quantity, operator, value = m.groups()
+    else:
+        m = _SKY_CONDITION_REVERSED_RE.match(condition)
+        if m is None:
+            return None
+        value, operator, quantity = m.groups()
+        operator = _REVERSED_OPERATORS[operator]
+
+    value = float(value)
+    ra_min, ra_max, dec_min, dec_max = sky_bounds
+    lower, upper = (ra_min, ra_max) if quantity == 'ra' else (dec_min, dec_max)
+    if operator in ('>', '>='):
+        return upper >= value
+    if operator in ('<', '<='):
+        return lower <= value
+    return lower <= value <= upper
+
+
+def query_may_pass(query, tract_and_patch, sky_bounds=None):
+    """Conservatively check if any row of a tract/patch may satisfy `query`
+
+    Parts of `query` that only involve tract and patch are evaluated exactly.
+    Simple comparisons on ra/dec (e.g. 'ra > 50.5') and SkyCone filters are
+    compared against `sky_bounds` (ra_min, ra_max, dec_min, dec_max) in degrees.
+    Anything else is assumed to possibly pass.
+
+    Args:
+        query (GCRQuery): The query to check
+        tract_and_patch (dict): {'tract': <tract>, 'patch': <patch>}
+        sky_bounds (tuple): The sky bounding box of the tract/patch, or None
+
+    Returns:
+        False if no row of this tract/patch can satisfy `query`, True otherwise
+    """
+    # pylint: disable=protected-access
+    variable_names = set(query.variable_names)
+    if variable_names.issubset(tract_and_patch):
+        return bool(query.check_scalar(tract_and_patch))
+
+    if query._operator == 'AND':
+        return all(query_may_pass(q, tract_and_patch, sky_bounds) for q in query._operands)
+
+    if query._operator == 'OR':
+        return any(query_may_pass(q, tract_and_patch, sky_bounds) for q in query._operands)
+
+    if query._operator is not None or sky_bounds is None or not variable_names.issubset(SKY_QUANTITIES):
+        return True
+
+    basic_query = query._operands
+    if is_string_like(basic_query):
+        result = _sky_condition_may_pass(basic_query, sky_bounds)
+        return True if result is None else result
+
+    if (isinstance(basic_query, tuple) and tuple(basic_query[1:]) == ('ra', 'dec') and
+            hasattr(basic_query[0], 'overlaps_box')):
+        return bool(basic_query[0].overlaps_box(*sky_bounds))
+
+    return True
+
+
+class HDFStorePool(object):
+    """A bounded pool of read-only pd.HDFStore file handles
+
+    At most `max_open_files` stores are kept open at any time.
+    When the pool is full, the least recently used store is closed first.
+
+    Args:
+        max_open_files (int): Maximal number of open stores (default: 16)
+    """
+
+    def __init__(self, max_open_files=MAX_OPEN_FILES):
+        self.max_open_files = max(int(max_open_files), 1)
+        self._handles = OrderedDict()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __contains__(self, file_path):
+        return file_path in self._handles
+
+    def open(self, file_path):
+        """Return an open pd.HDFStore for <file_path>, reusing a pooled one if possible"""
+        with _HDF5_LOCK:
+            fh = self._handles.pop(file_path, None)
+            if fh is None or not fh.is_open:
+                fh = pd.HDFStore(file_path, 'r')
+            self._handles[file_path] = fh
+
+            while len(self._handles) > self.max_open_files:
+                _, fh_old = self._handles.popitem(last=False)
+                fh_old.close()
+
+        return fh
+
+    def close_all(self):
+        """Close all pooled stores"""
+        with _HDF5_LOCK:
+            for fh in self._handles.values():
+                fh.close()
+            self._handles.clear()
+
+    def __getstate__(self):
+        # open stores are not pickled; they are reopened when needed
+        return {'max_open_files': self.max_open_files}
+
+    def __setstate__(self, state):
+        self.max_open_files = state['max_open_files']
+        self._handles = OrderedDict()
+
+
 class TableWrapper():
     """Wrapper class for pandas HDF5 storer
 
     Provides a unified API to access both fixed and table formats.
 
-    Takes a file_handle to the HDF5 file
+    Takes the path to the HDF5 file
     An HDF group key
     And a schema to specify dtypes and default values for missing columns.
-    """
 
-    def __init__(self, file_handle, key, schema=None):
-        if not file_handle.is_open:
-            raise ValueError('file handle has been closed!')
+    The file is only opened when data (or metadata not supplied by
+    `columns` and `nrows`) is actually requested. `file_opener` is called
+    with the file path and should return an open pd.HDFStore object.
+    If that store has been closed in the meantime (e.g., by a HDFStorePool),
+    the storer is obtained again from a newly opened store.
+
+    If `categorical_strings` is True, string columns filled from the schema
+    defaults are returned as (constant) CategoricalArrays.
 
-        self.storer = file_handle.get_storer(key)
-        self.is_table = self.storer.is_table
+    A TableWrapper can be read from several threads at once: storer access
+    is serialized by a module-level lock, and the rows read by `read` are
+    cached per thread, so that threads reading different chunks do not
+    evict (or see) each other's rows.
+    """
 
-        if not self.is_table and not self.storer.format_type == 'fixed':
-            raise ValueError('storer format type not supported!')
+    def __init__(self, file_path, key, schema=None, file_opener=None, columns=None, nrows=None,
+                 categorical_strings=False):
+        self.file_path = file_path
+        self.key = key
+        self._file_opener = file_opener or _open_hdf_store
+        self._storer = None
 
         self._schema = {} if schema is None else dict(schema)
-        self._columns = None
-        self._len = None
+        self._columns = None if columns is None else set(columns)
+        self._len = None if nrows is None else int(nrows)
+        self.categorical_strings = bool(categorical_strings)
         self._cache = None
-        self._constant_arrays = dict()
+        self._local = threading.local()
+
+    @property
+    def storer(self):
+        """The pandas storer of this table; opens the file if needed"""
+        with _HDF5_LOCK:
+            if self._storer is None or not self._storer.parent.is_open:
+                file_handle = self._file_opener(self.file_path)
+                if not file_handle.is_open:
+                    raise ValueError('file handle has been closed!')
+
+                storer = file_handle.get_storer(self.key)
+                if not storer.is_table and not storer.format_type == 'fixed':
+                    raise ValueError('storer format type not supported!')
+                self._storer = storer
+            return self._storer
+
+    @property
+    def is_table(self):
+        """Whether the underlying storer is in 'table' format"""
+        with _HDF5_LOCK:
+            return self.storer.is_table
 
     @property
     def columns(self):
         """Get columns from either 'fixed' or 'table' formatted HDF5 files."""
         if self._columns is None:
-            if self.is_table:
-                self._columns = set(self.storer.non_index_axes[0][1])
-            else:
-                self._columns = set(c.decode() for c in self.storer.group.axis0)
+            with _HDF5_LOCK:
+                self._columns = get_storer_columns(self.storer)
         return self._columns
 
     def __len__(self):
         if self._len is None:
-            if self.is_table:
-                self._len = self.storer.nrows
-            else:
-                self._len = self.storer.group.axis1.nrows
+            with _HDF5_LOCK:
+                self._len = get_storer_nrows(self.storer)
         return self._len
 
+    def _read_storer(self, **kwargs):
+        """Read the storer (with `kwargs` passed to `storer.read`) while holding the HDF5 lock"""
+        with _HDF5_LOCK:
+            return self.storer.read(**kwargs)
+
     def __contains__(self, item):
         return item in self.columns
 
@@ -117,69 +343,161 @@ class TableWrapper():
 
         Uses cached values, if available.
         """
-        if self._cache is None:
-            self._cache = self.storer.read()
+        cache = self._cache
+        if cache is None:
+            with _HDF5_LOCK:
+                if self._cache is None:
+                    self._cache = self.storer.read()
+                cache = self._cache
 
         try:
-            return self._cache[key].values
+            return cache[key].values
         except KeyError:
             return self._get_constant_array(key)
 
     get = __getitem__
 
-    def _get_constant_array(self, key):
+    def read(self, key, rows=None, dtype=None):
+        """Return the values of the column specified by 'key'
+
+        Only read `rows` (a sorted integer array) if set. The selected rows
+        are read for all columns at once with start/stop reads on the storer,
+        and kept (per thread) until a different `rows` object is requested.
+        If `dtype` is set (see `base.resolve_dtype`), the values are converted to it.
+        """
+        values = self._read(key, rows)
+        if dtype is None or isinstance(values, CategoricalArray):
+            return values
+        return cast_values(values, resolve_dtype(dtype, values.dtype))
+
+    def _read(self, key, rows=None):
+        if rows is None:
+            return self[key]
+
+        if key not in self.columns:
+            return self._get_constant_array(key, len(rows))
+
+        cache = self._cache
+        if cache is not None:
+            return cache[key].values[rows]
+
+        rows_cache = getattr(self._local, 'rows_cache', None)
+        if rows_cache is None or rows_cache[0] is not rows:
+            runs = get_row_runs(rows)
+            if len(runs) > MAX_ROW_RUNS:
+                df = self._read_storer().iloc[rows]
+            elif runs:
+                with _HDF5_LOCK:
+                    df = pd.concat([self.storer.read(start=start, stop=stop) for start, stop in runs])
+            else:
+                df = self._read_storer(start=0, stop=0)
+            rows_cache = self._local.rows_cache = (rows, df)
+
+        return rows_cache[1][key].values
+
+    def as_chunk(self, info=None):
+        """Return a NativeChunk that reads this table"""
+        return NativeChunk(self.read, self.__len__, info, MAX_ROW_RUNS)
+
+    def _get_constant_array(self, key, size=None):
         """
         Get a constant array for a column; `key` should be the column name.
         Find dtype and default value in `self._schema`.
         If not found, default to np.float64 and np.nan.
+        The array is a read-only, zero-stride view (see `base.constant_array`).
         """
         schema_this = self._schema.get(key, {})
-        return self._generate_constant_array(
-            dtype=schema_this.get('dtype', np.float64),
-            value=schema_this.get('default', np.nan),
-        )
+        value = schema_this.get('default', np.nan)
+        dtype = np.dtype(schema_this.get('dtype', np.float64))
+        size = len(self) if size is None else size
+        if self.categorical_strings and dtype.kind in 'SU':
+            return CategoricalArray.constant(value, size)
+        return constant_array(value, size, dtype)
 
-    def _generate_constant_array(self, dtype, value):
+    def clear_cache(self):
         """
-        Actually generate a constant array according to `dtype` and `value`
+        clear cached data (column names and row count are kept)
         """
-        dtype = np.dtype(dtype)
-        # here `key` is used to cache the constant array
-        # has nothing to do with column name
-        key = (dtype.str, value)
-        if key not in self._constant_arrays:
-            self._constant_arrays[key] = np.asarray(np.repeat(value, len(self)), dtype=dtype)
-            self._constant_arrays[key].setflags(write=False)
-        return self._constant_arrays[key]
+        with _HDF5_LOCK:
+            self._cache = self._storer = None
+        self._local = threading.local()
 
-    def clear_cache(self):
+    def reset_storer(self):
         """
-        clear cached data
+        forget the storer (and hence the open file), e.g., in a forked process;
+        the file is opened again when needed
         """
-        self._columns = self._len = self._cache = None
-        self._constant_arrays.clear()
+        self._storer = None
+
+    def __getstate__(self):
+        # the storer and the cached data are not pickled
+        state = self.__dict__.copy()
+        state['_storer'] = state['_cache'] = None
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
 
 
 class ObjectTableWrapper(TableWrapper):
     """Same as TableWrapper but add tract and patch info"""
 
-    def __init__(self, file_handle, key, schema=None):
-        key_items = key.split('_')
-        self.tract = int(key_items[1])
-        self.patch = ','.join(key_items[2])
-        super(ObjectTableWrapper, self).__init__(file_handle, key, schema)
+    def __init__(self, file_path, key, schema=None, sky_bounds=None, **kwargs):
+        self.tract, self.patch = self.parse_tract_patch(key)
+        self.sky_bounds = None if sky_bounds is None else tuple(sky_bounds)
+        super(ObjectTableWrapper, self).__init__(file_path, key, schema, **kwargs)
         # Add the schema info for tract, path
         # These values will be read by `get_constant_array`
         self._schema['tract'] = {'dtype': int, 'default': self.tract}
         self._schema['patch'] = {'dtype': str, 'default': self.patch}
 
+    @staticmethod
+    def parse_tract_patch(key):
+        """Return (tract, patch) from a group key like '/coadd_4850_31'"""
+        key_items = key.lstrip('/').split('_')
+        return int(key_items[1]), ','.join(key_items[2])
+
     @property
     def tract_and_patch(self):
         """Return a dict of the tract and patch info."""
         return {'tract': self.tract, 'patch': self.patch}
 
+    def compute_sky_bounds(self):
+        """Compute and set the sky bounding box from coord_ra and coord_dec
+
+        Returns:
+            (ra_min, ra_max, dec_min, dec_max) in degrees
+        """
+        if self._cache is not None:
+            coords = self._cache
+        elif self.is_table:
+            coords = self._read_storer(columns=['coord_ra', 'coord_dec'])
+        else:
+            coords = self._read_storer()
 
-class DC2ObjectCatalog(BaseGenericCatalog):
+        ra = np.rad2deg(coords['coord_ra'].values)
+        dec = np.rad2deg(coords['coord_dec'].values)
+        if len(ra):
+            self.sky_bounds = (float(np.nanmin(ra)), float(np.nanmax(ra)),
+                               float(np.nanmin(dec)), float(np.nanmax(dec)))
+        else:
+            self.sky_bounds = (np.nan,) * 4
+        return self.sky_bounds
+
+    def get_native_filter_table(self, quantities):
+        """Return a dict of arrays that native filters can be applied on"""
+        table = dict()
+        for q in quantities:
+            if q in SKY_QUANTITIES:
+                table[q] = np.rad2deg(self['coord_{}'.format(q)])
+            else:
+                table[q] = self[q]
+        return table
+
+
+class DC2ObjectCatalog(BaseCatalog):
     r"""DC2 Object Catalog reader
 
     Parameters
@@ -190,6 +508,16 @@ class DC2ObjectCatalog(BaseGenericCatalog):
     schema_path       (str): The optional location of the schema file
     pixel_scale     (float): scale to convert pixel to arcsec (default: 0.2)
     use_cache        (bool): Whether or not to cache read data in memory
+    max_open_files    (int): Maximal number of data files kept open at once (default: 16)
+    use_manifest     (bool): Whether or not to use a persisted dataset manifest (default: True)
+    manifest_path     (str): The optional location of the dataset manifest file
+    categorical_strings (bool): Whether to return `patch` as a CategoricalArray (default: False)
+
+    Native filters can be applied on `tract`, `patch`, `ra` and `dec`.
+    Tract/patches that cannot contain rows satisfying the ra/dec native filters
+    (simple comparisons like 'ra > 55.5' and `(SkyCone(...), 'ra', 'dec')` filters)
+    are skipped, based on per-patch sky bounding boxes stored in the manifest.
+    Conditions on ra/dec in `filters` are used in the same way to skip patches.
 
     Attributes
     ----------
@@ -199,7 +527,26 @@ class DC2ObjectCatalog(BaseGenericCatalog):
     """
     # pylint: disable=too-many-instance-attributes
 
-    _native_filter_quantities = {'tract', 'patch'}
+    _native_filter_quantities = {'tract', 'patch', 'ra', 'dec'}
+
+    # tract numbers of the skymap fit in int32
+    _compact_dtypes = {'tract': np.int32}
+
+    _snapshot_attributes = (
+        'base_dir',
+        '_filename_re',
+        '_groupname_re',
+        '_schema_path',
+        'pixel_scale',
+        'use_cache',
+        'categorical_strings',
+        '_manifest_path',
+        '_schema',
+        '_manifest_files',
+        '_columns',
+    )
+
+    _resource_attributes = ('_file_handles',)
 
     def _subclass_init(self, **kwargs):
         self.base_dir = kwargs['base_dir']
@@ -208,15 +555,20 @@ class DC2ObjectCatalog(BaseGenericCatalog):
         self._schema_path = kwargs.get('schema_path', os.path.join(self.base_dir, SCHEMA_PATH))
         self.pixel_scale = float(kwargs.get('pixel_scale', 0.2))
         self.use_cache = bool(kwargs.get('use_cache', True))
+        self.categorical_strings = bool(kwargs.get('categorical_strings', False))
 
         if not os.path.isdir(self.base_dir):
             raise ValueError('`base_dir` {} is not a valid directory'.format(self.base_dir))
 
+        self._manifest_path = None
+        if kwargs.get('use_manifest', True):
+            self._manifest_path = kwargs.get('manifest_path') or self._get_default_manifest_path()
+
         self._schema = None
         if self._schema_path and os.path.exists(self._schema_path):
             self._schema = self._generate_schema_from_yaml(self._schema_path)
 
-        self._file_handles = dict()
+        self._file_handles = HDFStorePool(kwargs.get('max_open_files', MAX_OPEN_FILES))
         self._datasets = self._generate_datasets()
         if not self._datasets:
             err_msg = 'No catalogs were found in `base_dir` {}'
@@ -225,15 +577,42 @@ class DC2ObjectCatalog(BaseGenericCatalog):
         if self._schema:
             self._columns = set(self._schema)
         else:
-            warnings.warn('Falling back to reading all datafiles for column names')
+            if not self._manifest_path:
+                warnings.warn('Falling back to reading all datafiles for column names')
             self._columns = self._generate_columns(self._datasets)
 
-        bands = [col[0] for col in self._columns if len(col) == 5 and col.endswith('_mag')]
-        self._quantity_modifiers = self._generate_modifiers(self.pixel_scale, bands)
-        self._quantity_info_dict = self._generate_info_dict(META_PATH, bands)
+        self._set_quantity_modifiers()
+
+    def _get_snapshot_paths(self, **kwargs):
+        base_dir = kwargs['base_dir']
+        schema_path = kwargs.get('schema_path', os.path.join(base_dir, SCHEMA_PATH))
+        return [base_dir, schema_path] if schema_path and os.path.exists(schema_path) else [base_dir]
+
+    def _init_from_snapshot(self, **kwargs):
+        self._file_handles = HDFStorePool(kwargs.get('max_open_files', MAX_OPEN_FILES))
+        self._datasets = self._make_datasets(self._manifest_files)
+        self._set_quantity_modifiers()
+
+    def _reopen_resources(self):
+        self._file_handles = HDFStorePool(self._init_kwargs.get('max_open_files', MAX_OPEN_FILES))
+        for dataset in self._datasets:
+            dataset.reset_storer()
+
+    def _set_quantity_modifiers(self):
+        """Set the quantity modifiers and info for the bands in `self._columns`"""
+        bands = tuple(sorted(set(col[0] for col in self._columns if len(col) == 5 and col.endswith('_mag'))))
+        key = (type(self), self.pixel_scale, bands)
+        if key not in _QUANTITY_MODIFIERS_CACHE:
+            _QUANTITY_MODIFIERS_CACHE[key] = self._generate_modifiers(self.pixel_scale, bands)
+        if key not in _QUANTITY_INFO_CACHE:
+            _QUANTITY_INFO_CACHE[key] = self._generate_info_dict(META_PATH, bands)
+        self._quantity_modifiers = dict(_QUANTITY_MODIFIERS_CACHE[key])
+        self._quantity_info_dict = {k: dict(v) for k, v in _QUANTITY_INFO_CACHE[key].items()}
 
     def __del__(self):
-        self.close_all_file_handles()
+        # construction may have failed before the file handles were set up
+        if getattr(self, '_file_handles', None) is not None:
+            self.close_all_file_handles()
 
     @staticmethod
     def _generate_modifiers(pixel_scale=0.2, bands='ugrizy'):
@@ -297,12 +676,12 @@ class DC2ObjectCatalog(BaseGenericCatalog):
                 modifiers['I{}PSF_{}'.format(ax, band)] = '{}_base_SdssShape_psf_{}'.format(band, ax)
 
             modifiers['mag_{}_cModel'.format(band)] = (
-                lambda x: -2.5 * np.log10(x) + 27.0,
+                calc_cmodel_mag,
                 '{}_modelfit_CModel_flux'.format(band),
             )
 
             modifiers['magerr_{}_cModel'.format(band)] = (
-                lambda flux, err: (2.5 * err) / (flux * np.log(10)),
+                calc_cmodel_magerr,
                 '{}_modelfit_CModel_flux'.format(band),
                 '{}_modelfit_CModel_fluxSigma'.format(band),
             )
@@ -314,7 +693,7 @@ class DC2ObjectCatalog(BaseGenericCatalog):
             )
 
             modifiers['psf_fwhm_{}'.format(band)] = (
-                lambda xx, yy, xy: pixel_scale * 2.355 * (xx * yy - xy * xy) ** 0.25,
+                partial(calc_psf_fwhm, pixel_scale=pixel_scale),
                 '{}_base_SdssShape_psf_xx'.format(band),
                 '{}_base_SdssShape_psf_yy'.format(band),
                 '{}_base_SdssShape_psf_xy'.format(band),
@@ -381,33 +760,209 @@ class DC2ObjectCatalog(BaseGenericCatalog):
     def _generate_datasets(self):
         """Return viable data sets from all files in self.base_dir
 
+        File contents (keys, row counts and columns) are taken from the
+        dataset manifest whenever the file's mtime and size still match,
+        so that no file needs to be opened here. Files that are new or
+        have changed are scanned and the manifest is updated.
+
         Returns:
             A list of ObjectTableWrapper(<file path>, <key>) objects
             for all files and keys
         """
-        datasets = list()
+        manifest = self._load_manifest()
+        manifest_files = dict()
+        manifest_changed = False
+
         for fname in sorted(os.listdir(self.base_dir)):
             if not self._filename_re.match(fname):
                 continue
 
             file_path = os.path.join(self.base_dir, fname)
+            entry = manifest.get(fname)
             try:
-                fh = self._open_hdf5(file_path)
+                stat = os.stat(file_path)
+                if (entry is None or
+                        entry['mtime'] != stat.st_mtime or
+                        entry['size'] != stat.st_size):
+                    entry = self._scan_file(file_path)
+                    entry['mtime'] = stat.st_mtime
+                    entry['size'] = stat.st_size
+                    manifest_changed = True
 
             except (IOError, OSError):
                 warnings.warn('Cannot access {}; skipped'.format(file_path))
                 continue
 
-            for key in fh:
-                if self._groupname_re.match(key.lstrip('/')):
-                    datasets.append(ObjectTableWrapper(fh, key, self._schema))
-                    continue
+            manifest_files[fname] = entry
+
+        if manifest_changed or set(manifest) != set(manifest_files):
+            self._save_manifest(manifest_files)
+        self._manifest_files = manifest_files
+
+        return self._make_datasets(manifest_files)
 
-                warn_msg = 'incorrect group name "{}" in {}; skipped this group'
-                warnings.warn(warn_msg.format(os.path.basename(file_path), key))
+    def _make_datasets(self, manifest_files):
+        """Return ObjectTableWrapper objects for all datasets in the manifest entries
+
+        Args:
+            manifest_files (dict): {<file name>: <manifest entry>, ...}
+        """
+        datasets = list()
+        for fname, entry in sorted(manifest_files.items()):
+            file_path = os.path.join(self.base_dir, fname)
+            for dataset in entry['datasets']:
+                datasets.append(ObjectTableWrapper(
+                    file_path,
+                    dataset['key'],
+                    self._schema,
+                    sky_bounds=dataset.get('sky_bounds'),
+                    file_opener=self._open_hdf5,
+                    columns=dataset['columns'],
+                    nrows=dataset['nrows'],
+                    categorical_strings=self.categorical_strings,
+                ))
 
         return datasets
 
+    def _ensure_sky_bounds(self):
+        """Compute the sky bounding boxes of all tract/patches that do not have one yet
+
+        Only coord_ra and coord_dec are needed. The results are stored
+        in the dataset manifest so that this is only done once.
+        """
+        if all(dataset.sky_bounds is not None for dataset in self._datasets):
+            return
+
+        # only one thread computes the bounds and updates the manifest
+        with _HDF5_LOCK:
+            missing = [dataset for dataset in self._datasets if dataset.sky_bounds is None]
+            if not missing:
+                return
+
+            for dataset in missing:
+                dataset.compute_sky_bounds()
+                if not self.use_cache:
+                    dataset.clear_cache()
+
+            sky_bounds = {(dataset.file_path, dataset.key): dataset.sky_bounds for dataset in self._datasets}
+            for fname, entry in self._manifest_files.items():
+                file_path = os.path.join(self.base_dir, fname)
+                for dataset in entry['datasets']:
+                    dataset['sky_bounds'] = sky_bounds.get((file_path, dataset['key']))
+            self._save_manifest(self._manifest_files)
+            self._save_snapshot()
+
+    def _scan_file(self, file_path):
+        """Open an HDF5 file and collect keys, row counts and columns of its groups
+
+        Args:
+            file_path (str): The path of the file to scan
+
+        Returns:
+            A manifest entry of the form
+                {'datasets': [{'key': <key>, 'nrows': <nrows>, 'columns': <set>}, ...]}
+        """
+        datasets = list()
+        with pd.HDFStore(file_path, 'r') as fh:
+            for key in fh.keys():
+                if not self._groupname_re.match(key.lstrip('/')):
+                    warn_msg = 'incorrect group name "{}" in {}; skipped this group'
+                    warnings.warn(warn_msg.format(key, os.path.basename(file_path)))
+                    continue
+
+                storer = fh.get_storer(key)
+                datasets.append({
+                    'key': key,
+                    'nrows': int(get_storer_nrows(storer)),
+                    'columns': frozenset(get_storer_columns(storer)),
+                })
+
+        return {'datasets': datasets}
+
+    def _get_default_manifest_path(self):
+        """Return the default manifest path in the GCRCatalogs cache directory
+
+        The file name depends on the absolute `base_dir` and the file and
+        group name patterns, so that different configs do not collide.
+        """
+        cache_dir = get_cache_dir('dc2_object')
+        if cache_dir is None:
+            return None
+
+        manifest_id = hashlib.md5('\n'.join((
+            os.path.abspath(self.base_dir),
+            self._filename_re.pattern,
+            self._groupname_re.pattern,
+        )).encode()).hexdigest()
+        return os.path.join(cache_dir, 'manifest_{}.json'.format(manifest_id))
+
+    def _load_manifest(self):
+        """Return the file entries stored in the dataset manifest
+
+        Returns an empty dictionary if there is no (valid) manifest.
+        Column sets are stored once in the manifest and are shared
+        between all datasets that have identical columns.
+        """
+        if not self._manifest_path or not os.path.isfile(self._manifest_path):
+            return dict()
+
+        try:
+            with open(self._manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('format_version') != MANIFEST_FORMAT_VERSION:
+                return dict()
+            column_sets = [frozenset(columns) for columns in manifest['column_sets']]
+            files = manifest['files']
+            for entry in files.values():
+                for dataset in entry['datasets']:
+                    dataset['columns'] = column_sets[dataset['columns']]
+        except (IOError, OSError, ValueError, KeyError, IndexError, TypeError):
+            warnings.warn('Cannot load dataset manifest {}; regenerating it'.format(self._manifest_path))
+            return dict()
+
+        return files
+
+    def _save_manifest(self, files):
+        """Write the file entries to the dataset manifest (atomically)
+
+        Args:
+            files (dict): {<file name>: <manifest entry>, ...}
+        """
+        if not self._manifest_path:
+            return
+
+        column_sets = list()
+        column_set_index = dict()
+        files_out = dict()
+        for fname, entry in files.items():
+            datasets_out = list()
+            for dataset in entry['datasets']:
+                columns = dataset['columns']
+                if columns not in column_set_index:
+                    column_set_index[columns] = len(column_sets)
+                    column_sets.append(sorted(columns))
+                dataset_out = dict(dataset)
+                dataset_out['columns'] = column_set_index[columns]
+                datasets_out.append(dataset_out)
+            files_out[fname] = dict(entry, datasets=datasets_out)
+
+        manifest = {
+            'format_version': MANIFEST_FORMAT_VERSION,
+            'base_dir': os.path.abspath(self.base_dir),
+            'files': files_out,
+            'column_sets': column_sets,
+        }
+
+        tmp_path = '{}.{}.tmp'.format(self._manifest_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f)
+            os.rename(tmp_path, self._manifest_path)
+        except (IOError, OSError):
+            warnings.warn('Cannot write dataset manifest {}'.format(self._manifest_path))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
     @staticmethod
     def _generate_schema_from_yaml(schema_path):
         """Return a dictionary of columns based on schema in YAML file
@@ -423,14 +978,18 @@ class DC2ObjectCatalog(BaseGenericCatalog):
             If one or more column names are repeated.
         """
 
-        with open(schema_path, 'r') as schema_stream:
-            schema = yaml.load(schema_stream)
+        key = (os.path.realpath(schema_path), os.path.getmtime(schema_path))
+        if key not in _SCHEMA_CACHE:
+            with open(schema_path, 'r') as schema_stream:
+                _SCHEMA_CACHE[key] = yaml.load(schema_stream)
+        schema = _SCHEMA_CACHE[key]
 
         if schema is None:
             warn_msg = 'No schema can be found in schema file {}'
             warnings.warn(warn_msg.format(schema_path))
+            return schema
 
-        return schema
+        return dict(schema)
 
     @staticmethod
     def _generate_columns(datasets):
@@ -479,39 +1038,132 @@ class DC2ObjectCatalog(BaseGenericCatalog):
     def _open_hdf5(self, file_path):
         """Return the file handle of an HDF5 file as an pd.HDFStore object
 
-        Cache and return the file handle for the HDF5 file at <file_path>
+        File handles are kept in a bounded pool; the least recently
+        used handle is closed when too many files are open.
 
         Args:
             file_path (str): The path of the desired file
 
         Return:
-            The cached file handle
+            The pooled file handle
         """
 
-        if (file_path not in self._file_handles or
-                not self._file_handles[file_path].is_open):
-            self._file_handles[file_path] = pd.HDFStore(file_path, 'r')
-
-        return self._file_handles[file_path]
+        return self._file_handles.open(file_path)
 
     def close_all_file_handles(self):
-        """Clear all cached file handles"""
+        """Close all pooled file handles"""
 
-        for fh in self._file_handles.values():
-            fh.close()
-
-        self._file_handles.clear()
+        self._file_handles.close_all()
 
     def _generate_native_quantity_list(self):
         """Return a set of native quantity names as strings"""
 
-        return self._columns.union(self._native_filter_quantities)
+        return self._columns.union({'tract', 'patch'})
 
-    def _iter_native_dataset(self, native_filters=None):
-        # pylint: disable=C0330
+    def _get_native_partitions(self, native_filters=None):
+        # ra/dec native filters are applied to rows, which partitions cannot represent
+        if native_filters is not None and SKY_QUANTITIES.intersection(native_filters.variable_names):
+            return None
+        partitions = []
+        for dataset in self._datasets:
+            if native_filters is not None and not query_may_pass(native_filters, dataset.tract_and_patch):
+                continue
+            if (dataset.tract, dataset.patch) not in partitions:
+                partitions.append((dataset.tract, dataset.patch))
+        return partitions
+
+    def _get_filtered_partitions(self, native_filters=None):
+        # ra/dec native filters are applied to the rows of each tract/patch (see _iter_filtered_partitions)
+        native_sky_filters = (native_filters is not None and
+                              bool(SKY_QUANTITIES.intersection(native_filters.variable_names)))
+        if native_sky_filters:
+            self._ensure_sky_bounds()
+        partitions = []
         for dataset in self._datasets:
-            if (native_filters is None or
-                native_filters.check_scalar(dataset.tract_and_patch)):
-                yield dataset.get
+            if (native_filters is not None and
+                    not query_may_pass(native_filters, dataset.tract_and_patch, dataset.sky_bounds)):
+                continue
+            if (dataset.tract, dataset.patch) not in partitions:
+                partitions.append((dataset.tract, dataset.patch))
+        return partitions
+
+    def _iter_filtered_partitions(self, partitions, native_filters=None):
+        for partition in partitions:
+            datasets = [dataset for dataset in self._datasets if (dataset.tract, dataset.patch) == tuple(partition)]
+            if not datasets:
+                raise ValueError('No data for tract {} and patch {}'.format(*partition))
+            for chunk in self._iter_datasets(native_filters, datasets=datasets):
+                yield chunk
+
+    def _get_native_partition_sky_bounds(self, partition):
+        self._ensure_sky_bounds()
+        bounds = np.array([dataset.sky_bounds for dataset in self._datasets
+                           if (dataset.tract, dataset.patch) == tuple(partition) and not np.isnan(dataset.sky_bounds).any()])
+        if not len(bounds):
+            return (np.nan,) * 4
+        return bounds[:, 0].min(), bounds[:, 1].max(), bounds[:, 2].min(), bounds[:, 3].max()
+
+    def _get_native_partition_info(self, partition):
+        tract, patch = partition
+        return {'tract': tract, 'patch': patch}
+
+    def _iter_native_partitions(self, partitions):
+        for partition in partitions:
+            datasets = [dataset for dataset in self._datasets if (dataset.tract, dataset.patch) == tuple(partition)]
+            if not datasets:
+                raise ValueError('No data for tract {} and patch {}'.format(*partition))
+            for dataset in datasets:
+                yield dataset.as_chunk(dataset.tract_and_patch)
                 if not self.use_cache:
                     dataset.clear_cache()
+
+    def _iter_native_dataset_with_filters(self, native_filters=None, filters=None):
+        # ra/dec conditions in `filters` are also used to skip tract/patches.
+        sky_filters = None
+        if (filters is not None and SKY_QUANTITIES.intersection(filters.variable_names) and
+                all(self._quantity_modifiers.get(q) == (np.rad2deg, 'coord_' + q) for q in SKY_QUANTITIES)):
+            sky_filters = filters
+        return self._iter_datasets(native_filters, sky_filters)
+
+    def _iter_native_dataset(self, native_filters=None):
+        return self._iter_datasets(native_filters)
+
+    def _iter_datasets(self, native_filters=None, sky_filters=None, datasets=None):
+        """Yield native quantity getters of the tract/patches that may pass the filters
+
+        Args:
+            native_filters (GCRQuery): native filters on tract, patch, ra, dec
+            sky_filters (GCRQuery): other filters whose ra/dec conditions are
+                used to skip tract/patches (but are not applied to rows here)
+            datasets (list): the datasets to go through (default: all)
+        """
+        # pylint: disable=C0330
+        native_sky_filters = (native_filters is not None and
+                              bool(SKY_QUANTITIES.intersection(native_filters.variable_names)))
+        if native_sky_filters or sky_filters is not None:
+            self._ensure_sky_bounds()
+
+        for dataset in (self._datasets if datasets is None else datasets):
+            if (native_filters is not None and
+                not query_may_pass(native_filters, dataset.tract_and_patch, dataset.sky_bounds)):
+                continue
+
+            if (sky_filters is not None and
+                not query_may_pass(sky_filters, dataset.tract_and_patch, dataset.sky_bounds)):
+                continue
+
+            if native_sky_filters:
+                mask = native_filters.mask(dataset.get_native_filter_table(native_filters.variable_names))
+                if not mask.any():
+                    if not self.use_cache:
+                        dataset.clear_cache()
+                    continue
+                if mask.all():
+                    yield dataset.as_chunk(dataset.tract_and_patch)
+                else:
+                    yield dataset.as_chunk(dataset.tract_and_patch).take(np.flatnonzero(mask))
+            else:
+                yield dataset.as_chunk(dataset.tract_and_patch)
+
+            if not self.use_cache:
+                dataset.clear_cache()
@@ -1,13 +1,100 @@
 import os
 import sqlite3
 import numpy as np
-from GCR import BaseGenericCatalog
+from .base import BaseCatalog
 from .utils import md5, is_string_like
 
 __all__ = ['DC2TruthCatalogReader', 'DC2TruthCatalogLightCurveReader']
 
 
-class DC2TruthCatalogReader(BaseGenericCatalog):
+def _to_bool(x):
+    return x.astype(np.bool)
+
+
+_UINT64_MASK = 2**64 - 1
+
+
+def _row_uniform(rowid, seed):
+    """
+    Return a number in [0, 1) that is uniformly distributed and independent
+    between rows and seeds (the splitmix64 hash of `rowid` and `seed`)
+    """
+    z = (seed + (rowid + 1) * 0x9E3779B97F4A7C15) & _UINT64_MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _UINT64_MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _UINT64_MASK
+    return (z ^ (z >> 31)) / 18446744073709551616.0
+
+
+class SQLiteQueryGetter(object):
+    """
+    Native quantity getter that queries the database for multiple columns at once.
+    Calling it with a list of column names returns a structured array.
+
+    Parameters
+    ----------
+    cursor : sqlite3.Cursor
+    source : str
+        the FROM part of the query (table name, possibly with joins)
+    dtypes : dict
+        sqlite column types
+    conditions : tuple of str, optional
+        conditions to be combined with AND in the WHERE clause
+    rowid : str, optional
+        name of the rowid column to use for sampling
+    """
+    def __init__(self, cursor, source, dtypes, conditions=tuple(), rowid='rowid'):
+        self._cursor = cursor
+        self._source = source
+        self._dtypes = dtypes
+        self._conditions = tuple(conditions)
+        self._rowid = rowid
+
+    def __call__(self, quantities):
+        dtype = np.dtype([(q, self._dtypes[q]) for q in quantities])
+        query = 'SELECT {} FROM {}'.format(', '.join(quantities), self._source)
+        if self._conditions:
+            query += ' WHERE ({})'.format(') AND ('.join(self._conditions))
+        # may need to switch to fetchmany for larger dataset
+        return np.array(self._cursor.execute(query + ';').fetchall(), dtype)
+
+    def sample(self, fraction, random_state, block_size=None): # pylint: disable=W0613
+        """
+        Return a new getter that only selects a random subsample of rows
+        (each row independently with probability `fraction`), done in the WHERE clause
+        with a seeded hash of the rowid (see `_row_uniform`), registered as an SQL function.
+        """
+        if fraction >= 1:
+            return self
+        self._cursor.connection.create_function('gcr_row_uniform', 2, _row_uniform)
+        condition = 'gcr_row_uniform({}, {}) < {!r}'.format(
+            self._rowid,
+            int(random_state.randint(2**31)) << 32 | int(random_state.randint(2**31)),
+            float(fraction),
+        )
+        return SQLiteQueryGetter(self._cursor, self._source, self._dtypes,
+                                 self._conditions + (condition,), self._rowid)
+
+
+class SQLiteConnectionMixin(object):
+    """
+    Provides `_conn`, a connection to the sqlite database `self._filename`.
+    The connection is opened on first use, and is not shared with other
+    processes (it is opened again after unpickling or forking).
+    """
+    _resource_attributes = ('_connection',)
+    _connection = None
+
+    @property
+    def _conn(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._filename, check_same_thread=False)
+        return self._connection
+
+    def _reopen_resources(self):
+        self._connection = None
+
+
+class DC2TruthCatalogReader(SQLiteConnectionMixin, BaseCatalog):
     """
     DC2 truth catalog reader
 
@@ -46,8 +133,6 @@ class DC2TruthCatalogReader(BaseGenericCatalog):
         if kwargs.get('md5') and md5(self._filename) != kwargs['md5']:
             raise ValueError('md5 sum does not match!')
 
-        self._conn = sqlite3.connect(self._filename)
-
         # get the descriptions of the columns as provided in the sqlite database
         cursor = self._conn.cursor()
         if self._is_static:
@@ -67,9 +152,9 @@ class DC2TruthCatalogReader(BaseGenericCatalog):
                 'mag_true_i': 'i',
                 'mag_true_z': 'z',
                 'mag_true_y': 'y',
-                'agn': (lambda x: x.astype(np.bool)),
-                'star': (lambda x: x.astype(np.bool)),
-                'sprinkled': (lambda x: x.astype(np.bool)),
+                'agn': _to_bool,
+                'star': _to_bool,
+                'sprinkled': _to_bool,
             }
 
     def _generate_native_quantity_list(self):
@@ -91,24 +176,9 @@ class DC2TruthCatalogReader(BaseGenericCatalog):
         else:
             all_filters = self.base_filters
 
-        if all_filters:
-            query_where_clause = 'WHERE ({})'.format(') AND ('.join(all_filters))
-        else:
-            query_where_clause = ''
-
-        def dc2_truth_native_quantity_getter(quantities):
-            # note the API of this getter is not normal, and hence
-            # we have overwritten _obtain_native_data_dict
-            dtype = np.dtype([(q, self._native_quantity_dtypes[q]) for q in quantities])
-            query = 'SELECT {} FROM {} {};'.format(
-                ', '.join(quantities),
-                self._table_name,
-                query_where_clause
-            )
-            # may need to switch to fetchmany for larger dataset
-            return np.array(cursor.execute(query).fetchall(), dtype)
-
-        yield dc2_truth_native_quantity_getter
+        # note the API of this getter is not normal, and hence
+        # we have overwritten _obtain_native_data_dict
+        yield SQLiteQueryGetter(cursor, self._table_name, self._native_quantity_dtypes, all_filters)
 
     def _get_quantity_info_dict(self, quantity, default=None):
         if quantity in self._column_descriptions:
@@ -116,7 +186,7 @@ class DC2TruthCatalogReader(BaseGenericCatalog):
         return default
 
 
-class DC2TruthCatalogLightCurveReader(BaseGenericCatalog):
+class DC2TruthCatalogLightCurveReader(SQLiteConnectionMixin, BaseCatalog):
     """
     DC2 truth catalog reader for light curves
 
@@ -159,7 +229,6 @@ class DC2TruthCatalogLightCurveReader(BaseGenericCatalog):
         if kwargs.get('md5') and md5(self._filename) != kwargs['md5']:
             raise ValueError('md5 sum does not match!')
 
-        self._conn = sqlite3.connect(self._filename)
         cursor = self._conn.cursor()
         self._dtypes = dict()
         for table, table_name in self._tables.items():
@@ -201,16 +270,13 @@ class DC2TruthCatalogLightCurveReader(BaseGenericCatalog):
         )
         ids_needed = np.array(cursor.execute(query).fetchall(), dtype)[id_col_name]
 
+        source = '{0} JOIN {1} ON {0}.{2}={1}.{2}'.format(
+            self._tables['light_curves'],
+            self._tables['obs_meta'],
+            'obshistid',
+        )
+        rowid = '{}.rowid'.format(self._tables['light_curves'])
+
         for id_this in ids_needed:
-            def dc2_truth_light_curve_native_quantity_getter(quantities):
-                dtype = np.dtype([(q, self._dtypes['light_curves'][q]) for q in quantities])
-                query = 'SELECT {0} FROM {1} JOIN {2} ON {1}.{4}={5} AND {1}.{3}={2}.{3};'.format(
-                    ', '.join(quantities),
-                    self._tables['light_curves'],
-                    self._tables['obs_meta'],
-                    'obshistid',
-                    id_col_name,
-                    id_this # pylint: disable=cell-var-from-loop
-                )
-                return np.array(cursor.execute(query).fetchall(), dtype)
-            yield dc2_truth_light_curve_native_quantity_getter
+            condition = '{}.{}={}'.format(self._tables['light_curves'], id_col_name, id_this)
+            yield SQLiteQueryGetter(cursor, source, self._dtypes['light_curves'], (condition,), rowid)
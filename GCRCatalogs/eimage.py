@@ -32,6 +32,10 @@ class FitsFile(object): # from buzzard.py but using hdu=0
     def data(self):
         return self.file_handle[0].data  #pylint: disable=E1101
 
+    def __getstate__(self):
+        # the file is opened again when needed
+        return {'_path': self._path, '_file_handle': None}
+
     def __del__(self):
         if self._file_handle is not None:
             del self._file_handle[0].data  #pylint: disable=E1101
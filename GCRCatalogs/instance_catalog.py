@@ -5,12 +5,14 @@ from __future__ import division, print_function
 import os
 import gc
 import gzip
+import threading
 import warnings
 from functools import partial
 import numpy as np
 import pandas as pd
 from astropy.cosmology import FlatLambdaCDM
-from GCR import BaseGenericCatalog
+from .base import BaseCatalog
+from .categorical import CategoricalArray
 
 __all__ = ['InstanceCatalog']
 
@@ -110,10 +112,14 @@ _get_total_e1 = partial(_total_shape, result='e1')
 _get_total_e2 = partial(_total_shape, result='e2')
 
 
-class InstanceCatalog(BaseGenericCatalog):
+class InstanceCatalog(BaseCatalog):
     """
     Instance catalog class. Uses generic quantity and filter mechanisms
     defined by BaseGenericCatalog class.
+
+    With `categorical_strings: true` in the config, string columns (object,
+    sed_name, source_type, dust names) are read as pandas categoricals and
+    returned as CategoricalArrays.
     """
 
     _base_col_names = [
@@ -181,6 +187,9 @@ class InstanceCatalog(BaseGenericCatalog):
 
     _legacy_gal_types = ('agn_gal', 'bulge_gal', 'disk_gal')
 
+    # tables read so far are not pickled
+    _resource_attributes = ('_data', '_data_lock')
+
     def _subclass_init(self, **kwargs):
         self.header_file = kwargs['header_file']
 
@@ -189,12 +198,14 @@ class InstanceCatalog(BaseGenericCatalog):
 
         self.header = self.parse_header(self.header_file)
         self.base_dir = os.path.dirname(self.header_file)
+        self.categorical_strings = bool(kwargs.get('categorical_strings', False))
 
         self.cosmology = FlatLambdaCDM(H0=71, Om0=0.265, Ob0=0.0448)
         self.lightcone = True
 
         self.legacy_gal_catalog = False
         self._data = dict()
+        self._data_lock = threading.RLock()
         self._object_files = dict()
         for filename in self.header['includeobj']:
             obj_type = filename.partition('_cat_')[0]
@@ -257,6 +268,10 @@ class InstanceCatalog(BaseGenericCatalog):
             'size_bulge_minor_true': 'gal/b_bulge',
         }
 
+    def _reopen_resources(self):
+        self._data = dict()
+        self._data_lock = threading.RLock()
+
     def _generate_native_quantity_list(self):
         native_quantities = ['{}/{}'.format(obj_type, col) for obj_type in self._object_files for col, _ in self._col_names[obj_type]]
         for col, _ in self._col_names['bulge_gal']:
@@ -266,11 +281,14 @@ class InstanceCatalog(BaseGenericCatalog):
         return native_quantities
 
     def _pd_read_table(self, obj_type, **kwargs):
+        dtype = dict(self._col_names[obj_type])
+        if self.categorical_strings:
+            dtype = {col: ('category' if t is str else t) for col, t in dtype.items()}
         return pd.read_table(
             self._object_files[obj_type],
             delim_whitespace=True,
             names=[c[0] for c in self._col_names[obj_type]],
-            dtype=dict(self._col_names[obj_type]),
+            dtype=dtype,
             **kwargs
         )
 
@@ -321,20 +339,28 @@ class InstanceCatalog(BaseGenericCatalog):
         return self._pd_read_table(obj_type)
 
     def load_single_catalog(self, obj_type):
-        if obj_type not in self._data:
-            try:
-                self._data[obj_type] = self._load_single_catalog(obj_type)
-            except MemoryError:
-                if not self._data:
-                    raise
-                self._data.clear()
-                gc.collect()
-                return self.load_single_catalog(obj_type)
-        return self._data[obj_type]
+        # tables are loaded by one thread at a time; threads that already hold
+        # a table keep using it even if `_data` is cleared to free memory
+        with self._data_lock:
+            data = self._data.get(obj_type)
+            if data is None:
+                try:
+                    data = self._load_single_catalog(obj_type)
+                except MemoryError:
+                    if not self._data:
+                        raise
+                    self._data.clear()
+                    gc.collect()
+                    return self.load_single_catalog(obj_type)
+                self._data[obj_type] = data
+            return data
 
     def _native_quantity_getter(self, native_quantity):
         obj_type, _, col_name = native_quantity.partition('/')
-        return self.load_single_catalog(obj_type)[col_name].values
+        column = self.load_single_catalog(obj_type)[col_name]
+        if pd.api.types.is_categorical_dtype(column.dtype):
+            return CategoricalArray.from_pandas(column)
+        return column.values
 
     def _iter_native_dataset(self, native_filters=None):
         if native_filters is not None:
@@ -0,0 +1,133 @@
+"""
+Lazy, partitioned access to catalogs (e.g., as dask DataFrames)
+
+`get_catalog_partitions` splits a catalog into its native partitions (see
+BaseCatalog.get_partitions): the healpix files (and redshift blocks) of
+cosmoDC2, the tract/patches of the DC2 object catalog, or the chunks of
+`_iter_native_dataset` for other readers. Each CatalogPartition carries its
+partition information (healpix_pixel, redshift_block_lower, tract, patch) and
+only reads data when `read` is called. Partitions are picklable (the catalog
+is pickled without open files or cached data), so they can be sent to
+multiprocessing workers.
+
+`to_dask_dataframe` builds a dask DataFrame with one (lazily read) partition
+per CatalogPartition, in the same order. Use `native_filters` or
+`partition_filter` to only keep the partitions that are needed.
+"""
+import numpy as np
+from .categorical import CategoricalArray
+from .utils import is_string_like
+
+__all__ = ['CatalogPartition', 'get_catalog_partitions', 'get_partition_sizes', 'to_dask_dataframe']
+
+
+class CatalogPartition(object):
+    """
+    One partition of a catalog.
+
+    Parameters
+    ----------
+    catalog : BaseCatalog
+    key : tuple
+        partition key returned by `catalog.get_partitions`
+    info : dict, optional
+        partition information (e.g., {'tract': 4850, 'patch': '3,1'})
+    native_filters : optional
+        the native filters that were passed to `catalog.get_partitions`
+    """
+    def __init__(self, catalog, key, info=None, native_filters=None):
+        self.catalog = catalog
+        self.key = tuple(key)
+        self.info = dict(info or {})
+        self.native_filters = native_filters
+
+    @property
+    def size(self):
+        """size of this partition in bytes (None if unknown)"""
+        return self.catalog.get_partition_size(self.key)
+
+    def read(self, quantities, filters=None, **kwargs):
+        """
+        read `quantities` of this partition; other keyword arguments
+        (e.g., `return_iterator`, `chunk_rows`) are passed to `get_quantities`
+        """
+        return self.catalog.get_quantities(quantities, filters, self.native_filters,
+                                           partitions=[self.key], **kwargs)
+
+    def __repr__(self):
+        return 'CatalogPartition({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in sorted(self.info.items())))
+
+
+def get_catalog_partitions(catalog, native_filters=None, partition_filter=None):
+    """
+    Return the partitions of `catalog` that may pass `native_filters`, as a list of CatalogPartition.
+    If `partition_filter` is set, only keep partitions for which `partition_filter(info)` is True.
+    """
+    partitions = []
+    for key, info in catalog.get_partitions(native_filters):
+        if partition_filter is None or partition_filter(info):
+            partitions.append(CatalogPartition(catalog, key, info, native_filters))
+    return partitions
+
+
+def get_partition_sizes(partitions):
+    """
+    Return the sizes in bytes of `partitions` (CatalogPartition instances);
+    partitions of unknown size count as the average known size (or 1).
+    """
+    sizes = [p.size for p in partitions]
+    known_sizes = [size for size in sizes if size is not None]
+    default_size = sum(known_sizes) / len(known_sizes) if known_sizes else 1
+    return [default_size if size is None else size for size in sizes]
+
+
+def _as_column(values):
+    if isinstance(values, CategoricalArray):
+        import pandas as pd # pylint: disable=import-error
+        return pd.Categorical.from_codes(values.codes, values.categories)
+    return np.asarray(values)
+
+
+def _to_frame(data, quantities):
+    import pandas as pd # pylint: disable=import-error
+    return pd.DataFrame({q: _as_column(data[q]) for q in quantities}, columns=quantities)
+
+
+def read_partition_frame(partition, quantities, filters=None, kwargs=None):
+    """read `quantities` of `partition` (a CatalogPartition) as a pandas DataFrame"""
+    return _to_frame(partition.read(quantities, filters, **(kwargs or {})), quantities)
+
+
+def _get_meta(partition, quantities):
+    """an empty DataFrame with the columns and dtypes of `quantities` (only reads about one row)"""
+    data = next(partition.read(quantities, return_iterator=True, chunk_rows=1), None)
+    if data is None:
+        data = partition.read(quantities)
+    return _to_frame(data, quantities).iloc[:0]
+
+
+def to_dask_dataframe(catalog, quantities, filters=None, native_filters=None, partition_filter=None,
+                      meta=None, **kwargs):
+    """
+    Return `quantities` of `catalog` as a dask DataFrame, with one partition per
+    native partition of the catalog (see `get_catalog_partitions`). No data are read
+    until the DataFrame is computed, except for about one row to find the dtypes
+    (unless `meta`, an empty pandas DataFrame with the right columns and dtypes, is given).
+
+    Other keyword arguments (e.g., `sample`, `chunk_rows`) are passed to `get_quantities`.
+    Quantities must be 1-d; CategoricalArrays become pandas categoricals.
+    """
+    import dask # pylint: disable=import-error
+    import dask.dataframe as dd # pylint: disable=import-error
+
+    quantities = [quantities] if is_string_like(quantities) else list(quantities)
+    partitions = get_catalog_partitions(catalog, native_filters, partition_filter)
+    if not partitions:
+        raise ValueError('No partitions of this catalog pass `native_filters` and `partition_filter`')
+
+    if meta is None:
+        meta = _get_meta(partitions[0], quantities)
+
+    read = dask.delayed(read_partition_frame, pure=False)
+    parts = [read(partition, quantities, filters, kwargs) for partition in partitions]
+    return dd.from_delayed(parts, meta=meta, verify_meta=False)
@@ -0,0 +1,219 @@
+"""
+Compiled evaluation of GCRQuery filters (used by BaseCatalog.get_quantities)
+
+A GCRQuery evaluates each clause into its own full-length boolean array and
+combines them afterwards. `CompiledQuery` instead fuses all string clauses into
+a single numexpr expression (one pass, no intermediate arrays), combines masks
+in place, and evaluates the remaining clauses of an AND (OR) only on the rows
+that are still selected (not yet selected).
+"""
+import re
+import numpy as np
+import numexpr as ne
+from .utils import is_string_like
+
+__all__ = ['CompiledQuery', 'StringComparison', 'convert_string_comparisons']
+
+# later clauses are only evaluated on a subset of rows when less than this fraction of rows is left
+SUBSET_FRACTION = 0.5
+
+_NUMEXPR_OPERATORS = {'AND': ' & ', 'OR': ' | '}
+
+
+_STRING_COMPARISON_RE = re.compile(
+    r'''^\s*(?:(?P<name>\w+)\s*(?P<op>[!=]=)\s*(?P<q>['"])(?P<value>[^'"]*)(?P=q)|'''
+    r'''(?P<q2>['"])(?P<value2>[^'"]*)(?P=q2)\s*(?P<op2>[!=]=)\s*(?P<name2>\w+))\s*$'''
+)
+
+
+class StringComparison(object):
+    """
+    Callable for filters like `(StringComparison('3,1'), 'patch')`, which select
+    rows equal (or not equal, if `equal` is False) to a string. Works on plain
+    string arrays and on CategoricalArrays (where it compares codes).
+    """
+    def __init__(self, value, equal=True):
+        self.value = value
+        self.equal = bool(equal)
+
+    def __call__(self, values):
+        value = self.value
+        if getattr(values, 'dtype', None) is not None and values.dtype.kind == 'S':
+            value = value.encode()
+        mask = np.asarray(values == value, dtype=np.bool_)
+        return mask if self.equal else ~mask
+
+    def __repr__(self):
+        return 'StringComparison({!r}, equal={})'.format(self.value, self.equal)
+
+
+def _convert_string_comparison(basic_query):
+    match = _STRING_COMPARISON_RE.match(basic_query)
+    if match is None:
+        return basic_query
+    if match.group('name'):
+        name, op, value = match.group('name', 'op', 'value')
+    else:
+        name, op, value = match.group('name2', 'op2', 'value2')
+    return (StringComparison(value, op == '=='), name)
+
+
+def convert_string_comparisons(filters):
+    """
+    numexpr cannot compare strings, so convert string filters of the form
+    "name == 'value'" (or !=) in `filters` (a string, a list of filters, or a GCRQuery)
+    to `(StringComparison('value'), 'name')`. Other filters are kept as they are.
+    """
+    # pylint: disable=protected-access
+    if filters is None:
+        return None
+    if is_string_like(filters):
+        return _convert_string_comparison(filters)
+    if isinstance(filters, list):
+        return [_convert_string_comparison(f) if is_string_like(f) else f for f in filters]
+    if not hasattr(filters, '_operator'):
+        return filters
+
+    if filters._operator is None:
+        if not is_string_like(filters._operands):
+            return filters
+        return type(filters)(_convert_string_comparison(filters._operands))
+
+    converted = type(filters)()
+    converted._operator = filters._operator
+    if filters._operator == 'NOT':
+        converted._operands = convert_string_comparisons(filters._operands)
+    else:
+        converted._operands = [convert_string_comparisons(op) for op in filters._operands]
+    return converted
+
+
+def _as_mask(result, n):
+    result = np.asarray(result, dtype=np.bool_)
+    if result.ndim == 0:
+        return np.full(n, bool(result), dtype=np.bool_)
+    return result
+
+
+def _get_numexpr(query):
+    """
+    return `query` (a GCRQuery) as one numexpr expression,
+    or None if `query` has clauses that are not strings
+    """
+    # pylint: disable=protected-access
+    operator, operands = query._operator, query._operands
+    if operator is None:
+        return '({})'.format(operands) if is_string_like(operands) else None
+    if operator == 'NOT':
+        expr = _get_numexpr(operands)
+        return None if expr is None else '(~{})'.format(expr)
+    if operator not in _NUMEXPR_OPERATORS:
+        return None
+    exprs = [_get_numexpr(op) for op in operands]
+    if any(expr is None for expr in exprs):
+        return None
+    return '({})'.format(_NUMEXPR_OPERATORS[operator].join(exprs))
+
+
+class _Clause(object):
+    """one compiled (sub-)query; `evaluate` returns a new boolean array"""
+
+    def __init__(self, query):
+        # pylint: disable=protected-access
+        self.variable_names = tuple(query.variable_names)
+        self.expr = _get_numexpr(query)
+        self.operator = query._operator
+        self.operands = None
+        self.basic_query = None
+
+        if self.expr is not None:
+            return
+
+        if self.operator is None:
+            self.basic_query = query._operands
+        elif self.operator == 'NOT':
+            self.operands = [_Clause(query._operands)]
+        else:
+            operands = [_Clause(op) for op in query._operands]
+            if self.operator in _NUMEXPR_OPERATORS:
+                # fuse all string clauses, and evaluate them first since they are cheap
+                fused = [op for op in operands if op.expr is not None]
+                others = [op for op in operands if op.expr is None]
+                if len(fused) > 1:
+                    fused = [_Clause.from_expr(_NUMEXPR_OPERATORS[self.operator].join(op.expr for op in fused),
+                                               set().union(*(op.variable_names for op in fused)))]
+                operands = fused + others
+            self.operands = operands
+
+    @classmethod
+    def from_expr(cls, expr, variable_names):
+        clause = cls.__new__(cls)
+        clause.variable_names = tuple(variable_names)
+        clause.expr = '({})'.format(expr)
+        clause.operator = None
+        clause.operands = None
+        clause.basic_query = None
+        return clause
+
+    def evaluate(self, data, n):
+        if self.expr is not None:
+            local_dict = {k: np.asarray(data[k]) for k in self.variable_names}
+            return _as_mask(ne.evaluate(self.expr, local_dict=local_dict, global_dict={}), n)
+
+        if self.operator is None:
+            if self.basic_query is None:
+                return np.ones(n, dtype=np.bool_)
+            func = self.basic_query[0]
+            return _as_mask(func(*(data[k] for k in self.basic_query[1:])), n)
+
+        if self.operator == 'NOT':
+            mask = self.operands[0].evaluate(data, n)
+            return np.logical_not(mask, out=mask)
+
+        mask = self.operands[0].evaluate(data, n)
+        for op in self.operands[1:]:
+            if self.operator == 'XOR':
+                mask ^= op.evaluate(data, n)
+                continue
+
+            # AND only needs to look at rows still True, OR at rows still False
+            rows = np.flatnonzero(mask if self.operator == 'AND' else ~mask)
+            if not rows.size:
+                break
+            if rows.size < n * SUBSET_FRACTION:
+                mask[rows] = op.evaluate({k: data[k][rows] for k in op.variable_names}, rows.size)
+            elif self.operator == 'AND':
+                mask &= op.evaluate(data, n)
+            else:
+                mask |= op.evaluate(data, n)
+        return mask
+
+
+class CompiledQuery(object):
+    """
+    A GCRQuery compiled for repeated evaluation on chunks of data.
+
+    Parameters
+    ----------
+    query : GCRQuery
+
+    `mask(data)` returns the same boolean array as `query.mask(data)`,
+    or None if `query` is empty (i.e., all rows are selected).
+    """
+
+    def __init__(self, query):
+        # pylint: disable=protected-access
+        self.variable_names = set(query.variable_names)
+        self.is_empty = query._operator is None and query._operands is None
+        self._clause = None if self.is_empty else _Clause(query)
+
+    def mask(self, data, n=None):
+        """
+        evaluate the query on `data` (a dict of arrays; must contain `variable_names`);
+        `n` is the number of rows, only needed when the query has no variables
+        """
+        if self.is_empty:
+            return None
+        if n is None:
+            n = len(data[next(iter(self.variable_names))])
+        return self._clause.evaluate(data, n)
@@ -4,10 +4,11 @@ redMaPPer catalog class.
 from __future__ import division, print_function
 import os
 import functools
+import threading
 import numpy as np
 from astropy.io import fits
 from astropy.cosmology import FlatLambdaCDM
-from GCR import BaseGenericCatalog
+from .base import BaseCatalog
 
 __all__ = ['RedMapperCatalog']
 
@@ -25,12 +26,14 @@ class FitsFile(object):
         del self._file_handle
 
 
-class RedMapperCatalog(BaseGenericCatalog):
+class RedMapperCatalog(BaseCatalog):
     """
     Buzzard galaxy catalog class. Uses generic quantity and filter mechanisms
     defined by BaseGenericCatalog class.
     """
 
+    _resource_attributes = ('cache', '_cache_lock')
+
     def _subclass_init(self, catalog_root_dir,
                        catalog_path_template,
                        use_cache=True,
@@ -55,6 +58,7 @@ class RedMapperCatalog(BaseGenericCatalog):
         _mask_func = lambda x: np.where(x==99.0, np.nan, x)
 
         self.cache = dict() if use_cache else None
+        self._cache_lock = threading.Lock()
 
         # specify quantity modifiers
         self._quantity_modifiers = {
@@ -84,6 +88,11 @@ class RedMapperCatalog(BaseGenericCatalog):
             self._quantity_modifiers['mag_{}_lsst'.format(band)] = 'members/MODEL_MAG/{}'.format(i)
             self._quantity_modifiers['magerr_{}_lsst'.format(band)] = 'members/MODEL_MAGERR/{}'.format(i)
 
+    def _reopen_resources(self):
+        # the FITS files are opened again (memory-mapped) when needed
+        self.cache = dict() if self._init_kwargs.get('use_cache', True) else None
+        self._cache_lock = threading.Lock()
+
     def _iter_native_dataset(self, native_filters=None):
         assert not native_filters, '*native_filters* is not supported'
 
@@ -109,9 +118,10 @@ class RedMapperCatalog(BaseGenericCatalog):
             return FitsFile(path)
 
         key = (subset)
-        if key not in self.cache:
-            self.cache[key] = FitsFile(path)
-        return self.cache[key]
+        with self._cache_lock:
+            if key not in self.cache:
+                self.cache[key] = FitsFile(path)
+            return self.cache[key]
 
 
     def _native_quantity_getter(self, native_quantity):
@@ -0,0 +1,351 @@
+"""
+Reducers for streaming aggregation over catalogs (see BaseCatalog.aggregate)
+
+Each reducer is updated with one chunk of data at a time, and partial results
+(e.g., from different chunks or different processes) can be merged.
+
+Example
+-------
+>>> from GCRCatalogs.reducers import hist, mean, count
+>>> catalog.aggregate(['mag_r_lsst'], filters=['redshift < 1'],
+...                   reducers=[hist(bins=np.linspace(15, 30, 61)), mean(), count()])
+{'hist(mag_r_lsst)': (array([...]), array([...])), 'mean(mag_r_lsst)': 24.1, 'count': 1234567}
+"""
+import copy
+import numpy as np
+from .utils import is_string_like
+
+__all__ = ['Reducer', 'count', 'total', 'mean', 'moments', 'minimum', 'maximum', 'hist', 'merge_results']
+
+
+def _get_values(data, quantity):
+    values = data[quantity]
+    if np.ma.isMaskedArray(values):
+        values = values.compressed()
+    return values
+
+
+def _get_finite_values(data, quantity):
+    values = _get_values(data, quantity)
+    if values.dtype.kind == 'f':
+        values = values[np.isfinite(values)]
+    return values
+
+
+class Reducer(object):
+    """
+    Base class for reducers.
+
+    Subclasses implement `_update(data)` (data is a dict of arrays of one chunk),
+    `_merge(other)` and `result()`. Reducers that take a quantity can be created
+    without one, and are then applied to each quantity passed to `aggregate`.
+    """
+    name = 'reducer'
+
+    def __init__(self, quantity=None):
+        if quantity is None or is_string_like(quantity):
+            self.quantity = quantity
+        else:
+            self.quantity = tuple(quantity)
+
+    @property
+    def quantities(self):
+        """quantities needed by this reducer"""
+        if self.quantity is None:
+            return []
+        if is_string_like(self.quantity):
+            return [self.quantity]
+        return list(self.quantity)
+
+    @property
+    def is_bound(self):
+        """whether the quantity of this reducer is set"""
+        return self.quantity is not None
+
+    @property
+    def key(self):
+        """key of this reducer's result in the dict returned by `aggregate`"""
+        if not self.quantities:
+            return self.name
+        return '{}({})'.format(self.name, ', '.join(self.quantities))
+
+    def bind(self, quantity):
+        """return a copy of this reducer (with empty state) applied to `quantity`"""
+        reducer = copy.deepcopy(self)
+        reducer.quantity = quantity
+        reducer.reset()
+        return reducer
+
+    def reset(self):
+        """clear the state"""
+        raise NotImplementedError
+
+    def update(self, data):
+        """update the state with a chunk of data (a dict of arrays)"""
+        self._update(data)
+        return self
+
+    def merge(self, other):
+        """merge the state of `other` (the same reducer applied to other data) into this one"""
+        if type(self) is not type(other) or self.key != other.key:
+            raise ValueError('Cannot merge {} with {}'.format(self.key, other.key))
+        self._merge(other)
+        return self
+
+    def _update(self, data):
+        raise NotImplementedError
+
+    def _merge(self, other):
+        raise NotImplementedError
+
+    def result(self):
+        """return the aggregated result"""
+        raise NotImplementedError
+
+
+class count(Reducer): # pylint: disable=invalid-name
+    """number of rows (that pass the filters)"""
+    name = 'count'
+
+    def __init__(self):
+        super(count, self).__init__()
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+
+    def _update(self, data):
+        if data:
+            self.n += len(next(iter(data.values())))
+
+    def _merge(self, other):
+        self.n += other.n
+
+    def result(self):
+        return self.n
+
+
+class total(Reducer): # pylint: disable=invalid-name
+    """sum of a quantity, ignoring NaN and masked values"""
+    name = 'sum'
+
+    def __init__(self, quantity=None):
+        super(total, self).__init__(quantity)
+        self.reset()
+
+    def reset(self):
+        self.sum = 0
+
+    def _update(self, data):
+        self.sum += _get_finite_values(data, self.quantity).sum()
+
+    def _merge(self, other):
+        self.sum += other.sum
+
+    def result(self):
+        return self.sum
+
+
+class moments(Reducer): # pylint: disable=invalid-name
+    """
+    count, mean and variance of a quantity, ignoring NaN and masked values.
+    Partial results are combined with the parallel algorithm of Chan et al.
+    """
+    name = 'moments'
+
+    def __init__(self, quantity=None):
+        super(moments, self).__init__(quantity)
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def _combine(self, n, mean, m2):
+        if not n:
+            return
+        n_total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / n_total
+        self.m2 += m2 + delta * delta * self.n * n / n_total
+        self.n = n_total
+
+    def _update(self, data):
+        values = _get_finite_values(data, self.quantity).astype(np.float64)
+        if values.size:
+            mean = values.mean()
+            self._combine(values.size, mean, np.square(values - mean).sum())
+
+    def _merge(self, other):
+        self._combine(other.n, other.mean, other.m2)
+
+    def result(self):
+        if not self.n:
+            return {'count': 0, 'mean': np.nan, 'var': np.nan}
+        return {'count': self.n, 'mean': self.mean, 'var': self.m2 / self.n}
+
+
+class mean(moments): # pylint: disable=invalid-name
+    """mean of a quantity, ignoring NaN and masked values"""
+    name = 'mean'
+
+    def result(self):
+        return self.mean if self.n else np.nan
+
+
+class minimum(Reducer): # pylint: disable=invalid-name
+    """minimum of a quantity, ignoring NaN and masked values"""
+    name = 'min'
+    _func = staticmethod(np.minimum)
+
+    def __init__(self, quantity=None):
+        super(minimum, self).__init__(quantity)
+        self.reset()
+
+    def reset(self):
+        self.value = None
+
+    def _combine(self, value):
+        if value is not None:
+            self.value = value if self.value is None else self._func(self.value, value)
+
+    def _update(self, data):
+        values = _get_finite_values(data, self.quantity)
+        if values.size:
+            self._combine(self._func.reduce(values))
+
+    def _merge(self, other):
+        self._combine(other.value)
+
+    def result(self):
+        return self.value
+
+
+class maximum(minimum): # pylint: disable=invalid-name
+    """maximum of a quantity, ignoring NaN and masked values"""
+    name = 'max'
+    _func = staticmethod(np.maximum)
+
+
+class hist(Reducer): # pylint: disable=invalid-name
+    """
+    Histogram of one quantity, or of several quantities (as a tuple) for an N-d histogram.
+    Bins must be fixed in advance: either bin edges, or a number of bins with `range`.
+
+    Parameters
+    ----------
+    quantity : str or tuple of str, optional
+    bins : array_like or int, or a list of those for N-d histograms
+    range : (float, float), or a list of those for N-d histograms, optional
+    weights : str, optional
+        quantity to use as weights
+
+    The result is (counts, bin_edges) for 1-d histograms,
+    and (counts, list_of_bin_edges) for N-d histograms.
+    """
+    name = 'hist'
+
+    def __init__(self, quantity=None, bins=10, range=None, weights=None): # pylint: disable=redefined-builtin
+        super(hist, self).__init__(quantity)
+        self.bins = bins
+        self.range = range
+        self.weights = weights
+        self.edges = None
+        self.counts = None
+        if self.is_bound:
+            self.reset()
+
+    @property
+    def quantities(self):
+        quantities = super(hist, self).quantities
+        if self.weights is not None:
+            quantities.append(self.weights)
+        return quantities
+
+    @property
+    def key(self):
+        quantities = super(hist, self).quantities
+        return '{}({})'.format(self.name, ', '.join(quantities)) if quantities else self.name
+
+    @property
+    def ndim(self):
+        return 1 if is_string_like(self.quantity) else len(self.quantity)
+
+    def reset(self):
+        if self.ndim == 1:
+            self.edges = [self._get_edges(self.bins, self.range)]
+        else:
+            bins = self.bins if np.ndim(self.bins) and len(self.bins) == self.ndim else [self.bins] * self.ndim
+            ranges = self.range if self.range is not None else [None] * self.ndim
+            self.edges = [self._get_edges(b, r) for b, r in zip(bins, ranges)]
+        self.counts = np.zeros(tuple(len(e) - 1 for e in self.edges), dtype=np.float64 if self.weights else np.int64)
+
+    @staticmethod
+    def _get_edges(bins, range_this):
+        if np.ndim(bins):
+            return np.asarray(bins, dtype=np.float64)
+        if range_this is None:
+            raise ValueError('`range` must be set when `bins` is a number of bins')
+        return np.linspace(range_this[0], range_this[1], int(bins) + 1)
+
+    def _update(self, data):
+        quantities = [self.quantity] if self.ndim == 1 else list(self.quantity)
+        if self.weights is not None:
+            quantities.append(self.weights)
+
+        values = [data[q] for q in quantities]
+        mask = np.ones(len(values[0]), dtype=np.bool_)
+        for v in values:
+            mask &= ~np.ma.getmaskarray(v)
+            if v.dtype.kind == 'f':
+                mask &= np.isfinite(v)
+        values = [np.asarray(np.ma.getdata(v))[mask] for v in values]
+        weights = values.pop() if self.weights is not None else None
+
+        if self.ndim == 1:
+            counts, _ = np.histogram(values[0], self.edges[0], weights=weights)
+        else:
+            counts, _ = np.histogramdd(np.stack(values, axis=-1), self.edges, weights=weights)
+        self.counts += counts.astype(self.counts.dtype)
+
+    def _merge(self, other):
+        if len(self.edges) != len(other.edges) or not all(np.array_equal(a, b) for a, b in zip(self.edges, other.edges)):
+            raise ValueError('Cannot merge histograms with different bins')
+        self.counts += other.counts
+
+    def result(self):
+        if self.ndim == 1:
+            return self.counts, self.edges[0]
+        return self.counts, self.edges
+
+
+def bind_reducers(reducers, quantities=None):
+    """
+    return a list of (copies of) `reducers` where the reducers without
+    a quantity are replaced by one reducer for each of `quantities`
+    """
+    bound = []
+    for reducer in reducers:
+        if reducer.is_bound or isinstance(reducer, count):
+            bound.append(copy.deepcopy(reducer))
+        elif not quantities:
+            raise ValueError('Reducer {} needs a quantity'.format(reducer.name))
+        else:
+            bound.extend(reducer.bind(q) for q in quantities)
+    return bound
+
+
+def merge_results(reducer_lists):
+    """
+    merge lists of reducers (e.g., from different processes), element by element;
+    returns the merged reducers (the first list is updated in place)
+    """
+    reducer_lists = list(reducer_lists)
+    merged = reducer_lists[0]
+    for reducers in reducer_lists[1:]:
+        if len(reducers) != len(merged):
+            raise ValueError('Cannot merge different sets of reducers')
+        for reducer, other in zip(merged, reducers):
+            reducer.merge(other)
+    return merged
@@ -3,11 +3,16 @@ Reference Catalog Reader
 """
 import os
 import numpy as np
-from GCR import BaseGenericCatalog
+from .base import BaseCatalog
 
 __all__ = ['ReferenceCatalogReader']
 
-class ReferenceCatalogReader(BaseGenericCatalog):
+
+def _to_bool(x):
+    return x.astype(np.bool)
+
+
+class ReferenceCatalogReader(BaseCatalog):
     """
     Reference Catalog Reader
 
@@ -41,8 +46,8 @@ class ReferenceCatalogReader(BaseGenericCatalog):
             'dec_unsmeared' : 'decJ2000',
             'sigma_ra' : 'sigma_raJ2000',
             'sigma_dec' : 'sigma_decJ2000',
-            'is_agn': (lambda x: x.astype(np.bool), 'isagn'),
-            'is_resolved': (lambda x: x.astype(np.bool), 'isresolved'),
+            'is_agn': (_to_bool, 'isagn'),
+            'is_resolved': (_to_bool, 'isresolved'),
         }
 
         for band in 'ugrizy':
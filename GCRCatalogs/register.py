@@ -1,23 +1,39 @@
 import os
+import json
+import time
 import importlib
+import threading
 import warnings
 import yaml
 import requests
 from GCR import BaseGenericCatalog
+from .utils import get_cache_dir
 
 
-__all__ = ['available_catalogs', 'get_catalog_config', 'get_available_catalogs', 'load_catalog']
+__all__ = ['available_catalogs', 'get_catalog_config', 'get_available_catalogs', 'load_catalog',
+           'set_alias_check']
 
 _CONFIG_DIRNAME = 'catalog_configs'
 _GITHUB_URL = 'https://raw.githubusercontent.com/LSSTDESC/gcr-catalogs/master/GCRCatalogs'
 
+# the online alias check is off unless this environment variable is set (or `set_alias_check` is called)
+_ALIAS_CHECK_ENV = 'GCR_CATALOGS_CHECK_ALIAS'
+_alias_check = {
+    'enabled': bool(os.environ.get(_ALIAS_CHECK_ENV)),
+    'url': _GITHUB_URL,
+    'timeout': 2.0,
+    'ttl': 86400.0,
+}
+_alias_check_threads = dict()
+_alias_check_lock = threading.Lock()
 
-def load_yaml(yaml_file):
+
+def load_yaml(yaml_file, timeout=None):
     """
     Load *yaml_file*. Ruturn a dictionary.
     """
     try:
-        r = requests.get(yaml_file, stream=True)
+        r = requests.get(yaml_file, stream=True, timeout=timeout)
     except (requests.exceptions.MissingSchema, requests.exceptions.URLRequired):
         with open(yaml_file) as f:
             config = yaml.load(f)
@@ -82,6 +98,102 @@ def resolve_config_alias(config_dict, last_alias=None):
     return config_dict
 
 
+def set_alias_check(enabled=True, url=None, timeout=None, ttl=None):
+    """
+    Turn on (or off) the check of whether the alias of a catalog config
+    differs from the online version when the catalog is loaded.
+
+    The check runs on a background thread (so `load_catalog` never waits for
+    the network), gives up after *timeout* seconds, and its result is cached
+    on disk for *ttl* seconds. *url* is the base url of the online package.
+    The check can also be turned on by setting the environment variable
+    `GCR_CATALOGS_CHECK_ALIAS`.
+    """
+    _alias_check['enabled'] = bool(enabled)
+    if url is not None:
+        _alias_check['url'] = url.rstrip('/')
+    if timeout is not None:
+        _alias_check['timeout'] = float(timeout)
+    if ttl is not None:
+        _alias_check['ttl'] = float(ttl)
+
+
+def _get_alias_check_cache_path(catalog_name):
+    cache_dir = get_cache_dir('alias_check')
+    return cache_dir and os.path.join(cache_dir, '{}.json'.format(catalog_name))
+
+
+def _load_alias_check_cache(catalog_name, url):
+    path = _get_alias_check_cache_path(catalog_name)
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (TypeError, IOError, OSError, ValueError):
+        return None
+    if cached.get('url') != url or time.time() - cached.get('time', 0) > _alias_check['ttl']:
+        return None
+    return cached
+
+
+def _save_alias_check_cache(catalog_name, url, online_alias):
+    path = _get_alias_check_cache_path(catalog_name)
+    if not path:
+        return
+    path_tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(path_tmp, 'w') as f:
+            json.dump({'url': url, 'time': time.time(), 'alias': online_alias}, f)
+        os.rename(path_tmp, path)
+    except (IOError, OSError):
+        pass
+
+
+def _warn_if_alias_differs(catalog_name, alias, online_alias):
+    if online_alias is not None and alias != online_alias:
+        warnings.warn('`{}` points to local version `{}`, differs from online version `{}`'.format(
+            catalog_name,
+            alias,
+            online_alias,
+        ))
+
+
+def _fetch_online_alias(catalog_name, alias, url):
+    try:
+        online_config = load_yaml(url, timeout=_alias_check['timeout'])
+    except (requests.RequestException, yaml.error.YAMLError):
+        warnings.warn('Version check skipped. Not able to retrive or load online config file {}'.format(url))
+        online_alias = None
+    else:
+        online_alias = online_config.get('alias') if isinstance(online_config, dict) else None
+    # failures are cached too, so that nodes without network do not retry on every load
+    _save_alias_check_cache(catalog_name, url, online_alias)
+    _warn_if_alias_differs(catalog_name, alias, online_alias)
+
+
+def check_alias_online(catalog_name, alias):
+    """
+    Warn if *alias* (the local alias of *catalog_name*) differs from the online one.
+    Uses the cached result if there is a recent one; otherwise the online
+    config is fetched on a background thread, which is returned (or None).
+    """
+    url = '{}/{}/{}.yaml'.format(_alias_check['url'], _CONFIG_DIRNAME, catalog_name)
+    cached = _load_alias_check_cache(catalog_name, url)
+    if cached is not None:
+        _warn_if_alias_differs(catalog_name, alias, cached.get('alias'))
+        return None
+
+    with _alias_check_lock:
+        thread = _alias_check_threads.get(catalog_name)
+        if thread is not None and thread.is_alive():
+            return thread
+        thread = threading.Thread(target=_fetch_online_alias, args=(catalog_name, alias, url),
+                                  name='GCRCatalogs-alias-check')
+        thread.daemon = True
+        thread.start()
+        _alias_check_threads[catalog_name] = thread
+    return thread
+
+
 def get_catalog_config(catalog):
     """
     get the config dict of *catalog*
@@ -145,19 +257,8 @@ def load_catalog(catalog_name, config_overwrite=None):
     if config.get('alias'):
         if strip_yaml_extension(config.get('alias', '')) == catalog_name:
             raise ValueError('Oops, config {} alias itself!'.format(catalog_name))
-        url = '{}/{}/{}.yaml'.format(_GITHUB_URL, _CONFIG_DIRNAME, catalog_name)
-        try:
-            online_config = load_yaml(url)
-        except (requests.RequestException, yaml.error.YAMLError):
-            warnings.warn('Version check skipped. Not able to retrive or load online config file {}'.format(url))
-        else:
-            if config['alias'] != online_config.get('alias'):
-                warnings.warn('`{}` points to local version `{}`, differs from online version `{}`'.format(
-                    catalog_name,
-                    config['alias'],
-                    online_config.get('alias'),
-                ))
-
+        if _alias_check['enabled']:
+            check_alias_online(catalog_name, config['alias'])
         return load_catalog(config['alias'], config_overwrite)
 
     if config_overwrite:
@@ -0,0 +1,203 @@
+"""
+Size-aware parallel passes over the partitions of a catalog
+
+Native iteration follows the order of the files on disk, so in a parallel
+pass one large file that happens to come last can dominate the wall-clock
+time. `map_partitions` (and `aggregate_partitions`) instead start the
+largest partitions first. Sizes come from the reader (for cosmoDC2, from
+`_cosmoDC2_check.yaml`, or from the files themselves when missing there);
+partitions of unknown size count as the average size.
+
+With threads, the partitions are assigned to the workers up front
+(largest first, each to the least loaded worker), and a worker that runs
+out of partitions steals the smallest remaining one of the most loaded
+worker (see WorkStealingQueue). With processes, the workers take the
+next largest partition from a shared queue.
+
+Both functions also return one PartitionTiming per partition, and
+`format_timings` summarizes them (time per worker, slowest partitions,
+and the imbalance between workers).
+"""
+import os
+import time
+import threading
+import functools
+import multiprocessing
+from collections import deque, namedtuple, OrderedDict
+from .partitions import get_catalog_partitions, get_partition_sizes
+from .reducers import merge_results
+from .sharding import assign_shards
+
+__all__ = ['PartitionTiming', 'WorkStealingQueue', 'map_partitions', 'aggregate_partitions', 'format_timings']
+
+
+PartitionTiming = namedtuple('PartitionTiming', ['index', 'info', 'size', 'worker', 'start', 'elapsed', 'stolen'])
+PartitionTiming.__doc__ = """
+Timing of one partition in a parallel pass: `index` in the list of partitions,
+partition `info`, `size` in bytes (as used for scheduling), `worker` name,
+`start` time (seconds since the start of the pass), `elapsed` seconds, and
+whether the partition was `stolen` from another worker (None with processes).
+"""
+
+
+class WorkStealingQueue(object):
+    """
+    Items of `sizes` assigned to `n_workers` workers, largest first.
+
+    Each worker pops its own items from the largest down; once it has none
+    left, it steals the smallest remaining item of the worker with the most
+    remaining work. Safe to use from several threads.
+    """
+    def __init__(self, sizes, n_workers):
+        self._sizes = list(sizes)
+        self._lock = threading.Lock()
+        self._queues = [deque(sorted(indices, key=lambda i: (-self._sizes[i], i)))
+                        for indices in assign_shards(self._sizes, n_workers)]
+        self._remaining = [sum(self._sizes[i] for i in queue) for queue in self._queues]
+
+    def pop(self, worker):
+        """return (index, stolen) of the next item for `worker`, or None if no items are left"""
+        with self._lock:
+            stolen = not self._queues[worker]
+            if stolen:
+                worker = max(range(len(self._queues)), key=lambda w: (len(self._queues[w]) > 0, self._remaining[w]))
+                if not self._queues[worker]:
+                    return None
+                index = self._queues[worker].pop()
+            else:
+                index = self._queues[worker].popleft()
+            self._remaining[worker] -= self._sizes[index]
+            return index, stolen
+
+
+def _run_partition(func, partition):
+    start = time.time()
+    result = func(partition)
+    return result, start, time.time() - start, 'process-{}'.format(os.getpid())
+
+
+def _map_threads(func, partitions, sizes, n_workers):
+    queue = WorkStealingQueue(sizes, n_workers)
+    results = [None] * len(partitions)
+    timings = [None] * len(partitions)
+    errors = []
+
+    def worker(i):
+        while not errors:
+            item = queue.pop(i)
+            if item is None:
+                return
+            index, stolen = item
+            start = time.time()
+            try:
+                results[index] = func(partitions[index])
+            except BaseException as e: # pylint: disable=broad-except
+                errors.append(e)
+                return
+            timings[index] = (start, time.time() - start, 'thread-{}'.format(i), stolen)
+
+    threads = [threading.Thread(target=worker, args=(i,), name='GCRCatalogs-worker-{}'.format(i))
+               for i in range(n_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results, timings
+
+
+def _map_processes(func, partitions, sizes, n_workers):
+    order = sorted(range(len(partitions)), key=lambda i: (-sizes[i], i))
+    results = [None] * len(partitions)
+    timings = [None] * len(partitions)
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        outputs = pool.imap(functools.partial(_run_partition, func), [partitions[i] for i in order], chunksize=1)
+        for index, (result, start, elapsed, worker) in zip(order, outputs):
+            results[index] = result
+            timings[index] = (start, elapsed, worker, None)
+    finally:
+        pool.close()
+        pool.join()
+    return results, timings
+
+
+def map_partitions(catalog, func, native_filters=None, partition_filter=None, n_workers=None, processes=False):
+    """
+    Call `func(partition)` for each partition (CatalogPartition) of `catalog` that
+    may pass `native_filters` and `partition_filter` (see `get_catalog_partitions`),
+    in `n_workers` threads (default: number of CPUs), or processes if `processes`
+    is True (then `func` must be picklable, e.g. a module-level function),
+    starting with the largest partitions.
+
+    Returns
+    -------
+    results : list
+        return values of `func`, in the order of the partitions
+    timings : list of PartitionTiming
+        in the order of the partitions
+    """
+    partitions = get_catalog_partitions(catalog, native_filters, partition_filter)
+    if not partitions:
+        return [], []
+    sizes = get_partition_sizes(partitions)
+    n_workers = max(1, min(int(n_workers or multiprocessing.cpu_count()), len(partitions)))
+
+    t0 = time.time()
+    run = _map_processes if processes else _map_threads
+    results, timings = run(func, partitions, sizes, n_workers)
+    timings = [PartitionTiming(i, p.info, size, worker, start - t0, elapsed, stolen)
+               for i, (p, size, (start, elapsed, worker, stolen)) in enumerate(zip(partitions, sizes, timings))]
+    return results, timings
+
+
+def _aggregate_partition(quantities, filters, reducers, kwargs, partition):
+    return partition.catalog.aggregate(quantities, filters, reducers, partition.native_filters,
+                                       return_reducers=True, partitions=[partition.key], **kwargs)
+
+
+def aggregate_partitions(catalog, quantities=None, filters=None, reducers=None, native_filters=None,
+                         partition_filter=None, n_workers=None, processes=False, **kwargs):
+    """
+    Same as `catalog.aggregate`, but run over the partitions of `catalog` in
+    parallel (see `map_partitions`). Other keyword arguments are passed to `get_quantities`.
+
+    Returns
+    -------
+    results : dict
+        results keyed by reducer, as returned by `aggregate`
+    timings : list of PartitionTiming
+    """
+    func = functools.partial(_aggregate_partition, quantities, filters, reducers, kwargs)
+    reducer_lists, timings = map_partitions(catalog, func, native_filters, partition_filter, n_workers, processes)
+    if not reducer_lists:
+        raise ValueError('No partitions of this catalog pass `native_filters` and `partition_filter`')
+    return {reducer.key: reducer.result() for reducer in merge_results(reducer_lists)}, timings
+
+
+def format_timings(timings, n_slowest=10):
+    """
+    Return a summary of `timings` (from `map_partitions` or `aggregate_partitions`):
+    busy time per worker, the `n_slowest` partitions, and the imbalance
+    (longest over mean busy time of the workers; 1 is perfectly balanced).
+    """
+    if not timings:
+        return 'no partitions'
+    workers = OrderedDict()
+    for t in sorted(timings, key=lambda t: t.start):
+        workers.setdefault(t.worker, []).append(t)
+    busy = {worker: sum(t.elapsed for t in ts) for worker, ts in workers.items()}
+    wall = max(t.start + t.elapsed for t in timings)
+    mean_busy = sum(busy.values()) / len(busy)
+
+    lines = ['{} partitions, {} workers, {:.2f} s wall time, imbalance {:.2f}'.format(
+        len(timings), len(workers), wall, max(busy.values()) / mean_busy if mean_busy else 1.0)]
+    for worker, ts in workers.items():
+        lines.append('  {:<16} {:>5} partitions ({} stolen), {:>8.2f} s busy, {:>8.2f} s end'.format(
+            worker, len(ts), sum(1 for t in ts if t.stolen), busy[worker], max(t.start + t.elapsed for t in ts)))
+    lines.append('slowest partitions:')
+    for t in sorted(timings, key=lambda t: -t.elapsed)[:n_slowest]:
+        lines.append('  {:>8.2f} s {:>10.1f} MB {:<16} {}'.format(
+            t.elapsed, t.size / 1e6, t.worker, ', '.join('{}={}'.format(k, v) for k, v in sorted(t.info.items()))))
+    return '\n'.join(lines)
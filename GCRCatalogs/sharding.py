@@ -0,0 +1,211 @@
+"""
+Sharding of full-catalog passes over several processes or nodes
+
+`shard_catalog` splits the partitions of a catalog (see
+BaseCatalog.get_partitions; for cosmoDC2, one partition per redshift block
+and healpix file) into shards of about the same size in bytes. The sizes
+come from the reader (for cosmoDC2, from `_cosmoDC2_check.yaml`, or from
+the files themselves when missing there); partitions of unknown size count
+as the average size. Shards can then be
+
+- aggregated in a local process pool (`run_shards`), with the reducers of
+  all shards merged at the end, or
+- written as per-shard catalog configs (`make_shard_configs`), one per node,
+  each selecting the `healpix_pixels` of its shard (configs can only select
+  healpix pixels, so these shards keep all redshift blocks of a pixel together).
+
+Command line usage:
+
+    python -m GCRCatalogs.sharding cosmoDC2_v1.0 8 --output-dir shards
+    python -m GCRCatalogs.sharding cosmoDC2_v1.0 8 --aggregate mag_r redshift --filters "mag_r < 25"
+"""
+from __future__ import print_function
+import os
+import sys
+import heapq
+import argparse
+import multiprocessing
+from collections import OrderedDict
+import yaml
+from .partitions import get_catalog_partitions, get_partition_sizes
+from .reducers import count, mean, minimum, maximum, merge_results
+from .register import get_catalog_config, load_catalog
+
+__all__ = ['Shard', 'assign_shards', 'shard_catalog', 'make_shard_configs', 'run_shards']
+
+
+def assign_shards(sizes, n_shards):
+    """
+    Assign items of `sizes` to `n_shards` shards of about equal total size
+    (largest items first, each to the currently smallest shard).
+    Returns a list of `n_shards` lists of indices into `sizes`.
+    """
+    n_shards = int(n_shards)
+    if n_shards < 1:
+        raise ValueError('`n_shards` must be a positive integer')
+    shards = [[] for _ in range(n_shards)]
+    heap = [(0, i) for i in range(n_shards)]
+    for index in sorted(range(len(sizes)), key=lambda i: (-sizes[i], i)):
+        total, shard = heapq.heappop(heap)
+        shards[shard].append(index)
+        heapq.heappush(heap, (total + sizes[index], shard))
+    return [sorted(shard) for shard in shards]
+
+
+class Shard(object):
+    """
+    A set of partitions (CatalogPartition instances) of one catalog
+    """
+    def __init__(self, partitions):
+        self.partitions = list(partitions)
+
+    def __len__(self):
+        return len(self.partitions)
+
+    @property
+    def keys(self):
+        """partition keys (to pass to `get_quantities` as `partitions`)"""
+        return [p.key for p in self.partitions]
+
+    @property
+    def size(self):
+        """total size in bytes of the partitions of known size"""
+        return sum(p.size or 0 for p in self.partitions)
+
+    @property
+    def healpix_pixels(self):
+        """sorted healpix pixels of the partitions"""
+        return sorted(set(p.info['healpix_pixel'] for p in self.partitions if 'healpix_pixel' in p.info))
+
+    def config_overwrite(self):
+        """config options that select this shard (the partitions must have healpix pixels)"""
+        if any('healpix_pixel' not in p.info for p in self.partitions):
+            raise ValueError('Only shards of healpix partitions can be selected in a config')
+        return {'healpix_pixels': self.healpix_pixels}
+
+    def aggregate(self, quantities=None, filters=None, reducers=None, **kwargs):
+        """
+        run `catalog.aggregate` over the partitions of this shard and return the reducers
+        (other keyword arguments are passed to `get_quantities`)
+        """
+        if not self.partitions:
+            raise ValueError('Cannot aggregate an empty shard')
+        first_partition = self.partitions[0]
+        return first_partition.catalog.aggregate(quantities, filters, reducers, first_partition.native_filters,
+                                                 return_reducers=True, partitions=self.keys, **kwargs)
+
+    def __repr__(self):
+        return 'Shard({} partitions, {:.3g} GB)'.format(len(self), self.size / 1e9)
+
+
+def shard_catalog(catalog, n_shards, native_filters=None, partition_filter=None, by_healpix=False):
+    """
+    Split the partitions of `catalog` that may pass `native_filters` (and
+    `partition_filter`, see `get_catalog_partitions`) into at most `n_shards`
+    Shards of about equal size in bytes. If `by_healpix` is True, all
+    partitions of a healpix pixel are put in the same shard.
+    Returns the non-empty shards, largest first.
+    """
+    partitions = get_catalog_partitions(catalog, native_filters, partition_filter)
+
+    partition_sizes = get_partition_sizes(partitions)
+
+    units = OrderedDict()
+    for i, partition in enumerate(partitions):
+        key = partition.info.get('healpix_pixel', ('partition', i)) if by_healpix else i
+        units.setdefault(key, []).append(i)
+    sizes = [sum(partition_sizes[i] for i in unit) for unit in units.values()]
+    units = [[partitions[i] for i in unit] for unit in units.values()]
+
+    shards = []
+    for indices in assign_shards(sizes, n_shards):
+        if indices:
+            shards.append((sum(sizes[i] for i in indices),
+                           Shard(p for i in indices for p in units[i])))
+    shards.sort(key=lambda s: -s[0])
+    return [shard for _, shard in shards]
+
+
+def make_shard_configs(catalog_name, n_shards, config_overwrite=None):
+    """
+    Return the configs (dicts that can be passed to `load_catalog_from_config_dict`
+    or saved as yaml files) of at most `n_shards` shards of catalog `catalog_name`,
+    each selecting the healpix pixels of one shard.
+    """
+    config = dict(get_catalog_config(catalog_name))
+    config.update(config_overwrite or {})
+    catalog = load_catalog(catalog_name, config_overwrite)
+    return [dict(config, **shard.config_overwrite()) for shard in shard_catalog(catalog, n_shards, by_healpix=True)]
+
+
+def _aggregate_shard(args):
+    shard, quantities, filters, reducers, kwargs = args
+    return shard.aggregate(quantities, filters, reducers, **kwargs)
+
+
+def run_shards(shards, quantities=None, filters=None, reducers=None, processes=None, **kwargs):
+    """
+    Aggregate (see BaseCatalog.aggregate) each of `shards` in a local process pool
+    of `processes` processes (default: one per shard), and merge the reducers.
+    Other keyword arguments are passed to `get_quantities`.
+
+    Returns
+    -------
+    results : dict
+        results keyed by reducer, as returned by `aggregate`
+    """
+    shards = [shard for shard in shards if len(shard)]
+    if not shards:
+        raise ValueError('No shards to run')
+    tasks = [(shard, quantities, filters, reducers, kwargs) for shard in shards]
+    pool = multiprocessing.Pool(processes or len(shards))
+    try:
+        reducer_lists = pool.map(_aggregate_shard, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return {reducer.key: reducer.result() for reducer in merge_results(reducer_lists)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m GCRCatalogs.sharding',
+        description='Split a catalog into shards of about equal size, and write per-shard configs '
+                    'or aggregate quantities over the shards in a local process pool.',
+    )
+    parser.add_argument('catalog', help='catalog name')
+    parser.add_argument('n_shards', type=int, help='number of shards')
+    parser.add_argument('--output-dir', help='write one catalog config (yaml) per shard to this directory')
+    parser.add_argument('--aggregate', nargs='+', metavar='QUANTITY',
+                        help='compute the count, mean, minimum and maximum of these quantities')
+    parser.add_argument('--filters', nargs='+', help='filters (e.g., "mag_r < 25") for --aggregate')
+    parser.add_argument('--processes', type=int, help='number of processes for --aggregate (default: one per shard)')
+    args = parser.parse_args(argv)
+
+    catalog = load_catalog(args.catalog)
+    shards = shard_catalog(catalog, args.n_shards, by_healpix=bool(args.output_dir))
+
+    if args.output_dir:
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        config = get_catalog_config(args.catalog)
+        for i, shard in enumerate(shards):
+            path = os.path.join(args.output_dir, '{}_shard{}of{}.yaml'.format(args.catalog, i + 1, len(shards)))
+            with open(path, 'w') as f:
+                yaml.safe_dump(dict(config, **shard.config_overwrite()), f, default_flow_style=False)
+
+    for i, shard in enumerate(shards):
+        pixels = shard.healpix_pixels
+        print('shard {:>4}: {:>5} partitions, {:>8.2f} GB{}'.format(
+            i + 1, len(shard), shard.size / 1e9,
+            ', healpix pixels {}'.format(pixels) if pixels else ''))
+
+    if args.aggregate:
+        results = run_shards(shards, args.aggregate, args.filters,
+                             [count(), mean(), minimum(), maximum()], args.processes)
+        for key, value in sorted(results.items()):
+            print('{}: {}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,100 @@
+"""
+Catalog snapshots (used by BaseCatalog when `use_snapshot` is set)
+
+Constructing a reader typically lists directories, matches file names and
+reads metadata from the data files. After a successful construction, the
+resulting state (file map, native quantities, quantity info, sky area,
+cosmology, ... as listed in `_snapshot_attributes` of each reader) can be
+saved to the GCRCatalogs cache directory, so that later constructions with
+the same config restore it instead of doing all that work again.
+
+A snapshot is identified by the reader class and a hash of its config, and
+it is only used while the mtimes of the data directories (and of the
+reader's source file) are the same as when it was saved. Adding, removing
+or renaming files changes the directory mtime; files that are rewritten in
+place are not detected, so use `use_snapshot` only for static data.
+"""
+import os
+import sys
+import json
+import pickle
+import hashlib
+import warnings
+from .utils import get_cache_dir
+
+__all__ = ['get_snapshot_path', 'get_mtimes', 'load_snapshot', 'save_snapshot']
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+def _get_class_path(cls):
+    return '{}.{}'.format(cls.__module__, cls.__name__)
+
+
+def get_snapshot_path(cls, config):
+    """
+    return the snapshot path of reader class `cls` with config dict `config`,
+    or None if there is no usable cache directory
+    """
+    cache_dir = get_cache_dir('snapshots')
+    if cache_dir is None:
+        return None
+    config_hash = hashlib.md5(json.dumps(
+        [_get_class_path(cls), config], sort_keys=True, default=repr
+    ).encode()).hexdigest()
+    return os.path.join(cache_dir, '{}_{}.pkl'.format(cls.__name__, config_hash))
+
+
+def get_mtimes(cls, paths):
+    """
+    return {path: mtime} for `paths` and the source file of `cls`,
+    or None if any of them cannot be accessed
+    """
+    paths = list(paths)
+    module = sys.modules.get(cls.__module__)
+    if getattr(module, '__file__', None):
+        paths.append(module.__file__)
+    try:
+        return {os.path.abspath(p): os.path.getmtime(p) for p in paths}
+    except OSError:
+        return None
+
+
+def load_snapshot(path, mtimes):
+    """
+    return the state stored in the snapshot at `path`,
+    or None if there is no snapshot or if `mtimes` have changed
+    """
+    if not path or mtimes is None or not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+        if snapshot.get('format_version') != SNAPSHOT_FORMAT_VERSION or snapshot.get('mtimes') != mtimes:
+            return None
+        return snapshot['state']
+    except Exception: # pylint: disable=broad-except
+        warnings.warn('Cannot load catalog snapshot {}; regenerating it'.format(path))
+        return None
+
+
+def save_snapshot(path, mtimes, state):
+    """write `state` (a dict of attributes) to the snapshot at `path` (atomically)"""
+    if not path or mtimes is None:
+        return
+
+    snapshot = {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'mtimes': mtimes,
+        'state': state,
+    }
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, pickle.PicklingError, TypeError, AttributeError):
+        warnings.warn('Cannot write catalog snapshot {}'.format(path))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -1,9 +1,17 @@
 """
 utility module
 """
+import os
 import hashlib
+import threading
+import numpy as np
 
-__all__ = ['md5', 'is_string_like']
+__all__ = ['md5', 'is_string_like', 'get_cache_dir', 'seeded_uniform', 'sky_boxes_overlap', 'SkyCone']
+
+CACHE_DIR_ENV = 'GCR_CATALOGS_CACHE_DIR'
+
+_SEEDED_UNIFORM_CACHE = dict()
+_SEEDED_UNIFORM_LOCK = threading.Lock()
 
 def md5(fname, chunk_size=65536):
     """
@@ -32,3 +40,99 @@ def first(iterable, default=None):
     returns the first element of `iterable`
     """
     return next(iter(iterable), default)
+
+
+def get_cache_dir(*subdirs):
+    """
+    returns the directory to store GCRCatalogs cache files in (created if needed)
+
+    The base directory is set by the environment variable `GCR_CATALOGS_CACHE_DIR`,
+    and defaults to `~/.cache/GCRCatalogs`. Returns `None` if the directory
+    cannot be created.
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV) or os.path.join(os.path.expanduser('~'), '.cache', 'GCRCatalogs')
+    cache_dir = os.path.join(cache_dir, *subdirs)
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            return None
+    return cache_dir
+
+
+def seeded_uniform(seed, low, high, size):
+    """
+    returns `size` uniform random numbers in [`low`, `high`) drawn with
+    `np.random.RandomState(seed)`, as a read-only array
+
+    A RandomState draws the same leading values whatever the size, so the
+    longest array drawn so far (per seed and range) is kept, and shorter
+    requests are views of it. Safe to call from several threads.
+    """
+    key = (seed, low, high)
+    with _SEEDED_UNIFORM_LOCK:
+        values = _SEEDED_UNIFORM_CACHE.get(key)
+        if values is None or values.size < size:
+            values = np.random.RandomState(seed).uniform(low, high, size)
+            values.flags.writeable = False
+            _SEEDED_UNIFORM_CACHE[key] = values
+    return values[:size]
+
+
+def _intervals_overlap(lo1, hi1, lo2, hi2):
+    return lo1 <= hi2 and lo2 <= hi1
+
+
+def sky_boxes_overlap(box1, box2):
+    """
+    check if two boxes (ra_min, ra_max, dec_min, dec_max), in degrees, overlap;
+    ra can be outside [0, 360) for boxes that cross ra = 0
+    """
+    if not _intervals_overlap(box1[2], box1[3], box2[2], box2[3]):
+        return False
+    return any(_intervals_overlap(box1[0] + shift, box1[1] + shift, box2[0], box2[1])
+               for shift in (-360.0, 0.0, 360.0))
+
+
+class SkyCone(object):
+    """
+    A cone on the sky, centered at (`ra`, `dec`) with `radius`, all in degrees.
+
+    Can be used in (native) filters as `(SkyCone(ra, dec, radius), 'ra', 'dec')`.
+    Readers that support spatial pruning use `overlaps_box` to skip partitions.
+    """
+    def __init__(self, ra, dec, radius):
+        self.ra = float(ra)
+        self.dec = float(dec)
+        self.radius = float(radius)
+
+    def __call__(self, ra, dec):
+        ra = np.deg2rad(ra)
+        dec = np.deg2rad(dec)
+        ra0 = np.deg2rad(self.ra)
+        dec0 = np.deg2rad(self.dec)
+        # haversine formula
+        hav = np.sin(0.5 * (dec - dec0))**2 + np.cos(dec) * np.cos(dec0) * np.sin(0.5 * (ra - ra0))**2
+        return hav <= np.sin(0.5 * np.deg2rad(self.radius))**2
+
+    @property
+    def bounds(self):
+        """
+        (ra_min, ra_max, dec_min, dec_max) of the bounding box of this cone.
+        ra_min and ra_max can be outside [0, 360) when the cone crosses ra = 0.
+        """
+        dec_min = max(self.dec - self.radius, -90.0)
+        dec_max = min(self.dec + self.radius, 90.0)
+        if dec_min == -90.0 or dec_max == 90.0:
+            return 0.0, 360.0, dec_min, dec_max
+        half_width = np.rad2deg(np.arcsin(min(
+            np.sin(np.deg2rad(self.radius)) / np.cos(np.deg2rad(self.dec)),
+            1.0,
+        )))
+        return self.ra - half_width, self.ra + half_width, dec_min, dec_max
+
+    def overlaps_box(self, ra_min, ra_max, dec_min, dec_max):
+        """
+        check (conservatively) if this cone overlaps with the given box (in degrees)
+        """
+        return sky_boxes_overlap(self.bounds, (ra_min, ra_max, dec_min, dec_max))
@@ -29,7 +29,7 @@ setup(
     ],
     keywords='GCR',
     packages=['GCRCatalogs'],
-    install_requires=['future', 'requests', 'pyyaml', 'numpy', 'astropy', 'GCR>=0.8.3'],
+    install_requires=['future', 'requests', 'pyyaml', 'numpy', 'astropy', 'GCR>=0.9.0'],
     extras_require={
         'protodc2': ['h5py'],
         'cosmodc2': ['h5py', 'healpy'],
@@ -38,7 +38,9 @@ setup(
         'dc1': ['sqlalchemy', 'pymssql'],
         'dc2_coadd': ['tables', 'pandas'],
         'focal_plane': ['scikit-image', 'pandas'],
-        'full': ['h5py', 'sqlalchemy', 'pymssql', 'pandas', 'tables', 'scikit-image', 'healpy'],
+        'crossmatch': ['scipy'],
+        'dask': ['dask[dataframe]', 'pandas'],
+        'full': ['h5py', 'sqlalchemy', 'pymssql', 'pandas', 'tables', 'scikit-image', 'healpy', 'scipy'],
     },
     package_data={'GCRCatalogs': ['catalog_configs/*.yaml']},
 )
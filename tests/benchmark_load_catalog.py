@@ -0,0 +1,71 @@
+"""
+Benchmark of catalog construction time (`load_catalog`) for each reader.
+
+Run from the tests directory:
+
+    python benchmark_load_catalog.py [catalog_name ...]
+
+Without arguments, all registered catalogs whose data are accessible here are
+timed (one catalog per reader class), plus the DC2 object test catalog.
+The first load includes building the (cached) quantity-modifier tables;
+the following loads show the per-instance cost only.
+"""
+from __future__ import print_function
+import sys
+import time
+import warnings
+
+import GCRCatalogs
+from GCRCatalogs.register import get_available_catalogs
+
+REPEAT = 5
+DC2_TEST_CATALOG = ('dc2_object_run1.1p_tract4850', {
+    'base_dir': 'dc2_object_data',
+    'filename_pattern': 'test_object_tract_4850.hdf5',
+})
+
+
+def time_load(catalog_name, config_overwrite=None, repeat=REPEAT):
+    """return the time of the first load and the best time of `repeat` further loads"""
+    times = []
+    for _ in range(repeat + 1):
+        t0 = time.time()
+        GCRCatalogs.load_catalog(catalog_name, config_overwrite)
+        times.append(time.time() - t0)
+    return times[0], min(times[1:])
+
+
+def get_catalogs_to_benchmark():
+    """one catalog per reader class, plus the DC2 object test catalog"""
+    catalogs = [DC2_TEST_CATALOG]
+    readers = set()
+    for name, config in sorted(get_available_catalogs(False).items()):
+        reader = config.get('subclass_name')
+        if reader and reader not in readers:
+            readers.add(reader)
+            catalogs.append((name, None))
+    return catalogs
+
+
+def main(catalog_names=None):
+    if catalog_names:
+        catalogs = [DC2_TEST_CATALOG if name == DC2_TEST_CATALOG[0] else (name, None) for name in catalog_names]
+    else:
+        catalogs = get_catalogs_to_benchmark()
+    print('{:<45} {:<45} {:>10} {:>10}'.format('catalog', 'reader', 'first (s)', 'next (s)'))
+    for name, config_overwrite in catalogs:
+        reader = GCRCatalogs.get_catalog_config(name).get('subclass_name', '')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            try:
+                first, best = time_load(name, config_overwrite)
+            except Exception as e: # pylint: disable=broad-except
+                if catalog_names:
+                    raise
+                print('{:<45} {:<45} skipped ({})'.format(name, reader, type(e).__name__))
+                continue
+        print('{:<45} {:<45} {:>10.4f} {:>10.4f}'.format(name, reader, first, best))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,41 @@
+"""
+Fixtures shared by several test modules
+"""
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from GCRCatalogs.register import load_catalog_from_config_dict
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    """Keep the cache files (manifests, join indices, snapshots) of each test in its own temporary directory"""
+    path = str(tmpdir.join('gcr_catalogs_cache'))
+    monkeypatch.setenv('GCR_CATALOGS_CACHE_DIR', path)
+    return path
+
+
+@pytest.fixture
+def healpix_catalog(tmpdir, request):
+    """
+    A small cosmoDC2-like add-on catalog with files of different sizes;
+    parametrize indirectly with a dict of (redshift block lower edge, healpix pixel): number of rows
+    """
+    root_dir = str(tmpdir)
+    for (zlo, hpx), n in request.param.items():
+        filename = 'z_{}_{}.addon.healpix_{}.hdf5'.format(zlo, zlo + 1, hpx)
+        with h5py.File(os.path.join(root_dir, filename), 'w') as fh:
+            fh['addon/galaxy_id'] = np.arange(n) + hpx * 10000
+            fh['addon/addon_value'] = np.full(n, hpx, dtype=np.float64)
+    return load_catalog_from_config_dict({
+        'subclass_name': 'cosmodc2.CosmoDC2AddonCatalog',
+        'catalog_root_dir': root_dir,
+        'catalog_filename_template': 'z_{}_{}.addon.healpix_{}.hdf5',
+        'addon_group': 'addon',
+        'catalog_name': 'addon',
+        'check_md5': False, 'check_size': False, 'check_version': False, 'check_cosmology': False,
+        'check_file_list_complete': False,
+    })
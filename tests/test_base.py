@@ -0,0 +1,179 @@
+"""
+Tests for the reading helpers in GCRCatalogs.base and GCRCatalogs.buffers
+"""
+import h5py
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+import GCRCatalogs
+from GCRCatalogs.base import BaseCatalog, NativeChunk, memmap_dataset, read_rows, get_row_runs
+from GCRCatalogs.buffers import scratch, clear_scratch_buffers, readonly
+
+
+def test_memmap_reads(tmpdir):
+    """Verify that contiguous datasets are memory-mapped (read-only),
+    and that other datasets fall back to regular reads
+    """
+    values = np.arange(100, dtype='>f8')
+    path = str(tmpdir.join('data.hdf5'))
+    with h5py.File(path, 'w') as fh:
+        fh['contiguous'] = values
+        fh.create_dataset('chunked', data=values, chunks=(10,))
+        fh.create_dataset('compressed', data=values, compression='gzip')
+        fh.create_dataset('empty', shape=(0,), dtype='f8')
+
+    rows = np.array([0, 1, 2, 50, 99])
+    with h5py.File(path, 'r') as fh:
+        data = memmap_dataset(fh['contiguous'])
+        assert isinstance(data, np.ndarray) and not data.flags.writeable
+        assert_array_equal(data, values)
+        for name in ('chunked', 'compressed', 'empty'):
+            assert memmap_dataset(fh[name]) is None
+        assert memmap_dataset(values) is None
+
+        for name in ('contiguous', 'chunked', 'compressed'):
+            assert_array_equal(read_rows(fh[name], use_memmap=True), values)
+            assert_array_equal(read_rows(fh[name], rows, use_memmap=True), values[rows])
+        assert not read_rows(fh['contiguous'], use_memmap=True).flags.writeable
+        assert read_rows(fh['contiguous']).flags.writeable
+
+    with h5py.File(path, 'r', driver='core') as fh:
+        assert memmap_dataset(fh['contiguous']) is None
+
+
+def test_read_rows_dtype(tmpdir):
+    """Verify that read_rows converts values while reading"""
+    values = np.arange(100, dtype='>f8')
+    path = str(tmpdir.join('data.hdf5'))
+    with h5py.File(path, 'w') as fh:
+        fh['contiguous'] = values
+        fh.create_dataset('chunked', data=values, chunks=(10,))
+
+    rows = np.array([0, 1, 2, 50, 99])
+    with h5py.File(path, 'r') as fh:
+        for name in ('contiguous', 'chunked'):
+            for use_memmap in (False, True):
+                for dtype in (np.float32, lambda native_dtype: np.float32):
+                    data = read_rows(fh[name], use_memmap=use_memmap, dtype=dtype)
+                    assert data.dtype == np.float32
+                    assert_array_equal(data, values)
+                    data = read_rows(fh[name], rows, use_memmap=use_memmap, dtype=dtype)
+                    assert data.dtype == np.float32
+                    assert_array_equal(data, values[rows])
+            assert read_rows(fh[name], np.array([], dtype=np.int64), dtype=np.float32).dtype == np.float32
+            assert read_rows(fh[name], dtype=lambda native_dtype: None).dtype == values.dtype
+
+
+def test_native_chunk_sample():
+    """Verify that rows are sampled independently unless a block size is requested"""
+    chunk = NativeChunk(lambda native_quantity, rows: rows, 100000, max_row_runs=256)
+    rows = chunk.sample(0.01, np.random.RandomState(1))('x')
+    assert len(rows) == pytest.approx(1000, rel=0.15)
+    assert len(get_row_runs(rows)) > 900
+    rows = chunk.sample(0.01, np.random.RandomState(1), 'auto')('x')
+    assert 0 < len(get_row_runs(rows)) < 2 * 256
+    rows = chunk.sample(0.01, np.random.RandomState(1), 10)('x')
+    assert all(stop - start >= 10 for start, stop in get_row_runs(rows))
+
+
+def test_scratch_buffers():
+    """Verify that scratch buffers are reused, but not while they are in use"""
+    with scratch(10) as tmp:
+        address = tmp.__array_interface__['data'][0]
+        with scratch(10) as tmp2:
+            assert tmp2.__array_interface__['data'][0] != address
+    with scratch((2, 5)) as tmp:
+        assert tmp.shape == (2, 5)
+        assert tmp.__array_interface__['data'][0] in (address, tmp2.__array_interface__['data'][0])
+    with scratch(10, np.float32) as tmp:
+        assert tmp.dtype == np.float32
+    clear_scratch_buffers()
+
+
+def test_readonly_modifier_inputs():
+    """Verify that modifiers cannot modify (shared) native quantities"""
+    def modify_in_place(ra):
+        ra += 1.0
+        return ra
+
+    gc = GCRCatalogs.load_catalog('dc2_object_run1.1p_tract4850', {
+        'base_dir': 'dc2_object_data',
+        'filename_pattern': 'test_object_tract_4850.hdf5',
+    })
+    gc._quantity_modifiers['ra_plus_one'] = (modify_in_place, 'coord_ra')  # pylint: disable=protected-access
+    with pytest.raises(ValueError):
+        gc.get_quantities(['ra', 'ra_plus_one'])
+    ra = gc['ra']
+    assert_array_equal(ra, np.rad2deg(gc['coord_ra']))
+    ra_readonly = readonly(ra)
+    assert not ra_readonly.flags.writeable and ra.flags.writeable
+    assert readonly(ra_readonly) is ra_readonly
+
+
+class ChunkCatalog(BaseCatalog):
+    """A catalog of 5 chunks (without native partitions) that counts the chunks it generates"""
+    def _subclass_init(self, **kwargs):
+        self.chunks_generated = 0
+
+    def _generate_native_quantity_list(self):
+        return {'x'}
+
+    def _iter_native_dataset(self, native_filters=None):
+        for i in range(5):
+            self.chunks_generated += 1
+            yield lambda native_quantity, i=i: np.arange(3) + 3 * i
+
+
+class DtypeCatalog(BaseCatalog):
+    """A catalog of one NativeChunk that records the dtypes its native quantities are read in"""
+    def _subclass_init(self, **kwargs):
+        self.read_dtypes = {}
+        self._quantity_modifiers = {
+            'x': None,
+            'y': 'y_native',
+            'y_plus_x': (np.add, 'y_native', 'x'),
+            'i': None,
+        }
+
+    def _generate_native_quantity_list(self):
+        return {'x', 'y_native', 'i'}
+
+    def _iter_native_dataset(self, native_filters=None):
+        data = {'x': np.arange(10, dtype=np.float64), 'y_native': np.linspace(0, 1, 10), 'i': np.arange(10)}
+        def read(native_quantity, rows=None, dtype=None):
+            self.read_dtypes[native_quantity] = dtype
+            values = data[native_quantity] if rows is None else data[native_quantity][rows]
+            return values if dtype is None else values.astype(dtype(values.dtype) or values.dtype)
+        yield NativeChunk(read, 10)
+
+
+def test_read_time_dtype_policy():
+    """Verify that plain aliases are converted while reading, and other quantities after assembly"""
+    gc = DtypeCatalog(dtype_policy='compact', compact_dtypes={'i': 'int16'})
+    data = gc.get_quantities(['x', 'y', 'i'])
+    assert (data['x'].dtype, data['y'].dtype, data['i'].dtype) == (np.float32, np.float32, np.int16)
+    assert set(gc.read_dtypes) == {'x', 'y_native', 'i'} and all(gc.read_dtypes.values())
+
+    # native quantities also used by modifiers or filters are read as they are
+    gc.read_dtypes.clear()
+    data = gc.get_quantities(['y', 'y_plus_x'], filters=['x > 4.5'])
+    assert gc.read_dtypes == {'x': None, 'y_native': None}
+    assert_array_equal(data['y_plus_x'], (np.linspace(0, 1, 10) + np.arange(10))[5:].astype(np.float32))
+    assert data['y'].dtype == data['y_plus_x'].dtype == np.float32
+
+    gc = DtypeCatalog()
+    assert gc.get_quantities(['x'])['x'].dtype == np.float64
+    assert gc.read_dtypes == {'x': None}
+
+
+def test_chunk_partitions():
+    """Verify that reading chunk partitions stops after the last requested chunk"""
+    gc = ChunkCatalog()
+    keys = [key for key, _ in gc.get_partitions()]
+    assert keys == [('chunk', i) for i in range(5)]
+    gc.chunks_generated = 0
+    assert_array_equal(gc.get_quantities(['x'], partitions=[keys[1]])['x'], [3, 4, 5])
+    assert gc.chunks_generated == 2
+    assert_array_equal(gc.get_quantities(['x'], partitions=[keys[3], keys[0]])['x'], [0, 1, 2, 9, 10, 11])
+    assert gc.chunks_generated == 6
@@ -0,0 +1,33 @@
+"""
+Tests for the Buzzard reader
+"""
+import numpy as np
+from numpy.testing import assert_array_equal
+from astropy.io import fits
+
+from GCRCatalogs.buzzard import BuzzardGalaxyCatalog
+
+
+def test_partitions(tmpdir):
+    """Verify that healpix pixels are native partitions, read without going through the other files"""
+    for healpix, nrows in ((1, 3), (5, 4), (8, 2)):
+        columns = [fits.Column(name='ID', format='K', array=np.arange(nrows) + healpix * 100),
+                   fits.Column(name='RA', format='D', array=np.full(nrows, float(healpix)))]
+        fits.BinTableHDU.from_columns(columns).writeto(str(tmpdir.join('truth.{}.fits'.format(healpix))))
+    gc = BuzzardGalaxyCatalog(catalog_root_dir=str(tmpdir), catalog_path_template={'truth': 'truth.{}.fits'},
+                              cosmology={'H0': 70.0, 'Om0': 0.3})
+
+    partitions = gc.get_partitions()
+    assert partitions == [(('partition', 1), {'healpix_pixel': 1}), (('partition', 5), {'healpix_pixel': 5}),
+                          (('partition', 8), {'healpix_pixel': 8})]
+    assert gc.get_partition_size(('partition', 5)) == tmpdir.join('truth.5.fits').size()
+    assert gc.get_partitions(['healpix_pixel > 1']) == partitions[1:]
+
+    opened = []
+    open_dataset = gc._open_dataset # pylint: disable=protected-access
+    gc._open_dataset = lambda healpix, subset: opened.append(healpix) or open_dataset(healpix, subset)
+    data = gc.get_quantities(['truth/ID', 'healpix_pixel'], partitions=[('partition', 8)])
+    assert_array_equal(data['truth/ID'], [800, 801])
+    assert_array_equal(data['healpix_pixel'], 8)
+    assert set(opened) == {8}
+    assert_array_equal(gc.get_quantities(['truth/ID'])['truth/ID'], [100, 101, 102, 500, 501, 502, 503, 800, 801])
@@ -0,0 +1,46 @@
+"""
+Tests for categorical (dictionary-encoded) string columns
+"""
+import numpy as np
+from numpy.testing import assert_array_equal
+import pandas as pd
+from GCR import GCRQuery
+
+from GCRCatalogs.categorical import CategoricalArray, concatenate_categorical
+from GCRCatalogs.query import CompiledQuery, convert_string_comparisons
+
+
+def test_categorical_array():
+    """Verify encoding, comparisons, masking and concatenation"""
+    values = np.array(['sed_b', 'sed_a', 'sed_b', 'sed_c'])
+    cat = CategoricalArray.encode(values)
+    assert_array_equal(cat.decode(), values)
+    assert_array_equal(cat == 'sed_b', values == 'sed_b')
+    assert_array_equal(cat != 'sed_x', np.ones(4, dtype=bool))
+    assert_array_equal(cat.isin(['sed_a', 'sed_c']), [False, True, False, True])
+    assert_array_equal(cat[cat == 'sed_b'].decode(), ['sed_b', 'sed_b'])
+
+    pandas_cat = CategoricalArray.from_pandas(pd.Series(['x', None, 'y'], dtype='category'))
+    assert_array_equal(pandas_cat.decode(missing='?'), ['x', '?', 'y'])
+    assert_array_equal(pandas_cat == 'zzz', [False, False, False])
+    assert_array_equal(pandas_cat != 'zzz', [True, True, True])
+    assert_array_equal(pandas_cat == 'y', [False, False, True])
+
+    constant = CategoricalArray.constant('3,1', 5)
+    assert constant.strides == (0,)
+    merged = concatenate_categorical([cat, constant, pandas_cat])
+    assert_array_equal(merged.decode(), list(values) + ['3,1'] * 5 + ['x', '', 'y'])
+    assert concatenate_categorical([constant, CategoricalArray.constant('3,1', 2)]).strides == (0,)
+
+
+def test_categorical_filters():
+    """Verify that string filters on categorical quantities run on the codes"""
+    values = np.array(['a', 'b', 'b', 'c'])
+    data = {'sed': CategoricalArray.encode(values), 'x': np.arange(4)}
+    query = GCRQuery("sed == 'b'", 'x > 1') | GCRQuery((lambda s: s == 'c', 'sed')) | "'a' != sed"
+    query = convert_string_comparisons(query)
+    assert set(query.variable_names) == {'sed', 'x'}
+    assert_array_equal(CompiledQuery(query).mask(data), [False, True, True, True])
+
+    data['sed'] = values
+    assert_array_equal(CompiledQuery(query).mask(data), [False, True, True, True])
@@ -0,0 +1,157 @@
+"""
+Tests for Composite Reader
+"""
+import os
+import pickle
+
+import h5py
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+from GCRCatalogs.register import load_catalog_from_config_dict
+from GCRCatalogs.composite import count_rows
+
+# pylint: disable=redefined-outer-name
+@pytest.fixture
+def object_config(tmpdir):
+    """Config of the test DC2 object catalog"""
+    return {'subclass_name': 'dc2_object.DC2ObjectCatalog',
+            'base_dir': 'dc2_object_data',
+            'filename_pattern': 'test_object_tract_4850.hdf5',
+            'manifest_path': str(tmpdir.join('manifest.json'))}
+
+
+def make_healpix_catalog(root_dir, group, healpix_pixels, nrows=5):
+    """Write a small cosmoDC2-like add-on catalog and return its config"""
+    os.makedirs(root_dir)
+    for hpx in healpix_pixels:
+        with h5py.File(os.path.join(root_dir, 'z_0_1.{}.healpix_{}.hdf5'.format(group, hpx)), 'w') as fh:
+            fh['{}/galaxy_id'.format(group)] = np.arange(nrows) + hpx * 1000
+            fh['{}/{}_value'.format(group, group)] = np.full(nrows, hpx, dtype=np.float64)
+    return {'subclass_name': 'cosmodc2.CosmoDC2AddonCatalog',
+            'catalog_root_dir': root_dir,
+            'catalog_filename_template': 'z_{}_{}.%s.healpix_{}.hdf5' % group,
+            'addon_group': group,
+            'catalog_name': group,
+            'check_md5': False, 'check_size': False, 'check_version': False, 'check_cosmology': False}
+
+
+def test_format_matching(tmpdir):
+    """Verify that catalogs with matching formats are iterated by the main catalog's partitions"""
+    main_config = make_healpix_catalog(str(tmpdir.join('main')), 'main', [100, 101, 102])
+    addon_config = make_healpix_catalog(str(tmpdir.join('addon')), 'addon', [100, 101, 102, 103])
+    gc = load_catalog_from_config_dict({
+        'subclass_name': 'composite.CompositeReader',
+        'catalogs': [main_config, addon_config],
+    })
+    data = gc.get_quantities([('main', 'galaxy_id'), ('addon', 'galaxy_id'), 'addon_value'],
+                             native_filters=['healpix_pixel >= 101'])
+    assert_array_equal(data[('main', 'galaxy_id')], data[('addon', 'galaxy_id')])
+    assert_array_equal(data['addon_value'], np.repeat([101, 102], 5))
+
+    gc = load_catalog_from_config_dict({
+        'subclass_name': 'composite.CompositeReader',
+        'catalogs': [addon_config, main_config],
+    })
+    with pytest.raises(ValueError):
+        gc.get_quantities(['main_value'])
+    assert len(gc.get_quantities(['main_value'], native_filters=['healpix_pixel < 103'])['main_value']) == 15
+
+    gc = pickle.loads(pickle.dumps(gc))
+    assert len(gc.get_quantities(['main_value'], native_filters=['healpix_pixel < 103'])['main_value']) == 15
+
+    short_config = make_healpix_catalog(str(tmpdir.join('short')), 'short', [100, 101, 102], nrows=4)
+    gc = load_catalog_from_config_dict({
+        'subclass_name': 'composite.CompositeReader',
+        'catalogs': [main_config, short_config],
+    })
+    with pytest.raises(ValueError):
+        gc.get_quantities(['short_value'])
+
+
+def test_column_matching(object_config, tmpdir, monkeypatch):
+    """Verify that column matching gives the matched rows,
+    and that the join index is saved and reused
+    """
+    monkeypatch.setenv('GCR_CATALOGS_CACHE_DIR', str(tmpdir.join('cache')))
+    main_config = dict(object_config, catalog_name='main', matching_method='id')
+    other_config = dict(object_config, catalog_name='other', matching_method='id')
+    gc = load_catalog_from_config_dict({
+        'subclass_name': 'composite.CompositeReader',
+        'catalogs': [main_config, other_config],
+    })
+    data = gc.get_quantities([('main', 'id'), ('other', 'id'), ('other', 'coord_ra'), ('main', 'coord_ra')])
+    assert_array_equal(data[('main', 'id')], data[('other', 'id')])
+    assert_array_equal(data[('main', 'coord_ra')], data[('other', 'coord_ra')])
+
+    join_index_files = os.listdir(str(tmpdir.join('cache', 'composite')))
+    assert len(join_index_files) == 1
+    sorter = np.load(str(tmpdir.join('cache', 'composite', join_index_files[0])))
+    assert_array_equal(np.sort(sorter), np.arange(len(data[('main', 'id')])))
+
+    ra = np.rad2deg(data[('main', 'coord_ra')])
+    data = gc.get_quantities([('other', 'coord_ra')], filters=[(lambda x: x > 55.6, 'ra')])
+    assert_array_equal(np.rad2deg(data[('other', 'coord_ra')]), ra[ra > 55.6])
+
+
+def test_column_matching_stream(tmpdir):
+    """Verify that the larger side of a column matching is streamed,
+    and that no columns are kept after a query
+    """
+    main_config = make_healpix_catalog(str(tmpdir.join('main')), 'main', [100, 101, 105])
+    addon_config = dict(make_healpix_catalog(str(tmpdir.join('addon')), 'addon', [100, 101, 102, 103], nrows=8),
+                        matching_method='galaxy_id')
+    results = dict()
+    for stream in ('auto', 'main', 'matched'):
+        gc = load_catalog_from_config_dict({
+            'subclass_name': 'composite.CompositeReader',
+            'catalogs': [main_config, dict(addon_config, matching_stream=stream)],
+            'use_join_index_cache': False,
+        })
+        spec = gc._catalogs[1] # pylint: disable=protected-access
+        data = gc.get_quantities([('main', 'galaxy_id'), ('addon', 'galaxy_id'), 'addon_value'],
+                                 native_filters=['healpix_pixel >= 101'])
+        assert spec.streams_matched(gc.main) == (stream != 'main')
+        assert not spec.column_cache._data and spec._joined is None # pylint: disable=protected-access
+        assert_array_equal(data[('main', 'galaxy_id')], np.concatenate([np.arange(5) + 101000, np.arange(5) + 105000]))
+        assert_array_equal(data[('addon', 'galaxy_id')].mask, np.repeat([False, True], 5))
+        assert_array_equal(data[('addon', 'galaxy_id')].compressed(), np.arange(5) + 101000)
+        assert_array_equal(data['addon_value'].compressed(), np.full(5, 101))
+        results[stream] = data
+
+        data = gc.get_quantities(['addon_value'], filters=['main_value < 105'])
+        assert_array_equal(data['addon_value'], np.repeat([100, 101], 5))
+
+    for key, value in results['main'].items():
+        assert_array_equal(results['matched'][key], value)
+
+    with pytest.raises(ValueError):
+        load_catalog_from_config_dict({
+            'subclass_name': 'composite.CompositeReader',
+            'catalogs': [main_config, dict(addon_config, matching_stream='left')],
+        })
+
+
+def test_count_rows(tmpdir):
+    """Verify that rows are only counted from chunks that know their lengths"""
+    gc = load_catalog_from_config_dict(make_healpix_catalog(str(tmpdir.join('main')), 'main', [100, 101]))
+    assert count_rows(gc) == 10
+    gc._iter_native_dataset = lambda native_filters=None: iter([lambda q: np.arange(3)]) # pylint: disable=protected-access
+    assert count_rows(gc) is None
+
+
+def test_position_matching(object_config):
+    """Verify that matching a catalog to itself by position gives the same rows"""
+    main_config = dict(object_config, catalog_name='main')
+    other_config = dict(object_config, catalog_name='other', matching_method='MATCHING_POSITION',
+                        matching_radius=0.1)
+    gc = load_catalog_from_config_dict({
+        'subclass_name': 'composite.CompositeReader',
+        'catalogs': [main_config, other_config],
+    })
+    data = gc.get_quantities([('main', 'id'), ('other', 'id')])
+    assert_array_equal(data[('main', 'id')], data[('other', 'id')])
+
+    data = gc.get_quantities([('main', 'id'), ('other', 'id')], filters=['ra > 55.6'])
+    assert_array_equal(data[('main', 'id')], data[('other', 'id')])
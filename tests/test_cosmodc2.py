@@ -0,0 +1,120 @@
+"""
+Tests for the cosmoDC2 readers
+"""
+import os
+import pickle
+
+import h5py
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+from GCRCatalogs.register import load_catalog_from_config_dict
+from GCRCatalogs.cosmodc2 import CosmoDC2GalaxyCatalog, load_file_check_info
+
+ROW_POSITION_QUANTITIES = ('position_angle_true', 'ellipticity_1_true', 'ellipticity_2_true')
+
+# pylint: disable=redefined-outer-name
+@pytest.fixture
+def morphology_catalog(tmpdir):
+    """A cosmoDC2-like add-on catalog (two files) with the modifiers of the row-position quantities"""
+    root_dir = str(tmpdir)
+    rng = np.random.RandomState(0)
+    for hpx, nrows in ((100, 1000), (101, 600)):
+        with h5py.File(os.path.join(root_dir, 'z_0_1.galaxyProperties.healpix_{}.hdf5'.format(hpx)), 'w') as fh:
+            fh['galaxyProperties/galaxyID'] = np.arange(nrows) + hpx * 10000
+            fh['galaxyProperties/morphology/positionAngle'] = np.zeros(nrows)
+            fh['galaxyProperties/morphology/totalEllipticity'] = rng.uniform(0, 0.5, nrows)
+    gc = load_catalog_from_config_dict({
+        'subclass_name': 'cosmodc2.CosmoDC2AddonCatalog',
+        'catalog_root_dir': root_dir,
+        'catalog_filename_template': 'z_{}_{}.galaxyProperties.healpix_{}.hdf5',
+        'addon_group': 'galaxyProperties',
+        'catalog_name': 'morphology',
+        'check_md5': False, 'check_size': False, 'check_version': False, 'check_cosmology': False,
+    })
+    modifiers = CosmoDC2GalaxyCatalog._generate_static_quantity_modifiers('1.1.4') # pylint: disable=protected-access
+    for quantity in ROW_POSITION_QUANTITIES + ('galaxy_id',):
+        gc.add_quantity_modifier(quantity, modifiers[quantity])
+    return gc
+
+
+def test_row_position_filters(morphology_catalog):
+    """Verify that row-position quantities of a galaxy do not depend on the filters"""
+    gc = morphology_catalog
+    quantities = list(ROW_POSITION_QUANTITIES)
+    full = gc.get_quantities(quantities + ['galaxy_id'])
+    # one seeded draw per file, as in a full read of each file
+    assert_array_equal(full['position_angle_true'][:1000], np.random.RandomState(123497).uniform(0, 180, 1000))
+    assert_array_equal(full['position_angle_true'][1000:], np.random.RandomState(123497).uniform(0, 180, 600))
+    for galaxy_id_min in (1000900, 1000500):  # selective (late materialization) and not
+        mask = full['galaxy_id'] > galaxy_id_min
+        data = gc.get_quantities(quantities, filters=['galaxy_id > {}'.format(galaxy_id_min)])
+        for q in quantities:
+            assert_array_equal(data[q], full[q][mask])
+
+    # filter on one row-position quantity, output another one
+    mask = full['ellipticity_1_true'] > 0.3
+    data = gc.get_quantities(['ellipticity_2_true', 'position_angle_true'], filters=['ellipticity_1_true > 0.3'])
+    assert mask.sum() < 0.25 * mask.size
+    assert_array_equal(data['ellipticity_2_true'], full['ellipticity_2_true'][mask])
+    assert_array_equal(data['position_angle_true'], full['position_angle_true'][mask])
+
+
+def test_row_position_sample(morphology_catalog):
+    """Verify that sampled galaxies have the same row-position quantities as in a full read"""
+    gc = morphology_catalog
+    quantities = list(ROW_POSITION_QUANTITIES)
+    full = gc.get_quantities(quantities + ['galaxy_id'])
+    for sample_block_size in (None, 'auto', 7):
+        data = gc.get_quantities(quantities + ['galaxy_id'], sample=0.1, sample_seed=1,
+                                 sample_block_size=sample_block_size)
+        assert 0 < len(data['galaxy_id']) < 0.5 * len(full['galaxy_id'])
+        rows = np.searchsorted(full['galaxy_id'], data['galaxy_id'])
+        assert_array_equal(full['galaxy_id'][rows], data['galaxy_id'])
+        for q in quantities:
+            assert_array_equal(data[q], full[q][rows])
+
+
+def test_row_position_chunk_rows(morphology_catalog):
+    """Verify that rechunking does not change row-position quantities"""
+    gc = morphology_catalog
+    quantities = list(ROW_POSITION_QUANTITIES)
+    full = gc.get_quantities(quantities)
+    for kwargs in ({'chunk_rows': 300}, {'chunk_rows': 700}, {'chunk_bytes': 4096}):
+        chunks = list(gc.get_quantities(quantities, return_iterator=True, **kwargs))
+        assert len(chunks) > 2
+        for q in quantities:
+            assert_array_equal(np.concatenate([chunk[q] for chunk in chunks]), full[q])
+
+    mask = full['ellipticity_1_true'] > 0.1
+    data = gc.get_quantities(['position_angle_true'], filters=['ellipticity_1_true > 0.1'], chunk_rows=300)
+    assert_array_equal(data['position_angle_true'], full['position_angle_true'][mask])
+
+
+def test_memmap_option(morphology_catalog):
+    """Verify that quantities are writable unless `use_memmap` is set"""
+    gc = morphology_catalog
+    for native_filters in (['healpix_pixel == 100'], None):
+        assert gc.get_quantities(['galaxy_id'], native_filters=native_filters)['galaxy_id'].flags.writeable
+
+    gc = load_catalog_from_config_dict(dict(gc.get_catalog_info(), use_memmap=True))
+    data = gc.get_quantities(['galaxyID'], native_filters=['healpix_pixel == 100'])
+    assert not data['galaxyID'].flags.writeable
+    assert_array_equal(data['galaxyID'], np.arange(1000) + 1000000)
+
+
+def test_snapshot_without_file_check_info(morphology_catalog, cache_dir):
+    """Verify that snapshots do not include the file check table, which is loaded when needed"""
+    config = dict(morphology_catalog.get_catalog_info(), use_snapshot=True, version='1.0.0')
+    load_catalog_from_config_dict(config)
+    snapshots = os.listdir(os.path.join(cache_dir, 'snapshots'))
+    assert len(snapshots) == 1
+    with open(os.path.join(cache_dir, 'snapshots', snapshots[0]), 'rb') as f:
+        state = pickle.load(f)['state']
+    assert 'version' in state
+    assert 'file_check_info' not in state and '_file_check_info' not in state
+
+    gc = load_catalog_from_config_dict(config)
+    assert gc.file_check_info == load_file_check_info('1.0.0') != {}
+    assert gc.get_partition_size(('partition', (0, 100))) == os.path.getsize(gc._healpix_files[(0, 100)]) # pylint: disable=protected-access
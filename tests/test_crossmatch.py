@@ -0,0 +1,28 @@
+"""
+Tests for positional cross-matching
+"""
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+
+from GCRCatalogs.crossmatch import match_nearest, get_sky_bounds, boxes_overlap
+
+
+def test_match_nearest():
+    """Verify nearest-neighbour matching within a radius, across ra = 0"""
+    ra2 = np.array([0.0, 359.9995, 10.0, 180.0])
+    dec2 = np.array([0.0, 0.0, 45.0, -89.9999])
+    ra1 = np.array([359.9999, 10.0002, 123.0, 0.0])
+    dec1 = np.array([0.0, 45.0, 0.0, -89.9999])
+    idx, sep = match_nearest(ra1, dec1, ra2, dec2, 1.0/3600.0)
+    assert_array_equal(idx, [0, 2, -1, 3])
+    assert_allclose(sep[:2], [0.0001, 0.0002 * np.cos(np.deg2rad(45.0))], rtol=1e-3)
+    assert np.isinf(sep[2])
+
+
+def test_sky_bounds_overlap():
+    """Verify that boxes crossing ra = 0 overlap correctly"""
+    box = get_sky_bounds([359.9, 0.1], [0.0, 0.0], margin=0.01)
+    assert box[0] < 0.1 and box[1] > 359.9
+    assert boxes_overlap((-0.5, 0.5, -1, 1), (359.0, 360.0, -1, 1))
+    assert not boxes_overlap((10, 20, -1, 1), (30, 40, -1, 1))
+    assert not boxes_overlap((10, 20, -1, 1), (np.nan,) * 4)
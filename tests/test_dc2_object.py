@@ -2,19 +2,31 @@
 Tests for DC2 Object Reader
 """
 
+import pickle
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from numpy.testing import assert_array_equal
 import pytest
 
 import GCRCatalogs
+from GCRCatalogs.dc2_object import HDFStorePool, TableWrapper
+from GCRCatalogs.base import prefetch_iter
+from GCRCatalogs.categorical import CategoricalArray
+from GCRCatalogs.partitions import get_catalog_partitions, to_dask_dataframe
+from GCRCatalogs.reducers import count, hist, mean, moments, merge_results
+from GCRCatalogs.utils import SkyCone
 
 # pylint: disable=redefined-outer-name
 @pytest.fixture(scope='module')
 def load_dc2_catalog():
     """Convenience function to provide catalog"""
     reader = 'dc2_object_run1.1p_tract4850.yaml'
+    # shared by the tests of this module, so it does not use the per-test cache directory
     config = {'base_dir': 'dc2_object_data',
-              'filename_pattern': 'test_object_tract_4850.hdf5'}
+              'filename_pattern': 'test_object_tract_4850.hdf5',
+              'use_manifest': False}
     return GCRCatalogs.load_catalog(reader, config)
 
 
@@ -53,3 +65,375 @@ def test_get_tract_patch(load_dc2_catalog):
 
     assert_array_equal(tract_col, np.repeat(tract, len(gc)))
     assert_array_equal(patch_col, np.repeat(patch, len(gc)))
+
+
+def test_dataset_manifest(tmpdir):
+    """Verify that the dataset manifest is written once and then reused.
+
+    No file handle should be opened when the catalog is constructed
+    from a valid manifest, even without a schema file.
+    """
+    reader = 'dc2_object_run1.1p_tract4850.yaml'
+    manifest_path = str(tmpdir.join('manifest.json'))
+    config = {'base_dir': 'dc2_object_data',
+              'filename_pattern': 'test_object_tract_4850.hdf5',
+              'schema_path': '',
+              'manifest_path': manifest_path}
+
+    gc = GCRCatalogs.load_catalog(reader, config)
+    assert tmpdir.join('manifest.json').check(file=1)
+    del gc
+
+    gc = GCRCatalogs.load_catalog(reader, config)
+    assert not gc._file_handles  # pylint: disable=protected-access
+    assert gc.available_tracts_and_patches == [{'tract': 4850, 'patch': '3,1'}]
+    assert gc.has_quantity('i_mag')
+
+    ra = gc['ra']
+    assert len(ra) == 10
+
+
+def test_snapshot(tmpdir, monkeypatch):
+    """Verify that a catalog snapshot is restored without scanning the data directory,
+    and that it is regenerated when files are added to the data directory.
+    """
+    monkeypatch.setenv('GCR_CATALOGS_CACHE_DIR', str(tmpdir.join('cache')))
+    base_dir = tmpdir.mkdir('data')
+    shutil.copy('dc2_object_data/test_object_tract_4850.hdf5', str(base_dir.join('object_tract_4850.hdf5')))
+    shutil.copy('dc2_object_data/schema.yaml', str(base_dir.join('schema.yaml')))
+    reader = 'dc2_object_run1.1p_tract4850.yaml'
+    config = {'base_dir': str(base_dir), 'filename_pattern': r'object_tract_\d+\.hdf5$', 'use_snapshot': True}
+
+    gc = GCRCatalogs.load_catalog(reader, config)
+    expected = gc.get_quantities(['ra', 'mag_i', 'patch'])
+    quantities = sorted(gc.list_all_quantities(True))
+
+    def fail(*args, **kwargs):
+        raise AssertionError('data directory should not be scanned')
+    monkeypatch.setattr(GCRCatalogs.dc2_object.DC2ObjectCatalog, '_generate_datasets', fail)
+    gc = GCRCatalogs.load_catalog(reader, config)
+    assert sorted(gc.list_all_quantities(True)) == quantities
+    assert gc.get_quantity_info('psFlux_i')['unit'] == 'nmgy'
+    data = gc.get_quantities(['ra', 'mag_i', 'patch'])
+    for q in expected:
+        assert_array_equal(data[q], expected[q])
+
+    monkeypatch.undo()
+    monkeypatch.setenv('GCR_CATALOGS_CACHE_DIR', str(tmpdir.join('cache')))
+    shutil.copy('dc2_object_data/test_object_tract_4850.hdf5', str(base_dir.join('object_tract_4851.hdf5')))
+    gc = GCRCatalogs.load_catalog(reader, config)
+    assert len(gc) == 2 * len(expected['ra'])
+
+
+def test_file_handle_pool(tmpdir):
+    """Verify that the pool closes the least recently used store first,
+    and that a table wrapper reopens its file after its store was closed.
+    """
+    paths = []
+    for i in range(3):
+        path = str(tmpdir.join('object_tract_{}.hdf5'.format(i)))
+        shutil.copy('dc2_object_data/test_object_tract_4850.hdf5', path)
+        paths.append(path)
+
+    pool = HDFStorePool(max_open_files=2)
+    table = TableWrapper(paths[0], '/coadd_4850_31', file_opener=pool.open)
+    assert 'coord_ra' in table
+
+    fh0 = pool.open(paths[0])
+    pool.open(paths[1])
+    pool.open(paths[0])
+    pool.open(paths[2])
+    assert len(pool) == 2
+    assert paths[1] not in pool
+    assert fh0.is_open
+
+    pool.open(paths[1])
+    assert not fh0.is_open
+
+    assert len(table['coord_ra']) == 10
+    assert len(pool) == 2
+    pool.close_all()
+    assert not pool
+
+
+def test_sky_pruning(tmpdir):
+    """Verify that ra/dec native filters and filters skip non-overlapping patches,
+    and that ra/dec native filters are applied to rows of overlapping patches.
+    """
+    reader = 'dc2_object_run1.1p_tract4850.yaml'
+    config = {'base_dir': 'dc2_object_data',
+              'filename_pattern': 'test_object_tract_4850.hdf5',
+              'manifest_path': str(tmpdir.join('manifest.json'))}
+    gc = GCRCatalogs.load_catalog(reader, config)
+    ra_all = gc['ra']
+    gc.clear_cache()
+
+    data = gc.get_quantities(['ra'], native_filters=['ra > 55.6'])
+    assert_array_equal(data['ra'], ra_all[ra_all > 55.6])
+
+    # bounding boxes are now in the manifest; a new instance reads no data
+    gc = GCRCatalogs.load_catalog(reader, config)
+    assert not len(gc.get_quantities(['ra'], native_filters=['ra > 56'])['ra'])
+    assert not len(gc.get_quantities(['ra'], filters=['dec < -30'])['ra'])
+    cone = (SkyCone(50.0, -29.6, 1.0), 'ra', 'dec')
+    assert not len(gc.get_quantities(['ra'], native_filters=[cone])['ra'])
+    assert gc._datasets[0]._cache is None  # pylint: disable=protected-access
+
+    cone = (SkyCone(55.6, -29.624, 0.05), 'ra', 'dec')
+    ra, dec = ra_all, gc['dec']
+    data = gc.get_quantities(['ra'], native_filters=[cone])
+    assert_array_equal(data['ra'], ra[cone[0](ra, dec)])
+
+
+def test_sample(tmpdir):
+    """Verify that `sample` returns a reproducible subset of rows,
+    read with start/stop reads of the selected rows only.
+    """
+    reader = 'dc2_object_run1.1p_tract4850.yaml'
+    config = {'base_dir': 'dc2_object_data',
+              'filename_pattern': 'test_object_tract_4850.hdf5',
+              'manifest_path': str(tmpdir.join('manifest.json')),
+              'use_cache': False}
+    gc = GCRCatalogs.load_catalog(reader, config)
+    data_all = gc.get_quantities(['ra', 'tract', 'patch'])
+
+    data = gc.get_quantities(['ra', 'tract', 'patch'], sample=0.5, sample_seed=1)
+    assert 0 < len(data['ra']) < len(data_all['ra'])
+    assert np.in1d(data['ra'], data_all['ra']).all()
+    assert (data['tract'] == 4850).all()
+    assert len(data['patch']) == len(data['ra'])
+    assert_array_equal(data['ra'], gc.get_quantities(['ra'], sample=0.5, sample_seed=1)['ra'])
+
+    data = gc.get_quantities(['ra'], filters=['ra > 55.6'], sample=1)
+    assert_array_equal(data['ra'], data_all['ra'][data_all['ra'] > 55.6])
+
+    with pytest.raises(ValueError):
+        gc.get_quantities(['ra'], sample=0)
+
+
+def test_prefetch(load_dc2_catalog):
+    """Verify that prefetching returns the same chunks, and propagates errors"""
+    gc = load_dc2_catalog
+    quantities = ['ra', 'dec', 'tract', 'patch']
+    chunks = list(gc.get_quantities(quantities, return_iterator=True))
+    chunks_prefetched = list(gc.get_quantities(quantities, return_iterator=True, prefetch=2))
+    assert len(chunks) == len(chunks_prefetched)
+    for chunk, chunk_prefetched in zip(chunks, chunks_prefetched):
+        for q in quantities:
+            assert_array_equal(chunk[q], chunk_prefetched[q])
+
+    it = gc.get_quantities(quantities, return_iterator=True, prefetch=1)
+    next(it)
+    it.close()
+
+    def getter_with_error(native_quantity):
+        raise IOError(native_quantity)
+    with pytest.raises(IOError):
+        list(prefetch_iter(getter_with_error, ['ra', 'dec']))
+
+
+def test_aggregate(load_dc2_catalog):
+    """Verify that streaming aggregates match the results on the full data"""
+    gc = load_dc2_catalog
+    ra = gc['ra']
+    bins = np.linspace(55.5, 55.8, 7)
+    results = gc.aggregate('ra', reducers=[hist(bins=bins), mean(), count()])
+    assert_array_equal(results['hist(ra)'][0], np.histogram(ra, bins)[0])
+    assert np.isclose(results['mean(ra)'], ra.mean())
+    assert results['count'] == len(ra)
+
+    results = gc.aggregate(filters=['ra > 55.6'])
+    assert results['count'] == (ra > 55.6).sum()
+
+    half = gc.aggregate(reducers=[moments('ra')], filters=['ra > 55.6'], return_reducers=True)
+    other_half = gc.aggregate(reducers=[moments('ra')], filters=['ra <= 55.6'], return_reducers=True)
+    result = merge_results([half, other_half])[0].result()
+    assert result['count'] == len(ra)
+    assert np.isclose(result['mean'], ra.mean())
+    assert np.isclose(result['var'], ra.var())
+
+
+def test_two_phase_read(load_dc2_catalog, monkeypatch):
+    """Verify that output quantities are only read for the rows that pass selective filters"""
+    gc = load_dc2_catalog
+    ra, dec = gc['ra'], gc['dec']
+    cut = np.sort(ra)[len(ra) // 10]
+
+    rows_requested = []
+    read = TableWrapper.read
+    def read_and_record(self, key, rows=None):
+        if key == 'coord_dec':
+            rows_requested.append(rows)
+        return read(self, key, rows)
+    monkeypatch.setattr(TableWrapper, 'read', read_and_record)
+
+    data = gc.get_quantities(['dec'], filters=['ra < {}'.format(cut)])
+    assert_array_equal(data['dec'], dec[ra < cut])
+    assert rows_requested and all(rows is not None for rows in rows_requested)
+
+    del rows_requested[:]
+    data = gc.get_quantities(['dec'], filters=['ra >= {}'.format(cut)])
+    assert_array_equal(data['dec'], dec[ra >= cut])
+    assert all(rows is None for rows in rows_requested)
+
+
+def test_dtype_policy():
+    """Verify that quantities are returned in the dtypes set by dtype_policy and dtype_overrides"""
+    reader = 'dc2_object_run1.1p_tract4850.yaml'
+    config = {'base_dir': 'dc2_object_data',
+              'filename_pattern': 'test_object_tract_4850.hdf5',
+              'dtype_policy': 'compact',
+              'dtype_overrides': {'dec': 'float64'}}
+    gc = GCRCatalogs.load_catalog(reader, config)
+    data = gc.get_quantities(['ra', 'dec', 'tract'], filters=['ra > 0'])
+    assert data['ra'].dtype == np.float32
+    assert data['dec'].dtype == np.float64
+    assert data['tract'].dtype == np.int32
+    assert_array_equal(data['tract'], 4850)
+
+    # dtypes do not depend on the values of each chunk
+    for chunk in gc.get_quantities(['ra', 'dec', 'tract', 'id'], return_iterator=True, chunk_rows=3):
+        assert chunk['ra'].dtype == np.float32
+        assert chunk['dec'].dtype == np.float64
+        assert chunk['tract'].dtype == np.int32
+        assert chunk['id'].dtype == gc.get_quantities(['id'])['id'].dtype
+
+    gc = GCRCatalogs.load_catalog(reader, dict(config, compact_dtypes={'id': 'int32'}))
+    assert gc.get_quantities(['id'], filters=['ra > 0'])['id'].dtype == np.int32
+
+    with pytest.raises(ValueError):
+        GCRCatalogs.load_catalog(reader, dict(config, dtype_policy='float16'))
+
+
+def test_constant_columns(load_dc2_catalog):
+    """Verify that per-chunk constant columns are returned as zero-stride arrays"""
+    gc = load_dc2_catalog
+    data = gc.get_quantities(['tract', 'patch', 'g_parent', 'ra'], filters=['tract == 4850', 'ra > 0'])
+    for q in ('tract', 'patch', 'g_parent'):
+        assert data[q].strides == (0,)
+        assert len(data[q]) == len(data['ra'])
+    assert_array_equal(data['patch'], '3,1')
+
+    ra_max = gc['ra'].max()
+    data = gc.get_quantities(['tract', 'ra'], filters=['ra < {}'.format(ra_max)])
+    assert data['tract'].strides == (0,)
+    assert len(data['tract']) == len(data['ra']) == len(gc) - 1
+
+
+def test_categorical_strings():
+    """Verify that `patch` is returned as a CategoricalArray that can be filtered on"""
+    reader = 'dc2_object_run1.1p_tract4850.yaml'
+    config = {'base_dir': 'dc2_object_data',
+              'filename_pattern': 'test_object_tract_4850.hdf5',
+              'categorical_strings': True}
+    gc = GCRCatalogs.load_catalog(reader, config)
+    patch = gc.get_quantities(['patch'], filters=["patch == '3,1'"])['patch']
+    assert isinstance(patch, CategoricalArray)
+    assert len(patch) == len(gc)
+    assert_array_equal(patch.decode(), '3,1')
+    assert not len(gc.get_quantities(['ra'], filters=["patch != '3,1'"])['ra'])
+
+
+def test_chunk_rows(load_dc2_catalog):
+    """Verify that chunks are re-sliced to the requested size"""
+    gc = load_dc2_catalog
+    ra = gc['ra']
+
+    chunks = list(gc.get_quantities(['ra', 'tract'], return_iterator=True, chunk_rows=3))
+    assert [len(chunk['ra']) for chunk in chunks] == [3, 3, 3, 1]
+    assert_array_equal(np.concatenate([chunk['ra'] for chunk in chunks]), ra)
+
+    chunks = list(gc.get_quantities(['ra'], filters=['ra > 0'], return_iterator=True, chunk_bytes=16))
+    assert [len(chunk['ra']) for chunk in chunks] == [2] * 5
+
+    assert_array_equal(gc.get_quantities(['ra'], chunk_rows=100)['ra'], ra)
+    with pytest.raises(ValueError):
+        gc.get_quantities(['ra'], chunk_rows=0)
+
+
+def test_cached_modifiers(load_dc2_catalog):
+    """Modifier tables are cached across instances, but each instance gets its own copy"""
+    gc = load_dc2_catalog
+    reader = 'dc2_object_run1.1p_tract4850.yaml'
+    config = {'base_dir': 'dc2_object_data',
+              'filename_pattern': 'test_object_tract_4850.hdf5'}
+    gc2 = GCRCatalogs.load_catalog(reader, config)
+
+    assert gc2._quantity_modifiers == gc._quantity_modifiers # pylint: disable=protected-access
+    gc2.add_quantity_modifier('ra_copy', 'ra')
+    assert 'ra_copy' not in gc.list_all_quantities()
+    assert gc2.get_quantity_info('psFlux_g') == gc.get_quantity_info('psFlux_g') is not None
+
+
+def test_pickle(load_dc2_catalog):
+    """Verify that a pickled catalog does not carry open file handles or cached data,
+    and reopens its files when read
+    """
+    gc = load_dc2_catalog
+    ra = gc['ra']
+    assert gc._file_handles  # pylint: disable=protected-access
+
+    gc2 = pickle.loads(pickle.dumps(gc))
+    assert not gc2._file_handles  # pylint: disable=protected-access
+    assert all(dataset._cache is None for dataset in gc2._datasets)  # pylint: disable=protected-access
+    assert_array_equal(gc2['ra'], ra)
+    assert_array_equal(gc2['mag_i_cModel'], gc['mag_i_cModel'])
+    assert gc2._file_handles  # pylint: disable=protected-access
+
+
+def test_threaded_reads(tmpdir):
+    """Verify that one catalog can be read from several threads at once"""
+    reader = 'dc2_object_run1.1p_tract4850.yaml'
+    config = {'base_dir': 'dc2_object_data',
+              'filename_pattern': 'test_object_tract_4850.hdf5',
+              'manifest_path': str(tmpdir.join('manifest.json')),
+              'use_cache': False,
+              'max_open_files': 1}
+    gc = GCRCatalogs.load_catalog(reader, config)
+    quantities = ['ra', 'dec', 'mag_i_cModel', 'patch']
+
+    # each thread reads different rows of the same tables
+    def read_sample(seed):
+        return gc.get_quantities(quantities, sample=0.5, sample_seed=seed, chunk_rows=100)
+
+    seeds = list(range(8))
+    expected = [read_sample(seed) for seed in seeds]
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(read_sample, seeds * 4))
+
+    for i, data in enumerate(results):
+        for q in quantities:
+            assert_array_equal(data[q], expected[i % len(seeds)][q])
+
+
+def test_partitions(load_dc2_catalog):
+    """Verify that partitions carry tract/patch info, can be pruned, and read lazily"""
+    gc = load_dc2_catalog
+    partitions = get_catalog_partitions(gc)
+    assert [p.info for p in partitions] == [{'tract': 4850, 'patch': '3,1'}]
+    assert not get_catalog_partitions(gc, native_filters=['tract == 4851'])
+    assert not get_catalog_partitions(gc, partition_filter=lambda info: info['patch'] == '0,0')
+
+    data_all = gc.get_quantities(['ra', 'patch'])
+    partition = pickle.loads(pickle.dumps(partitions[0]))
+    data = partition.read(['ra', 'patch'])
+    assert_array_equal(data['ra'], data_all['ra'])
+    assert_array_equal(data['patch'], data_all['patch'])
+
+    # ra/dec native filters are applied to the rows of each tract/patch
+    partitions = get_catalog_partitions(gc, native_filters=['ra > 55.6'])
+    assert [p.key for p in partitions] == [('partition', (4850, '3,1'))]
+    assert_array_equal(partitions[0].read(['ra'])['ra'], data_all['ra'][data_all['ra'] > 55.6])
+    assert not get_catalog_partitions(gc, native_filters=['ra > 80'])
+
+
+def test_dask_dataframe(load_dc2_catalog):
+    """Verify that a catalog can be read as a dask DataFrame"""
+    pytest.importorskip('dask.dataframe')
+    gc = load_dc2_catalog
+    ddf = to_dask_dataframe(gc, ['ra', 'mag_i_cModel'], filters=['mag_i_cModel < 24'])
+    assert ddf.npartitions == 1
+    df = ddf.compute(scheduler='sync')
+    data = gc.get_quantities(['ra', 'mag_i_cModel'], filters=['mag_i_cModel < 24'])
+    assert_array_equal(df['ra'].values, data['ra'])
+    assert_array_equal(df['mag_i_cModel'].values, data['mag_i_cModel'])
@@ -0,0 +1,27 @@
+"""
+Tests for the DC2 truth catalog readers
+"""
+import sqlite3
+
+import numpy as np
+import pytest
+
+from GCRCatalogs.dc2_truth import DC2TruthCatalogReader
+
+
+def test_sample(tmpdir):
+    """Verify that rows are sampled independently of each other and between seeds"""
+    filename = str(tmpdir.join('truth.db'))
+    nrows = 20000
+    with sqlite3.connect(filename) as conn:
+        conn.execute('CREATE TABLE truth (object_id i8, value f8)')
+        conn.executemany('INSERT INTO truth VALUES (?, ?)', ((i, 0.5 * i) for i in range(nrows)))
+    gc = DC2TruthCatalogReader(filename=filename, is_static=False)
+
+    ids = {seed: gc.get_quantities(['object_id'], sample=0.1, sample_seed=seed)['object_id'] for seed in (1, 2)}
+    for selected in ids.values():
+        assert len(selected) == pytest.approx(0.1 * nrows, rel=0.1)
+        # a periodic selection would have a near-constant spacing between selected rows
+        assert np.std(np.diff(selected)) == pytest.approx(np.mean(np.diff(selected)), rel=0.1)
+    assert len(np.intersect1d(ids[1], ids[2])) == pytest.approx(0.01 * nrows, rel=0.3)
+    np.testing.assert_array_equal(gc.get_quantities(['object_id'], sample=0.1, sample_seed=1)['object_id'], ids[1])
@@ -0,0 +1,48 @@
+"""
+Tests for compiled filter evaluation
+"""
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+from GCR import GCRQuery
+
+import GCRCatalogs
+from GCRCatalogs.query import CompiledQuery, StringComparison, convert_string_comparisons
+
+
+def test_compiled_query():
+    """Verify that compiled queries give the same masks as GCRQuery"""
+    rng = np.random.RandomState(0)
+    data = {'a': rng.rand(1000), 'b': rng.rand(1000), 'c': rng.randint(0, 10, 1000)}
+    queries = [
+        GCRQuery('a < 0.5', 'b > 0.2', 'c != 3'),
+        GCRQuery('a < 0.1', (np.greater, 'b', 'a'), 'c > 2'),
+        GCRQuery('a < 0.5') | GCRQuery((lambda c: c == 3, 'c')) | 'b > 0.99',
+        ~GCRQuery('a < 0.5', (lambda b: b > 0.5, 'b')),
+        GCRQuery('a < 0.5') ^ GCRQuery('b < 0.5'),
+        (GCRQuery('a < 0.01') | 'b < 0.01') & ~GCRQuery((np.isnan, 'a')),
+        GCRQuery('a > 2', (np.isfinite, 'b')),
+    ]
+    for query in queries:
+        assert_array_equal(CompiledQuery(query).mask(data), query.mask(data))
+
+    assert CompiledQuery(GCRQuery()).mask(data) is None
+
+
+def test_string_comparisons():
+    """Verify that only whole single string comparisons are converted"""
+    converted = convert_string_comparisons(["patch == '3,1'", '"2,2" != patch', 'a < 1'])
+    assert isinstance(converted[0][0], StringComparison) and converted[0][1] == 'patch'
+    assert converted[0][0].value == '3,1' and converted[0][0].equal
+    assert converted[1][0].value == '2,2' and not converted[1][0].equal
+    assert converted[2] == 'a < 1'
+    compound = "patch == '3,1' | patch == '2,2'"
+    assert convert_string_comparisons(compound) == compound
+
+    gc = GCRCatalogs.load_catalog('dc2_object_run1.1p_tract4850.yaml',
+                                  {'base_dir': 'dc2_object_data',
+                                   'filename_pattern': 'test_object_tract_4850.hdf5'})
+    query = GCRQuery("patch == '3,1'") | "patch == '2,2'"
+    assert len(gc.get_quantities(['patch'], filters=query)['patch']) == 10
+    with pytest.raises(TypeError):
+        gc.get_quantities(['patch'], filters=[compound])
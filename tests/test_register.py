@@ -0,0 +1,68 @@
+"""
+Tests for the online alias check of load_catalog
+"""
+import os
+import json
+import threading
+import warnings
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+from GCRCatalogs import register
+
+
+# pylint: disable=redefined-outer-name
+@pytest.fixture
+def alias_check(tmpdir, monkeypatch):
+    """Serve online configs from a local HTTP server, and cache results in `tmpdir`"""
+    monkeypatch.setenv('GCR_CATALOGS_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.setattr(register, '_alias_check', dict(register._alias_check)) # pylint: disable=protected-access
+
+    config_dir = tmpdir.mkdir('online').mkdir('catalog_configs')
+    config_dir.join('my_catalog.yaml').write('alias: my_catalog_v2\n')
+
+    handler = partial(SimpleHTTPRequestHandler, directory=str(tmpdir.join('online')))
+    handler.log_message = lambda *args: None
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    register.set_alias_check(url='http://127.0.0.1:{}'.format(server.server_address[1]), timeout=5, ttl=3600)
+    yield tmpdir
+    server.shutdown()
+    server.server_close()
+
+
+def test_alias_check(alias_check):
+    """Verify that the check runs in the background, warns, and is cached"""
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        thread = register.check_alias_online('my_catalog', 'my_catalog_v1')
+        assert thread is not None
+        thread.join(10)
+    assert any('differs from online version `my_catalog_v2`' in str(x.message) for x in w)
+
+    cache_path = os.path.join(str(alias_check.join('cache')), 'alias_check', 'my_catalog.json')
+    with open(cache_path) as f:
+        assert json.load(f)['alias'] == 'my_catalog_v2'
+
+    # a cached result is used without any request
+    alias_check.join('online', 'catalog_configs', 'my_catalog.yaml').remove()
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        assert register.check_alias_online('my_catalog', 'my_catalog_v1') is None
+    assert any('my_catalog_v2' in str(x.message) for x in w)
+
+    assert register.check_alias_online('my_catalog', 'my_catalog_v2') is None
+
+
+def test_alias_check_failure(alias_check):
+    """Verify that failed checks only warn, and are cached too"""
+    with pytest.warns(UserWarning, match='Version check skipped'):
+        register.check_alias_online('no_such_catalog', 'whatever').join(10)
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        assert register.check_alias_online('no_such_catalog', 'whatever') is None
+    assert not w
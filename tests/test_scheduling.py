@@ -0,0 +1,55 @@
+"""
+Tests for size-aware parallel passes
+"""
+import pytest
+
+from GCRCatalogs.reducers import count, mean
+from GCRCatalogs.scheduling import WorkStealingQueue, map_partitions, aggregate_partitions, format_timings
+
+# files of different sizes, all in the first redshift block
+FILE_ROWS = {(0, 100): 500, (0, 101): 4000, (0, 102): 1000, (0, 103): 2000}
+
+
+def test_work_stealing_queue():
+    """Verify that workers start with their largest items and steal the smallest ones"""
+    queue = WorkStealingQueue([1, 8, 2, 5, 3], 2)
+    assert queue.pop(0) == (1, False)
+    assert queue.pop(1) == (3, False)
+    assert queue.pop(1) == (4, False)
+    assert queue.pop(1) == (0, False)
+    assert queue.pop(1) == (2, True)
+    assert queue.pop(0) is None
+
+    queue = WorkStealingQueue([4, 3, 2, 1], 2)
+    assert queue.pop(0) == (0, False)
+    assert queue.pop(0) == (3, False)
+    assert queue.pop(0) == (2, True)
+    assert queue.pop(0) == (1, True)
+    assert queue.pop(1) is None
+
+
+@pytest.mark.parametrize('healpix_catalog', [FILE_ROWS], indirect=True)
+def test_map_partitions(healpix_catalog):
+    """Verify results, order, and timings of a threaded pass"""
+    gc = healpix_catalog
+    results, timings = map_partitions(gc, lambda p: len(p.read(['addon_value'])['addon_value']), n_workers=2)
+    assert results == [500, 4000, 1000, 2000]
+    assert [t.info['healpix_pixel'] for t in timings] == [100, 101, 102, 103]
+    assert timings[1].size == max(t.size for t in timings)
+    assert all(t.elapsed >= 0 for t in timings)
+    assert '4 partitions' in format_timings(timings)
+
+
+@pytest.mark.parametrize('healpix_catalog', [FILE_ROWS], indirect=True)
+def test_aggregate_partitions(healpix_catalog):
+    """Verify that parallel aggregates equal serial aggregates"""
+    gc = healpix_catalog
+    reducers = [count(), mean()]
+    expected = gc.aggregate(['addon_value'], ['addon_value > 100'], reducers)
+    for processes in (False, True):
+        results, timings = aggregate_partitions(gc, ['addon_value'], ['addon_value > 100'], reducers,
+                                                n_workers=2, processes=processes)
+        assert len(timings) == 4
+        assert set(results) == set(expected)
+        for key, value in expected.items():
+            assert results[key] == pytest.approx(value)
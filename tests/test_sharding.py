@@ -0,0 +1,55 @@
+"""
+Tests for catalog sharding
+"""
+import pytest
+
+from GCRCatalogs.reducers import count, mean, maximum
+from GCRCatalogs.sharding import assign_shards, shard_catalog, run_shards
+
+# files of different sizes in two redshift blocks; healpix pixel 101 has a file in both
+FILE_ROWS = {(0, 100): 4000, (0, 101): 1000, (1, 101): 1000, (0, 102): 2000, (1, 103): 500, (1, 104): 1500}
+
+
+def test_assign_shards():
+    """Verify that items are balanced over shards"""
+    shards = assign_shards([5, 1, 4, 2, 3, 3], 2)
+    assert sorted(sum(shards, [])) == list(range(6))
+    assert sorted(sum([5, 1, 4, 2, 3, 3][i] for i in shard) for shard in shards) == [9, 9]
+    assert assign_shards([1, 2], 4) == [[1], [0], [], []]
+    with pytest.raises(ValueError):
+        assign_shards([1], 0)
+
+
+@pytest.mark.parametrize('healpix_catalog', [FILE_ROWS], indirect=True)
+def test_shard_catalog(healpix_catalog):
+    """Verify that shards are balanced by file size and cover all partitions once"""
+    gc = healpix_catalog
+    shards = shard_catalog(gc, 3)
+    assert len(shards) == 3
+    keys = sorted(key for shard in shards for key in shard.keys)
+    assert keys == sorted(key for key, _ in gc.get_partitions())
+    assert all(shard.size > 0 for shard in shards)
+    assert shards[0].size >= shards[-1].size
+    # the largest file alone is its own shard
+    assert shards[0].healpix_pixels == [100]
+
+    shards = shard_catalog(gc, 10, by_healpix=True)
+    assert len(shards) == 5
+    pixels = [shard.config_overwrite()['healpix_pixels'] for shard in shards]
+    assert sorted(sum(pixels, [])) == [100, 101, 102, 103, 104]
+    assert [101] in pixels and len(shards[pixels.index([101])]) == 2
+
+    assert len(shard_catalog(gc, 2, native_filters=['healpix_pixel > 101'])[0].healpix_pixels) <= 2
+
+
+@pytest.mark.parametrize('healpix_catalog', [FILE_ROWS], indirect=True)
+def test_run_shards(healpix_catalog):
+    """Verify that merged shard results equal the results of the whole catalog"""
+    gc = healpix_catalog
+    reducers = [count(), mean(), maximum()]
+    expected = gc.aggregate(['addon_value'], ['addon_value > 100'], reducers)
+    results = run_shards(shard_catalog(gc, 2), ['addon_value'], ['addon_value > 100'], reducers, processes=2)
+    assert set(results) == set(expected)
+    for key, value in expected.items():
+        assert results[key] == pytest.approx(value)
+    assert results['max(addon_value)'] == 104